@@ -23,6 +23,16 @@ class Settings(BaseSettings):
     EMAIL_FROM: str
     
     IMAGES_FOLDER: Path = Path("./static/images")
+
+    RATING_PREGENERATE_STAGES: bool = False
+    RATING_WRITE_BEHIND: bool = False
+    RATING_FLUSH_INTERVAL: float = 1.0
+    RATING_FLUSH_BATCH: int = 500
+    RATING_REAP_ABANDONED: bool = False
+    RATING_ABANDONED_AFTER: float = 30 * 24 * 3600
+    RATING_REAP_INTERVAL: float = 3600.0
+    RATING_REAP_BATCH: int = 1000
+    IDEMPOTENCY_EXPIRE: int = 600
     
     REGISTRATION_TOKEN_PATH: str
     PASS_RESTORE_TOKEN_PATH: str
@@ -1,14 +1,26 @@
 from datetime import datetime
+from enum import Enum, IntEnum
 from typing import Annotated
 from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, declared_attr
-from sqlalchemy import Integer, String, ForeignKey, Boolean, UniqueConstraint
-from sqlalchemy.dialects.postgresql import UUID, ARRAY, TIMESTAMP
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    UniqueConstraint,
+    text,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, TIMESTAMP, UUID
 from sqlalchemy.ext.asyncio import (
     AsyncAttrs,
 )
 from app.models import created_at, updated_at, str_uniq, str_nullable, uuid_pk, int_pk
+import random
 import uuid
-from sqlalchemy.ext.mutable import MutableList
 
 
 user_nullable_fk = Annotated[
@@ -49,6 +61,13 @@ class User(Base):
     hashed_password: Mapped[str] = mapped_column(String, nullable=False)
 
 
+class Pairing(str, Enum):
+    SINGLE_ELIMINATION = "single_elimination"
+    SWISS = "swiss"
+    ELO = "elo"
+    FULL_RANKING = "full_ranking"
+
+
 class Competition(Base):
     id: Mapped[uuid_pk]
     user_id: Mapped[user_fk]
@@ -57,6 +76,16 @@ class Competition(Base):
     category: Mapped[str] = mapped_column(String, nullable=False)
     image: Mapped[str] = mapped_column(String, nullable=False)
     published: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    pairing: Mapped[str] = mapped_column(
+        String,
+        nullable=False,
+        default=Pairing.SINGLE_ELIMINATION,
+        server_default=Pairing.SINGLE_ELIMINATION.value,
+    )
+    # Maintained by triggers on competition_item.
+    items_count: Mapped[int] = mapped_column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
 
 
 class CompetitionItem(Base):
@@ -76,6 +105,30 @@ class CompetitionItem(Base):
     )
 
 
+class CompetitionItemStanding(Base):
+    item_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey(CompetitionItem.id, ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True,
+    )
+    competition_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey(Competition.id, ondelete="CASCADE", onupdate="CASCADE"),
+        nullable=False,
+    )
+    wins: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    losses: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    appearances: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    score: Mapped[float] = mapped_column(Float, default=1500, nullable=False)
+
+    __table_args__ = (
+        Index(
+            "ix_competition_item_standing_competition_id_score",
+            "competition_id",
+            "score",
+            "item_id",
+        ),
+    )
+
+
 class RatingChoice(Base):
     id: Mapped[uuid_pk]
     rating_id: Mapped[uuid.UUID] = mapped_column(
@@ -90,6 +143,13 @@ class RatingChoice(Base):
         nullable=True,
     )
     stage: Mapped[int] = mapped_column(Integer, default=1, nullable=False)
+    round: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint(
+            "rating_id", "stage", "round", name="uq_rating_choice_rating_id_stage_round"
+        ),
+    )
 
 
 class Rating(Base):
@@ -101,11 +161,99 @@ class Rating(Base):
     user_id: Mapped[user_fk]
     ended: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
     stage: Mapped[int] = mapped_column(Integer, default=1, nullable=False)
-    choices: Mapped[list[uuid.UUID]] = mapped_column(
-        MutableList.as_mutable(ARRAY(UUID)), default=[]
-    )
+    round: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
     is_refreshed: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
     is_refreshable: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+    # Pairings are derived from the seed, so they can be reproduced.
+    seed: Mapped[int] = mapped_column(
+        BigInteger, default=lambda: random.getrandbits(63), nullable=False
+    )
+    refreshes: Mapped[int] = mapped_column(
+        Integer, default=0, server_default="0", nullable=False
+    )
+    # The number of items taking part, counted when the rating starts.
+    items_count: Mapped[int] = mapped_column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    # Taken from the competition when the rating starts.
+    pairing: Mapped[str] = mapped_column(
+        String,
+        nullable=False,
+        default=Pairing.SINGLE_ELIMINATION,
+        server_default=Pairing.SINGLE_ELIMINATION.value,
+    )
+    # Items ranked so far, best first; kept by full ranking ratings only.
+    ranking: Mapped[list[uuid.UUID] | None] = mapped_column(
+        ARRAY(UUID), nullable=True
+    )
+
+    __table_args__ = (
+        # A user has at most one unfinished rating per competition.
+        Index(
+            "uq_rating_user_id_competition_id_unfinished",
+            "user_id",
+            "competition_id",
+            unique=True,
+            postgresql_where=text("NOT ended"),
+        ),
+        Index(
+            "ix_rating_updated_at_unfinished",
+            "updated_at",
+            postgresql_where=text("NOT ended"),
+        ),
+    )
+
+
+class RatingItemStatus(IntEnum):
+    AVAILABLE = 0
+    PAIRED = 1
+    ELIMINATED = 2
+
+
+class RatingItem(Base):
+    rating_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey(Rating.id, ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True,
+    )
+    item_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey(CompetitionItem.id, ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True,
+    )
+    stage: Mapped[int] = mapped_column(Integer, default=1, nullable=False)
+    status: Mapped[int] = mapped_column(
+        Integer, default=RatingItemStatus.AVAILABLE, nullable=False
+    )
+    # Kept by scored pairing strategies; the insertion order of items in
+    # full ranking ratings.
+    score: Mapped[float] = mapped_column(
+        Float, default=0, server_default="0", nullable=False
+    )
+
+    __table_args__ = (
+        Index("ix_rating_item_rating_id_stage_status", "rating_id", "stage", "status"),
+    )
+
+
+class RatingArchive(Base):
+    rating_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey(Rating.id, ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True,
+    )
+    # Choices of an ended rating in stage and round order, packed with
+    # app.utils.archive.pack_choices.
+    choices: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    stage_sizes: Mapped[list[int]] = mapped_column(ARRAY(Integer), nullable=False)
+
+
+class RatingResult(Base):
+    rating_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey(Rating.id, ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True,
+    )
+    # Items of an ended rating from the champion down, in tiers of the stage
+    # they got to.
+    items: Mapped[list[uuid.UUID]] = mapped_column(ARRAY(UUID), nullable=False)
+    tier_sizes: Mapped[list[int]] = mapped_column(ARRAY(Integer), nullable=False)
 
 
 class ProhibitedTokens(Base):
@@ -11,3 +11,4 @@ OptionalMaxPerPageType = Annotated[
 OptionalPageType = Annotated[
     int | None, Query(gt=0, le=9223372036854775807)
 ]
+OptionalSeedType = Annotated[int | None, Query(ge=0, le=9223372036854775807)]
@@ -1,5 +1,6 @@
 from uuid import UUID
 from fastapi import APIRouter, Depends, Form, UploadFile, File
+from app.models.tests import Pairing
 from app.routers import (
     MaxPerPageType,
     PageType,
@@ -13,11 +14,13 @@ from app.schemas.competition import (
 from app.schemas.competition_item import (
     CompetitionItemPaginatedResponseSchema,
     CompetitionItemSchema,
+    CompetitionItemStandingPaginatedResponseSchema,
     NewCompetitionItemSchema,
     UpdateCompetitionItemPayloadSchema,
 )
 from app.services.competition import CompetitionService
 from app.services.competition_item import CompetitionItemService
+from app.services.competition_item_standing import CompetitionItemStandingService
 from app.utils.token import httpbearer
 
 router = APIRouter(prefix="/competition", tags=["Competition"])
@@ -44,6 +47,7 @@ async def post(
     title: str = Form(),
     description: str = Form(),
     category: str = Form(),
+    pairing: Pairing = Form(Pairing.SINGLE_ELIMINATION),
     service: CompetitionService = Depends(CompetitionService.get_service),
 ):
     return await service.post(
@@ -51,6 +55,7 @@ async def post(
         description=description,
         category=category,
         image=image,
+        pairing=pairing,
     )
 
 
@@ -59,7 +64,7 @@ async def get(
     competition_id: UUID,
     service: CompetitionService = Depends(CompetitionService.get_service),
 ):
-    return await service.get(id=competition_id)
+    return await service.get_cached(id=competition_id)
 
 
 @router.patch(
@@ -74,6 +79,7 @@ async def update(
     description: str | None = Form(None),
     category: str | None = Form(None),
     published: bool | None = Form(None),
+    pairing: Pairing | None = Form(None),
     service: CompetitionService = Depends(CompetitionService.get_service),
 ):
     return await service.update(
@@ -83,6 +89,7 @@ async def update(
         description=description,
         category=category,
         published=published,
+        pairing=pairing,
     )
 
 
@@ -174,3 +181,20 @@ async def get_rounds_total(
     service: CompetitionService = Depends(CompetitionService.get_service),
 ):
     return await service.get_stages_total(id=competition_id)
+
+
+@router.get(
+    "/{competition_id}/standings/",
+    response_model=CompetitionItemStandingPaginatedResponseSchema,
+)
+async def get_standings(
+    competition_id: UUID,
+    max_per_page: MaxPerPageType,
+    page: PageType,
+    service: CompetitionItemStandingService = Depends(
+        CompetitionItemStandingService.get_service
+    ),
+):
+    return await service.get_paginated_list(
+        max_per_page=max_per_page, page=page, competition_id=competition_id
+    )
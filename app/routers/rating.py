@@ -1,20 +1,28 @@
 from uuid import UUID
-from fastapi import APIRouter, Depends
-from app.routers import MaxPerPageType, PageType
+from fastapi import APIRouter, Depends, Header, Response
+from app.models.tests import Pairing
+from app.routers import MaxPerPageType, OptionalSeedType, PageType
 from app.schemas.competition_item import CompetitionItemSchema
 from app.schemas.rating import (
+    ChooseBatchItemSchema,
     ChoosePayloadSchema,
     ChooseResponseSchema,
+    CompactGridSchema,
     RatingChoiceResponseSchema,
     RatingSchema,
     RatingPaginatedResponseSchema,
+    RatingResultSchema,
+    RatingSnapshotSchema,
 )
 from app.services.rating import RatingService
+from app.utils.idempotency import Idempotency
 from app.utils.token import httpbearer
 
 
 router = APIRouter(prefix="/rating", tags=["Rating"])
 
+GRID_COMPACT_MEDIA_TYPE = "application/vnd.rating-grid.compact+json"
+
 
 @router.get(
     "/",
@@ -47,20 +55,34 @@ async def get_paginated_list(
 )
 async def start(
     competition_id: UUID,
+    seed: OptionalSeedType = None,
+    resume: bool = True,
+    pairing: Pairing | None = None,
+    idempotency: Idempotency = Depends(Idempotency.get_dependency),
     service: RatingService = Depends(RatingService.get_service),
 ):
-    return await service.start(competition_id=competition_id)
+    return await idempotency.run(
+        lambda: service.start(
+            competition_id=competition_id, seed=seed, resume=resume, pairing=pairing
+        )
+    )
 
 
 @router.get(
     "/{id}/grid/",
-    response_model=list[list[tuple[UUID, UUID | None]]],
+    response_model=list[list[tuple[UUID, UUID | None]]] | CompactGridSchema,
     dependencies=[Depends(httpbearer)],
 )
 async def get_grid(
     id: UUID,
+    response: Response,
+    compact: bool = False,
+    accept: str | None = Header(None),
     service: RatingService = Depends(RatingService.get_service),
 ):
+    response.headers["Vary"] = "Accept"
+    if compact or (accept and GRID_COMPACT_MEDIA_TYPE in accept):
+        return await service.get_compact_grid(id=id)
     return await service.get_grid(id=id)
 
 
@@ -85,7 +107,7 @@ async def get_available_items_ids(
     id: UUID,
     service: RatingService = Depends(RatingService.get_service),
 ):
-    return await service._get_available_items_ids(rating_id=id)
+    return await service.get_available_items_ids(id=id)
 
 
 @router.get(
@@ -100,6 +122,37 @@ async def get_rounds_total(
     return await service.get_rounds_total(id=id)
 
 
+@router.get(
+    "/{id}/snapshot/",
+    response_model=RatingSnapshotSchema,
+    dependencies=[Depends(httpbearer)],
+    responses={304: {"description": "Snapshot not modified"}},
+)
+async def get_snapshot(
+    id: UUID,
+    response: Response,
+    if_none_match: str | None = Header(None),
+    service: RatingService = Depends(RatingService.get_service),
+):
+    etag, snapshot = await service.get_snapshot(id=id, etag=if_none_match)
+    if snapshot is None:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return snapshot
+
+
+@router.get(
+    "/{id}/result/",
+    response_model=RatingResultSchema,
+    dependencies=[Depends(httpbearer)],
+)
+async def get_result(
+    id: UUID,
+    service: RatingService = Depends(RatingService.get_service),
+):
+    return await service.get_result(id=id)
+
+
 @router.get(
     "/{id}/choice/last/",
     response_model=RatingChoiceResponseSchema,
@@ -107,9 +160,10 @@ async def get_rounds_total(
 )
 async def get_last_choice(
     id: UUID,
+    embed_items: bool = False,
     service: RatingService = Depends(RatingService.get_service),
 ):
-    return await service.get_last_choice(id=id)
+    return await service.get_last_choice(id=id, embed_items=embed_items)
 
 
 @router.get(
@@ -120,9 +174,12 @@ async def get_last_choice(
 async def get_choice(
     id: UUID,
     rating_choice_id: UUID,
+    embed_items: bool = False,
     service: RatingService = Depends(RatingService.get_service),
 ):
-    return await service.get_choice(rating_id=id, choice_id=rating_choice_id)
+    return await service.get_choice(
+        rating_id=id, choice_id=rating_choice_id, embed_items=embed_items
+    )
 
 
 @router.get(
@@ -145,9 +202,30 @@ async def get(
 async def refresh(
     id: UUID,
     choice_id: UUID,
+    embed_items: bool = False,
+    idempotency: Idempotency = Depends(Idempotency.get_dependency),
+    service: RatingService = Depends(RatingService.get_service),
+):
+    return await idempotency.run(
+        lambda: service.refresh(id=id, choice_id=choice_id, embed_items=embed_items)
+    )
+
+
+@router.post(
+    "/{id}/choose/",
+    response_model=ChooseResponseSchema,
+    dependencies=[Depends(httpbearer)],
+)
+async def choose_batch(
+    id: UUID,
+    payload: list[ChooseBatchItemSchema],
+    embed_items: bool = False,
+    idempotency: Idempotency = Depends(Idempotency.get_dependency),
     service: RatingService = Depends(RatingService.get_service),
 ):
-    return await service.refresh(id=id, choice_id=choice_id)
+    return await idempotency.run(
+        lambda: service.choose_batch(id=id, payload=payload, embed_items=embed_items)
+    )
 
 
 @router.post(
@@ -159,6 +237,12 @@ async def choose(
     id: UUID,
     choice_id: UUID,
     payload: ChoosePayloadSchema,
+    embed_items: bool = False,
+    idempotency: Idempotency = Depends(Idempotency.get_dependency),
     service: RatingService = Depends(RatingService.get_service),
 ):
-    return await service.choose(id=id, choice_id=choice_id, payload=payload)
+    return await idempotency.run(
+        lambda: service.choose(
+            id=id, choice_id=choice_id, payload=payload, embed_items=embed_items
+        )
+    )
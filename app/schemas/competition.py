@@ -1,5 +1,6 @@
 from uuid import UUID
 from pydantic import BaseModel
+from app.models.tests import Pairing
 from app.utils.pagination import PaginatedResponse
 
 
@@ -14,6 +15,8 @@ class NewCompetitionSchema(BaseModel):
 
 class CompetitionSchema(NewCompetitionSchema):
     id: UUID
+    items_count: int = 0
+    pairing: Pairing = Pairing.SINGLE_ELIMINATION
 
 
 class CompetitionPaginatedResponseSchema(PaginatedResponse):
@@ -19,6 +19,20 @@ class CompetitionItemPaginatedResponseSchema(PaginatedResponse):
     data: list[CompetitionItemSchema]
 
 
+class CompetitionItemStandingSchema(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    item_id: UUID
+    wins: int
+    losses: int
+    appearances: int
+    score: float
+
+
+class CompetitionItemStandingPaginatedResponseSchema(PaginatedResponse):
+    data: list[CompetitionItemStandingSchema]
+
+
 class UpdateCompetitionItemPayloadSchema(BaseModel):
     title: str | None = None
     description: str | None = None
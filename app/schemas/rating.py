@@ -1,5 +1,7 @@
 from uuid import UUID
 from pydantic import BaseModel, ConfigDict
+from app.models.tests import Pairing
+from app.schemas.competition_item import CompetitionItemSchema
 from app.utils.pagination import PaginatedResponse
 
 
@@ -9,9 +11,10 @@ class NewRatingSchema(BaseModel):
     competition_id: UUID
     user_id: UUID
     stage: int
-    choices: list[UUID]
+    round: int
     ended: bool
     is_refreshed: bool
+    pairing: Pairing = Pairing.SINGLE_ELIMINATION
 
 
 class RatingSchema(NewRatingSchema):
@@ -30,12 +33,42 @@ class RatingChoiceResponseSchema(BaseModel):
     prev: UUID | None = None
     next: UUID | None = None
     winner_id: UUID | None = None
+    items_data: list[CompetitionItemSchema] | None = None
 
 
 class ChoosePayloadSchema(BaseModel):
     winner_id: UUID
 
 
+class ChooseBatchItemSchema(ChoosePayloadSchema):
+    choice_id: UUID
+
+
 class ChooseResponseSchema(BaseModel):
     next_choice: RatingChoiceResponseSchema | None = None
     ended: bool
+
+
+class CompactGridSchema(BaseModel):
+    items: list[UUID]
+    stages: list[list[tuple[int, int | None]]]
+
+
+class RatingSnapshotSchema(BaseModel):
+    rating: RatingSchema
+    choice: RatingChoiceResponseSchema | None = None
+    items: list[CompetitionItemSchema]
+    grid: list[list[tuple[UUID, UUID | None]]]
+    rounds_total: int
+    stages_total: int
+
+
+class RatingResultSchema(BaseModel):
+    rating_id: UUID
+    champion: UUID
+    runner_up: UUID | None = None
+    # Items eliminated in every stage, the first stage first.
+    eliminated: list[list[UUID]]
+    # Every item from the champion down; items of a tier are tied, the
+    # champion and the runner-up are the first of them.
+    tiers: list[list[UUID]]
@@ -7,13 +7,16 @@ from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import get_async_session, get_redis
 from app.utils.pagination import Paginator
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from types import FunctionType, MethodType
 from asyncio import iscoroutinefunction
 
 from app.utils.token import AccessToken, get_optional_access_token_data
 from functools import wraps
 
+# Raised by SELECT ... FOR UPDATE NOWAIT on a row locked by another request.
+LOCK_NOT_AVAILABLE = "55P03"
+
 
 class ExceptionHandlerMeta(type):
     def __new__(cls, name, bases, dct):
@@ -34,6 +37,10 @@ class ExceptionHandlerMeta(type):
             except IntegrityError as e:
                 errors = tuple(i.split("DETAIL:")[1].lstrip() for i in e.args)
                 raise HTTPException(409, errors)
+            except DBAPIError as e:
+                if getattr(e.orig, "pgcode", None) != LOCK_NOT_AVAILABLE:
+                    raise
+                raise HTTPException(409, "Updated by another request")
 
         return wrapper
 
@@ -46,6 +53,10 @@ class ExceptionHandlerMeta(type):
             except IntegrityError as e:
                 errors = tuple(i.split("DETAIL:")[1].lstrip() for i in e.args)
                 raise HTTPException(409, errors)
+            except DBAPIError as e:
+                if getattr(e.orig, "pgcode", None) != LOCK_NOT_AVAILABLE:
+                    raise
+                raise HTTPException(409, "Updated by another request")
 
         return wrapper
 
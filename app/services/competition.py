@@ -1,10 +1,10 @@
 from datetime import datetime
-import math
 import os
 from uuid import UUID
 from fastapi import HTTPException, UploadFile
-from sqlalchemy import func, select
+from sqlalchemy import select
 from app.config import settings
+from app.schemas.competition import CompetitionSchema
 from app.schemas.competition_item import (
     UpdateCompetitionItemPayloadSchema,
 )
@@ -14,13 +14,17 @@ from PIL import Image
 from io import BytesIO
 from pathlib import Path
 import aiofiles
+from app.services.competition_item import CompetitionItemService
 from app.services.youtube import YouTubeService
+from app.utils.pairing import get_strategy
+from app.utils.redis import invalidate_tags
 
 
 class CompetitionService(BaseService, ModelRequests[Competition]):
     model = Competition
 
     _youtube_service: YouTubeService = None
+    _competition_item_service: CompetitionItemService = None
 
     @property
     def youtube_service(self):
@@ -30,6 +34,14 @@ class CompetitionService(BaseService, ModelRequests[Competition]):
             )
         return self._youtube_service
 
+    @property
+    def competition_item_service(self):
+        if self._competition_item_service is None:
+            self._competition_item_service = CompetitionItemService(
+                self.session, self.redis, self._token
+            )
+        return self._competition_item_service
+
     async def _process_image(self, image: UploadFile, user_id: UUID) -> str:
         try:
             contents = await image.read()
@@ -70,6 +82,20 @@ class CompetitionService(BaseService, ModelRequests[Competition]):
             )
         return data
 
+    async def get_cached(self, id: UUID) -> CompetitionSchema:
+        """
+        Get a competition like `get`, read from the cache of competitions.
+        """
+        competition = await self.competition_item_service.get_competition(id)
+        if not competition or (
+            not competition.published
+            and (not self._token or competition.user_id != self.token.sub)
+        ):
+            raise HTTPException(
+                status_code=404, detail=f"{self.model.__name__} not found"
+            )
+        return competition
+
     async def post(
         self,
         title: str,
@@ -118,6 +144,9 @@ class CompetitionService(BaseService, ModelRequests[Competition]):
 
         await self.session.commit()
         await self.session.refresh(instance)
+        await invalidate_tags(
+            CompetitionItemService.cache_tag.format(competition_id=id)
+        )
 
         return instance
 
@@ -131,6 +160,9 @@ class CompetitionService(BaseService, ModelRequests[Competition]):
         self._check_permission(instance, self.token.sub)
         await self.session.delete(instance)
         await self.session.commit()
+        await invalidate_tags(
+            CompetitionItemService.cache_tag.format(competition_id=id)
+        )
         self._delete_old_image(image)
         return True
 
@@ -183,6 +215,7 @@ class CompetitionService(BaseService, ModelRequests[Competition]):
 
         await self.session.commit()
         await self.session.refresh(competition_item)
+        await self.competition_item_service.delete_cached_items(id)
         return competition_item
 
     async def delete_item(self, id: UUID, item_id: UUID):
@@ -199,14 +232,9 @@ class CompetitionService(BaseService, ModelRequests[Competition]):
             )
         await self.session.delete(competition_item)
         await self.session.commit()
+        await self.competition_item_service.delete_cached_items(id)
         return True
 
     async def get_stages_total(self, id: UUID):
         competition = await self.get(id=id)
-
-        stmt = select(func.count(CompetitionItem.id)).filter(
-            CompetitionItem.competition_id == competition.id
-        )
-        items_total: int = await self.session.scalar(stmt)
-
-        return math.ceil(math.log2(items_total))
+        return get_strategy(competition.pairing).stages_total(competition.items_count)
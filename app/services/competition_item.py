@@ -1,19 +1,92 @@
 from uuid import UUID
 from fastapi import HTTPException
 from sqlalchemy import select
+from app.schemas.competition import CompetitionSchema
+from app.schemas.competition_item import CompetitionItemSchema
+from app.database import db_manager
 from app.services import BaseService, ModelRequests
 from app.models.tests import Competition, CompetitionItem
+from app.utils.redis import cache, invalidate_tags
 
 
 class CompetitionItemService(BaseService, ModelRequests[CompetitionItem]):
     model = CompetitionItem
 
+    cache_items = "cache:CompetitionItemService:items:{competition_id}"
+    cache_items_version = "cache:CompetitionItemService:items_version:{competition_id}"
+    cache_tag = "competition:{competition_id}"
+    cache_expire = 3600
+
+    async def get_cached_items(
+        self, competition_id: UUID, ids: list[UUID]
+    ) -> list[CompetitionItemSchema]:
+        """
+        Get items of a competition from a cache holding all of its items.
+
+        The cache is filled with every item of the competition on the first
+        miss.
+
+        Args:
+            competition_id: The id of the competition.
+            ids: The ids of the items.
+
+        Returns:
+            The items found, in the order of `ids`.
+        """
+        if not ids:
+            return []
+        cache_key = self.cache_items.format(competition_id=competition_id)
+        cached = await self.redis.hmget(cache_key, [str(i) for i in ids])
+        if None in cached:
+            stmt = select(CompetitionItem).filter(
+                CompetitionItem.competition_id == competition_id
+            )
+            items = {
+                str(item.id): CompetitionItemSchema.model_validate(item).model_dump_json()
+                for item in (await self.session.scalars(stmt)).all()
+            }
+            if items:
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    pipe.delete(cache_key)
+                    pipe.hset(cache_key, mapping=items)
+                    pipe.expire(cache_key, self.cache_expire)
+                    await pipe.execute()
+            cached = [items.get(str(i)) for i in ids]
+        return [CompetitionItemSchema.model_validate_json(i) for i in cached if i]
+
+    @cache(
+        expire=600,
+        local_expire=0,
+        tags=lambda self, competition_id: [
+            self.cache_tag.format(competition_id=competition_id)
+        ],
+    )
+    async def get_competition(self, competition_id: UUID) -> CompetitionSchema | None:
+        """
+        Get a competition; every request to its items reads it, so it is
+        cached under the tag of the competition.
+
+        Access checks depend on it, so it is not kept in process where an
+        unpublished competition would stay visible, and it is read in a
+        session of its own, since the call is shared by concurrent requests.
+        """
+        async with db_manager.session() as session:
+            competition = await session.get(Competition, competition_id)
+        if not competition:
+            return None
+        return CompetitionSchema.model_validate(competition, from_attributes=True)
+
+    async def delete_cached_items(self, competition_id: UUID):
+        await self.redis.delete(
+            self.cache_items.format(competition_id=competition_id),
+            self.cache_items_version.format(competition_id=competition_id),
+        )
+        await invalidate_tags(self.cache_tag.format(competition_id=competition_id))
+
     async def get_list(self, **filters):
         competition_id: UUID = filters.get("competition_id")
         if competition_id:
-            competition = await self.session.scalar(
-                select(Competition).filter(Competition.id == competition_id)
-            )
+            competition = await self.get_competition(competition_id)
             if not competition or (
                 competition.published and competition.user_id != self.token.sub
             ):
@@ -23,9 +96,7 @@ class CompetitionItemService(BaseService, ModelRequests[CompetitionItem]):
     async def get_paginated_list(self, max_per_page: int, page: int, **filters):
         competition_id: UUID = filters.get("competition_id")
         if competition_id:
-            competition = await self.session.scalar(
-                select(Competition).filter(Competition.id == competition_id)
-            )
+            competition = await self.get_competition(competition_id)
             if not competition or (
                 competition.published and competition.user_id != self.token.sub
             ):
@@ -45,27 +116,29 @@ class CompetitionItemService(BaseService, ModelRequests[CompetitionItem]):
     async def get(self, **filters) -> CompetitionItem:
         competition_id: UUID = filters.get("competition_id")
         if competition_id:
-            competition = await self.session.scalar(
-                select(Competition).filter(Competition.id == competition_id)
-            )
+            competition = await self.get_competition(competition_id)
             if not competition or (
                 competition.published and competition.user_id != self.token.sub
             ):
                 raise HTTPException(404, "Competition not found")
         return await super().get(**filters)
 
+    async def post(self, competition_id: UUID, **data):
+        instance = await super().post(competition_id=competition_id, **data)
+        await self.delete_cached_items(competition_id)
+        return instance
+
     async def update(self, id: UUID, competition_id: UUID, **data):
-        competition = await self.session.scalar(
-            select(Competition).filter(Competition.id == competition_id)
-        )
+        competition = await self.get_competition(competition_id)
         if not competition or (competition.user_id != self.token.sub):
             raise HTTPException(404, "Competition not found")
-        return await super().update(id, **data)
+        instance = await super().update(id, **data)
+        await self.delete_cached_items(competition_id)
+        return instance
 
     async def delete(self, id: UUID, competition_id: UUID):
-        competition = await self.session.scalar(
-            select(Competition).filter(Competition.id == competition_id)
-        )
+        competition = await self.get_competition(competition_id)
         if not competition or (competition.user_id != self.token.sub):
             raise HTTPException(404, "Competition not found")
+        await self.delete_cached_items(competition_id)
         return await super().delete(id)
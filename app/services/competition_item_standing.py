@@ -0,0 +1,253 @@
+from itertools import chain
+from uuid import UUID
+from fastapi import HTTPException
+import numpy as np
+from sqlalchemy import Integer, case, delete, func, insert, literal, select, update
+from sqlalchemy.dialects.postgresql import UUID as UUIDType, insert as pg_insert
+from sqlalchemy.orm import aliased
+from app.services import BaseService, ModelRequests
+from app.models.tests import (
+    Competition,
+    CompetitionItem,
+    CompetitionItemStanding,
+    Rating,
+    RatingArchive,
+    RatingChoice,
+)
+from app.utils.archive import CHOICE_DTYPE
+from app.utils.pagination import Paginator
+from app.utils.scores import fit_bradley_terry, to_elo
+
+
+class CompetitionItemStandingService(BaseService, ModelRequests[CompetitionItemStanding]):
+    model = CompetitionItemStanding
+
+    base_score = 1500
+    k_factor = 32
+
+    def _stage_games(self, rating_id: UUID, stage: int):
+        winners = select(
+            RatingChoice.winner_id.label("item_id"),
+            RatingChoice.looser_id.label("opponent_id"),
+            case((RatingChoice.looser_id.is_(None), 0), else_=1).label("wins"),
+            literal(0, Integer).label("losses"),
+        ).filter(RatingChoice.rating_id == rating_id, RatingChoice.stage == stage)
+        loosers = select(
+            RatingChoice.looser_id,
+            RatingChoice.winner_id,
+            literal(0, Integer),
+            literal(1, Integer),
+        ).filter(
+            RatingChoice.rating_id == rating_id,
+            RatingChoice.stage == stage,
+            RatingChoice.looser_id.is_not(None),
+        )
+        return winners.union_all(loosers).cte("games")
+
+    async def record_stage(self, rating_id: UUID, competition_id: UUID, stage: int):
+        """
+        Add the results of a finished rating stage to the standings.
+
+        Results become final when their stage ends, so they are counted once
+        and never have to be taken back. Elo updates of a stage are all taken
+        from the scores before it and summed up per item, since an item may
+        play several times in a stage of a full ranking, so they are applied
+        at once. Rows of the items are taken in the order of their ids, so
+        that stages of ratings of a competition ending at the same time wait
+        for each other instead of deadlocking.
+
+        Args:
+            rating_id: The id of the rating.
+            competition_id: The id of the rating competition.
+            stage: The finished stage.
+        """
+        games = self._stage_games(rating_id, stage)
+        stmt = (
+            pg_insert(CompetitionItemStanding)
+            .from_select(
+                ["item_id", "competition_id", "score"],
+                select(
+                    games.c.item_id,
+                    literal(competition_id, UUIDType),
+                    literal(self.base_score),
+                ).order_by(games.c.item_id),
+            )
+            .on_conflict_do_nothing()
+        )
+        await self.session.execute(stmt)
+
+        games = self._stage_games(rating_id, stage)
+        stmt = (
+            select(CompetitionItemStanding.item_id)
+            .filter(CompetitionItemStanding.item_id.in_(select(games.c.item_id)))
+            .order_by(CompetitionItemStanding.item_id)
+            .with_for_update()
+        )
+        await self.session.execute(stmt)
+
+        games = self._stage_games(rating_id, stage)
+        own = aliased(CompetitionItemStanding)
+        opponent = aliased(CompetitionItemStanding)
+        expected = 1 / (1 + func.power(10.0, (opponent.score - own.score) / 400))
+        results = (
+            select(
+                games.c.item_id,
+                func.sum(games.c.wins).label("wins"),
+                func.sum(games.c.losses).label("losses"),
+                func.count().label("appearances"),
+                func.sum(
+                    func.coalesce(self.k_factor * (games.c.wins - expected), 0)
+                ).label("delta"),
+            )
+            .join(own, own.item_id == games.c.item_id)
+            .outerjoin(opponent, opponent.item_id == games.c.opponent_id)
+            .group_by(games.c.item_id)
+            .subquery()
+        )
+        stmt = (
+            update(CompetitionItemStanding)
+            .filter(CompetitionItemStanding.item_id == results.c.item_id)
+            .values(
+                wins=CompetitionItemStanding.wins + results.c.wins,
+                losses=CompetitionItemStanding.losses + results.c.losses,
+                appearances=CompetitionItemStanding.appearances
+                + results.c.appearances,
+                score=CompetitionItemStanding.score + results.c.delta,
+                updated_at=func.now(),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await self.session.execute(stmt)
+
+    async def recompute(self, competition_id: UUID, chunk_size: int = 100_000) -> int:
+        """
+        Rebuild the standings of a competition from all finished rating stages,
+        archived ones included.
+
+        Comparisons are streamed with items encoded as integer indices and
+        scores are fitted with the Bradley-Terry model on the Elo scale.
+
+        Args:
+            competition_id: The id of the competition.
+            chunk_size: Number of comparisons fetched at once.
+
+        Returns:
+            The number of items with standings.
+        """
+        stmt = (
+            select(CompetitionItem.id)
+            .filter(CompetitionItem.competition_id == competition_id)
+            .order_by(CompetitionItem.id)
+        )
+        ids = (await self.session.scalars(stmt)).all()
+
+        indices = (
+            select(
+                CompetitionItem.id,
+                (func.row_number().over(order_by=CompetitionItem.id) - 1).label(
+                    "index"
+                ),
+            )
+            .filter(CompetitionItem.competition_id == competition_id)
+            .subquery()
+        )
+        winner = aliased(indices)
+        looser = aliased(indices)
+        stmt = (
+            select(winner.c.index, func.coalesce(looser.c.index, -1))
+            .select_from(RatingChoice)
+            .join(Rating, Rating.id == RatingChoice.rating_id)
+            .join(winner, winner.c.id == RatingChoice.winner_id)
+            .outerjoin(looser, looser.c.id == RatingChoice.looser_id)
+            .filter(
+                Rating.competition_id == competition_id,
+                RatingChoice.stage < Rating.stage,
+            )
+            .execution_options(yield_per=chunk_size)
+        )
+        chunks = [np.empty(0, dtype=np.int64)]
+        result = await self.session.stream(stmt)
+        async for partition in result.partitions():
+            chunks.append(
+                np.fromiter(chain.from_iterable(partition), dtype=np.int64)
+            )
+
+        # Archived ratings have ended, so all of their stages are finished.
+        # Their items are looked up by binary search in the sorted ids.
+        keys = np.array([id.bytes for id in ids], dtype="S16")
+        order = np.argsort(keys)
+        keys = keys[order]
+
+        def positions(values: np.ndarray) -> np.ndarray:
+            if not len(keys):
+                return np.full(len(values), -1, dtype=np.int64)
+            found = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+            return np.where(keys[found] == values, order[found], -1)
+
+        stmt = (
+            select(RatingArchive.choices)
+            .join(Rating, Rating.id == RatingArchive.rating_id)
+            .filter(Rating.competition_id == competition_id)
+            .execution_options(yield_per=max(chunk_size // max(len(ids), 1), 1))
+        )
+        result = await self.session.stream_scalars(stmt)
+        async for partition in result.partitions():
+            records = np.frombuffer(b"".join(partition), dtype=CHOICE_DTYPE)
+            games = np.stack(
+                [positions(records["winner"]), positions(records["looser"])], axis=1
+            )
+            chunks.append(games[games[:, 0] >= 0].ravel())
+        winners, loosers = np.concatenate(chunks).reshape(-1, 2).T
+
+        played = loosers >= 0
+        wins = np.bincount(winners[played], minlength=len(ids))
+        losses = np.bincount(loosers[played], minlength=len(ids))
+        appearances = np.bincount(winners, minlength=len(ids)) + losses
+        scores = to_elo(
+            fit_bradley_terry(winners[played], loosers[played], len(ids)),
+            self.base_score,
+        )
+
+        stmt = delete(CompetitionItemStanding).filter(
+            CompetitionItemStanding.competition_id == competition_id
+        )
+        await self.session.execute(stmt)
+        standings = [
+            dict(
+                item_id=ids[i],
+                competition_id=competition_id,
+                wins=int(wins[i]),
+                losses=int(losses[i]),
+                appearances=int(appearances[i]),
+                score=float(scores[i]),
+            )
+            for i in np.flatnonzero(appearances)
+        ]
+        if standings:
+            await self.session.execute(insert(CompetitionItemStanding), standings)
+        await self.session.commit()
+        return len(standings)
+
+    async def get_paginated_list(self, max_per_page: int, page: int, competition_id: UUID):
+        competition = await self.session.get(Competition, competition_id)
+        if not competition or (
+            not competition.published
+            and (not self._token or competition.user_id != self.token.sub)
+        ):
+            raise HTTPException(404, "Competition not found")
+
+        stmt = (
+            select(CompetitionItemStanding)
+            .filter(CompetitionItemStanding.competition_id == competition_id)
+            .order_by(
+                CompetitionItemStanding.score.desc(),
+                CompetitionItemStanding.item_id.desc(),
+            )
+        )
+        paginator = Paginator(
+            session=self.session, stmt=stmt, max_per_page=max_per_page, page=page
+        )
+        await paginator.execute()
+        if not paginator.data:
+            raise HTTPException(status_code=404, detail="Data is out of bounds")
+        return paginator.response
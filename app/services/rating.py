@@ -1,30 +1,71 @@
-from collections import defaultdict
+import asyncio
+from datetime import datetime, timedelta
+from itertools import groupby
 import json
-import math
+import logging
 from typing import Any, Callable, TypeVar
-from uuid import UUID
+from uuid import UUID, uuid4
 from fastapi import HTTPException
-from sqlalchemy import func, select, delete
+from sqlalchemy import (
+    Float,
+    Integer,
+    and_,
+    case,
+    column,
+    func,
+    insert,
+    literal,
+    select,
+    delete,
+    exists,
+    true,
+    update,
+    values,
+)
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import UUID as UUIDType, insert as pg_insert
+from app.config import settings
+from app.database import db_manager, redis_manager
 from app.schemas.rating import (
+    ChooseBatchItemSchema,
     ChoosePayloadSchema,
     ChooseResponseSchema,
     RatingChoiceResponseSchema,
+    RatingResultSchema,
+    RatingSchema,
+    RatingSnapshotSchema,
 )
 from app.services import BaseService, ModelRequests
-from app.models.tests import Competition, CompetitionItem, Rating, RatingChoice
+from app.models.tests import (
+    Competition,
+    CompetitionItem,
+    Pairing,
+    Rating,
+    RatingArchive,
+    RatingChoice,
+    RatingItem,
+    RatingItemStatus,
+    RatingResult,
+)
 import random
 from app.services.competition_item import CompetitionItemService
+from app.services.competition_item_standing import CompetitionItemStandingService
 from app.services.rating_choice import RatingChoiceService
+from app.utils.archive import pack_choices, unpack_choices
+from app.utils.pairing import PairingStrategy, get_strategy, sequential_pairings
 
 
 _T = TypeVar("_T", bound=Any)
 
+logger = logging.getLogger(__name__)
+
 
 class RatingService(BaseService, ModelRequests[Rating]):
     model = Rating
 
     _rating_choice_service: RatingChoiceService = None
     _competition_item_service: CompetitionItemService = None
+    _competition_item_standing_service: CompetitionItemStandingService = None
 
     @property
     def rating_choice_service(self):
@@ -42,10 +83,141 @@ class RatingService(BaseService, ModelRequests[Rating]):
             )
         return self._competition_item_service
 
-    cache_key_items = "cache:RatingService:available_items:{rating_id}"
+    @property
+    def competition_item_standing_service(self):
+        if self._competition_item_standing_service is None:
+            self._competition_item_standing_service = CompetitionItemStandingService(
+                self.session, self.redis, self._token
+            )
+        return self._competition_item_standing_service
+
+    # A sorted set scored by the seeded order of the stage.
+    cache_key_items = "cache:RatingService:item_pool:{rating_id}"
+    # The user of a rating, kept next to its pool so that pairs are only drawn
+    # for the user before the rating is read.
+    cache_key_owner = "cache:RatingService:owner:{rating_id}"
     cache_grid = "cache:RatingService:grid:{rating_id}"
+    # Changed along with the rating, so it can be compared without reading it.
+    cache_snapshot_version = "cache:RatingService:snapshot_version:{rating_id}"
+    # Set in place of the version before a change is committed, so that no
+    # version is stored for a snapshot read meanwhile; it outlives the change.
+    snapshot_pending = "pending"
+    snapshot_pending_expire = 10
     cache_expire = 3600
 
+    # Pops the next two ids of the stage pool in one atomic step. The user
+    # ARGV[2] must own the rating, unless ARGV[3] is '1' because the rating
+    # has been read, which records the owner. Unless ARGV[4] is 0, the
+    # snapshot version KEYS[3] is marked pending for ARGV[4] seconds, as the
+    # drawn pair is about to be committed. When the pool is missing it is
+    # filled from ARGV[5:], in
+    # order, first (unless another worker has already rebuilt it); with
+    # nothing to fill from the script returns nil.
+    draw_pair_script = """
+    if ARGV[3] == '1' then
+        redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[1])
+    elseif redis.call('GET', KEYS[2]) ~= ARGV[2] then
+        return false
+    end
+    if ARGV[4] ~= '0' then
+        redis.call('SET', KEYS[3], 'pending', 'EX', ARGV[4])
+    end
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        if #ARGV < 5 then
+            return false
+        end
+        for i = 5, #ARGV, 500 do
+            local args = {}
+            for j = i, math.min(i + 499, #ARGV) do
+                args[#args + 1] = j
+                args[#args + 1] = ARGV[j]
+            end
+            redis.call('ZADD', KEYS[1], unpack(args))
+        end
+    end
+    local ids = {}
+    local popped = redis.call('ZPOPMIN', KEYS[1], 2)
+    for i = 1, #popped, 2 do
+        ids[#ids + 1] = popped[i]
+    end
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        redis.call('EXPIRE', KEYS[1], ARGV[1])
+        redis.call('EXPIRE', KEYS[2], ARGV[1])
+    end
+    return ids
+    """
+
+    # Write-behind mode: the frontier of a rating lives in a hash, choices of
+    # the stage that are yet to come in a list, and recorded results in a
+    # per-rating stream that is flushed to the database in batches.
+    write_behind_state = "RatingService:write_behind:{rating_id}"
+    write_behind_pending = "RatingService:write_behind:{rating_id}:pending"
+    write_behind_log = "RatingService:write_behind:{rating_id}:log"
+    write_behind_dirty = "RatingService:write_behind:dirty"
+
+    # Records the winner of the frontier choice and moves on to the next
+    # choice of the stage: a pending one, or a pair popped from the pool. Returns
+    # nil when the request is not for the frontier or the stage is over.
+    write_behind_choose_script = """
+    local state = redis.call(
+        'HMGET', KEYS[1], 'user_id', 'stage', 'round', 'choice', 'first', 'second',
+        'competition_id'
+    )
+    if state[1] ~= ARGV[1] or state[4] ~= ARGV[2] then
+        return false
+    end
+    local looser
+    if ARGV[3] == state[5] then
+        looser = state[6]
+    elseif ARGV[3] == state[6] then
+        looser = state[5]
+    else
+        return false
+    end
+    local next_id, first, second, inserted
+    local pending = redis.call('LPOP', KEYS[2])
+    if pending then
+        next_id, first, second = string.match(pending, '([^|]*)|([^|]*)|([^|]*)')
+        inserted = '0'
+    else
+        local pair = redis.call('ZPOPMIN', KEYS[3], 2)
+        if #pair == 0 then
+            return false
+        end
+        next_id, first, second, inserted = ARGV[4], pair[1], pair[3] or '', '1'
+    end
+    local round = tostring(tonumber(state[3]) + 1)
+    redis.call(
+        'XADD', KEYS[4], '*', 'rating', ARGV[5], 'user_id', ARGV[1],
+        'stage', state[2], 'choice', ARGV[2], 'winner', ARGV[3], 'looser', looser,
+        'next', next_id, 'round', round, 'first', first, 'second', second,
+        'inserted', inserted
+    )
+    redis.call(
+        'HSET', KEYS[1], 'round', round, 'choice', next_id,
+        'first', first, 'second', second
+    )
+    redis.call('SADD', KEYS[5], ARGV[5])
+    redis.call('DEL', KEYS[6])
+    for i = 1, 3 do
+        if redis.call('EXISTS', KEYS[i]) == 1 then
+            redis.call('EXPIRE', KEYS[i], ARGV[6])
+        end
+    end
+    return {next_id, first, second, state[2], round, state[7]}
+    """
+
+    # Removes flushed entries and clears the dirty flag if nothing was added
+    # in the meantime.
+    write_behind_ack_script = """
+    if #ARGV > 1 then
+        redis.call('XDEL', KEYS[1], unpack(ARGV, 2))
+    end
+    if redis.call('XLEN', KEYS[1]) == 0 then
+        redis.call('SREM', KEYS[2], ARGV[1])
+    end
+    """
+
     class CustomJSONEncoder(json.JSONEncoder):
         def default(self, obj):
             try:
@@ -65,61 +237,530 @@ class RatingService(BaseService, ModelRequests[Rating]):
                     return obj
             return obj
 
-    async def _get_available_items_ids(self, rating_id: UUID, use_cache=True) -> list[UUID]:
-        if use_cache:
-            cache_key = self.cache_key_items.format(rating_id=rating_id)
+    def _items_cache_key(self, rating_id: UUID) -> str:
+        return self.cache_key_items.format(rating_id=rating_id)
+
+    def _pool_keys(self, rating_id: UUID) -> list[str]:
+        return [
+            self._items_cache_key(rating_id),
+            self.cache_key_owner.format(rating_id=rating_id),
+            self.cache_snapshot_version.format(rating_id=rating_id),
+        ]
+
+    @staticmethod
+    def _stage_order(rating: Rating, scores: dict[UUID, float]) -> list[UUID]:
+        """
+        Order the items of the current stage the way they are paired.
+
+        The order only depends on the seed of the rating, the stage, the number
+        of refreshes in it and the items with their scores, so it can be
+        reproduced.
+        """
+        rng = random.Random(f"{rating.seed}:{rating.stage}:{rating.refreshes}")
+        return get_strategy(rating.pairing).order(list(scores), scores, rng)
 
-            cached_result = await self.redis.get(cache_key)
+    async def _load_available_items_ids(self, rating: Rating) -> list[UUID]:
+        """
+        Get the available items of the current stage in the order they are
+        paired.
+        """
+        stmt = select(
+            RatingItem.item_id, RatingItem.status, RatingItem.score
+        ).filter(
+            RatingItem.rating_id == rating.id,
+            RatingItem.stage == rating.stage,
+        )
+        rows = (await self.session.execute(stmt)).all()
+        scores = {row.item_id: row.score for row in rows}
+        available = {
+            row.item_id for row in rows if row.status == RatingItemStatus.AVAILABLE
+        }
+        return [i for i in self._stage_order(rating, scores) if i in available]
+
+    async def _set_items_status(
+        self, rating: Rating, ids: list[UUID], status: RatingItemStatus
+    ):
+        if not ids:
+            return
+        stmt = (
+            update(RatingItem)
+            .filter(RatingItem.rating_id == rating.id, RatingItem.item_id.in_(ids))
+            .values(status=status)
+            .execution_options(synchronize_session=False)
+        )
+        await self.session.execute(stmt)
 
+    async def _get_available_items_ids(
+        self, rating: Rating, use_cache=True
+    ) -> list[UUID]:
+        cache_key = self._items_cache_key(rating.id)
+        if use_cache:
+            cached_result = await self.redis.zrange(cache_key, 0, -1)
             if cached_result:
-                return json.loads(cached_result, cls=self.CustomJSONDecoder)
+                return [UUID(i.decode()) for i in cached_result]
 
-        subquery = (
-            select(RatingChoice.winner_id)
-            .join(Rating, Rating.id == RatingChoice.rating_id)
+        ids = await self._load_available_items_ids(rating)
+        await self._cache_ids(rating, ids)
+        return ids
+
+    async def _cache_ids(self, rating: Rating, ids: list[UUID]):
+        cache_key, owner_key, _ = self._pool_keys(rating.id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(owner_key, str(rating.user_id), ex=self.cache_expire)
+            pipe.delete(cache_key)
+            for i in range(0, len(ids), 1000):
+                pipe.zadd(
+                    cache_key,
+                    {str(id): i + j for j, id in enumerate(ids[i : i + 1000])},
+                )
+            pipe.expire(cache_key, self.cache_expire)
+            await pipe.execute()
+
+    async def _draw_pair(self, rating: Rating) -> list[UUID]:
+        """
+        Atomically take the next pair of items from the rating's stage pool.
+
+        Postgres is only queried when the pool is missing from Redis.
+        """
+        pair = await self._try_draw_pair(rating.id, rating)
+        if pair is not None:
+            return pair
+
+        ids = await self._load_available_items_ids(rating)
+        if not ids:
+            return []
+        script = self.redis.register_script(self.draw_pair_script)
+        drawn = await script(
+            keys=self._pool_keys(rating.id),
+            args=[
+                self.cache_expire,
+                str(rating.user_id),
+                "1",
+                0,
+                *(str(id) for id in ids),
+            ],
+        )
+        return [UUID(i.decode()) for i in drawn or []]
+
+    async def _try_draw_pair(
+        self,
+        rating_id: UUID,
+        rating: Rating | None = None,
+        mark_snapshot: bool = False,
+    ) -> list[UUID] | None:
+        """
+        Draw a pair from the pool without falling back to Postgres.
+
+        Args:
+            rating_id: The id of the rating.
+            rating: The rating, if it has been read; otherwise a pair is only
+                drawn if the pool is known to belong to the user.
+            mark_snapshot: Whether to mark the snapshot version pending, for
+                a change committed without deleting it afterwards.
+
+        Returns:
+            list[UUID] | None: The drawn pair or None if the pool is missing.
+        """
+        user_id = rating.user_id if rating else self.token.sub
+        script = self.redis.register_script(self.draw_pair_script)
+        drawn = await script(
+            keys=self._pool_keys(rating_id),
+            args=[
+                self.cache_expire,
+                str(user_id),
+                "1" if rating else "0",
+                self.snapshot_pending_expire if mark_snapshot else 0,
+            ],
+        )
+        if drawn is None:
+            return None
+        return [UUID(i.decode()) for i in drawn]
+
+    async def _return_pair(self, rating_id: UUID, pair: list[UUID]):
+        cache_key = self._items_cache_key(rating_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            # Put the pair back in front of the pool.
+            pipe.zadd(
+                cache_key, {str(id): i - len(pair) for i, id in enumerate(pair)}
+            )
+            pipe.expire(cache_key, self.cache_expire)
+            await pipe.execute()
+
+    def _new_rating_choice(self, rating: Rating, pair: list[UUID]):
+        if not pair:
+            return None
+        return RatingChoice(
+            rating_id=rating.id,
+            winner_id=pair[0],
+            looser_id=pair[1] if len(pair) > 1 else None,
+            stage=rating.stage,
+            round=rating.round + 1,
+        )
+
+    async def _add_rating_choice(self, rating: Rating, choice: RatingChoice):
+        self.session.add(choice)
+        await self._set_items_status(
+            rating,
+            [i for i in (choice.winner_id, choice.looser_id) if i],
+            RatingItemStatus.PAIRED,
+        )
+
+    async def _record_result(self, rating: Rating, choice: RatingChoice):
+        if not choice.looser_id:
+            return
+        stmt = (
+            update(RatingItem)
             .filter(
-                RatingChoice.rating_id == rating_id,
-                RatingChoice.stage == Rating.stage,
+                RatingItem.rating_id == rating.id,
+                RatingItem.item_id.in_([choice.winner_id, choice.looser_id]),
             )
-            .union_all(
-                select(RatingChoice.looser_id)
-                .distinct()
-                .filter(
-                    RatingChoice.rating_id == rating_id,
-                    RatingChoice.looser_id.isnot(None),
+            .values(
+                status=case(
+                    (
+                        RatingItem.item_id == choice.winner_id,
+                        literal(RatingItemStatus.PAIRED, Integer),
+                    ),
+                    else_=literal(RatingItemStatus.ELIMINATED, Integer),
                 )
             )
-            .subquery()
+            .execution_options(synchronize_session=False)
+        )
+        await self.session.execute(stmt)
+
+    async def _next_pending_choice(self, rating: Rating) -> RatingChoice | None:
+        stmt = select(RatingChoice).filter(
+            RatingChoice.rating_id == rating.id,
+            RatingChoice.stage == rating.stage,
+            RatingChoice.round == rating.round + 1,
         )
+        return await self.session.scalar(stmt)
+
+    async def _pregenerate_choices(self, rating: Rating) -> list[UUID]:
+        """
+        Split the available items of the current stage into pairs and insert a
+        choice for every pair in a single statement.
+
+        Returns:
+            list[UUID]: The ids of the inserted choices.
+        """
+        ids = await self._load_available_items_ids(rating)
+        user_id = self._token.sub if self._token else None
+        rows = [
+            dict(
+                id=uuid4(),
+                rating_id=rating.id,
+                winner_id=ids[i],
+                looser_id=self._get_nth_element(ids, i + 1),
+                stage=rating.stage,
+                round=rating.round + i // 2 + 1,
+                created_by=user_id,
+                updated_by=user_id,
+            )
+            for i in range(0, len(ids), 2)
+        ]
+        if not rows:
+            return []
+        await self.session.execute(insert(RatingChoice), rows)
+
         stmt = (
-            select(CompetitionItem.id)
-            .join(Rating, Rating.competition_id == CompetitionItem.competition_id)
+            update(RatingItem)
             .filter(
-                Rating.id == rating_id,
-                CompetitionItem.competition_id == Rating.competition_id,
-                CompetitionItem.id.not_in(select(subquery)),
+                RatingItem.rating_id == rating.id,
+                RatingItem.stage == rating.stage,
+                RatingItem.status == RatingItemStatus.AVAILABLE,
             )
+            .values(status=RatingItemStatus.PAIRED)
+            .execution_options(synchronize_session=False)
         )
-        ids: list[UUID] = (await self.session.scalars(stmt)).all()
-        return ids
+        await self.session.execute(stmt)
+        return [row["id"] for row in rows]
 
-    async def _cache_ids(self, ids: list[UUID], cache_key: str):
-        await self.redis.setex(
-            cache_key,
-            self.cache_expire,
-            json.dumps(ids, cls=RatingService.CustomJSONEncoder),
-        )
+    async def _next_choice(self, rating: Rating) -> RatingChoice | None:
+        """
+        Reveal the next choice of the current stage: a pregenerated one if there
+        is any, otherwise a new pair drawn from the stage pool.
+        """
+        pregenerated = settings.RATING_PREGENERATE_STAGES
+        if pregenerated:
+            choice = await self._next_pending_choice(rating)
+            if choice:
+                return choice
+
+        choice = self._new_rating_choice(rating, await self._draw_pair(rating))
+        if choice:
+            await self._add_rating_choice(rating, choice)
+            return choice
+
+        if not pregenerated:
+            return await self._next_pending_choice(rating)
+        return None
+
+    async def _start_stage(self, rating: Rating) -> RatingChoice | None:
+        if not settings.RATING_PREGENERATE_STAGES:
+            return await self._next_choice(rating)
+
+        choices_ids = await self._pregenerate_choices(rating)
+        if not choices_ids:
+            return None
+        return await self.session.get(RatingChoice, choices_ids[0])
 
-    def _new_rating_choice(self, rating: Rating, ids: list[UUID]):
+    async def _start_ranking(self, rating: Rating) -> RatingChoice | None:
+        """
+        Fix the order the items of a full ranking are inserted in and start
+        inserting the second one; the first one is ranked without a choice.
+        """
+        stmt = select(RatingItem.item_id).filter(RatingItem.rating_id == rating.id)
+        ids = (await self.session.scalars(stmt)).all()
+        ids = self._stage_order(rating, dict.fromkeys(ids, 0.0))
         if not ids:
             return None
-        winner_id = ids.pop(random.randint(0, len(ids) - 1))
-        looser_id = ids.pop(random.randint(0, len(ids) - 1)) if ids else None
-        return RatingChoice(
+
+        # The order is kept in the scores, so the next item is one query away.
+        items = values(
+            column("item_id", UUIDType), column("score", Float), name="items"
+        ).data([(id, float(i)) for i, id in enumerate(ids)])
+        stmt = (
+            update(RatingItem)
+            .filter(
+                RatingItem.rating_id == rating.id,
+                RatingItem.item_id == items.c.item_id,
+            )
+            .values(score=items.c.score, updated_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+        await self.session.execute(stmt)
+        await self._set_items_status(rating, ids[:1], RatingItemStatus.PAIRED)
+        rating.ranking = ids[:1]
+        return await self._next_insertion(rating)
+
+    async def _next_insertion(self, rating: Rating) -> RatingChoice | None:
+        """
+        Start inserting the next item into the ranking with the first choice
+        of the current stage, or return None when every item is ranked.
+        """
+        stmt = (
+            select(RatingItem.item_id)
+            .filter(
+                RatingItem.rating_id == rating.id,
+                RatingItem.status == RatingItemStatus.AVAILABLE,
+            )
+            .order_by(RatingItem.score)
+            .limit(1)
+        )
+        item_id = await self.session.scalar(stmt)
+        if not item_id:
+            return None
+
+        low, high = get_strategy(rating.pairing).search(len(rating.ranking), [])
+        choice = RatingChoice(
             rating_id=rating.id,
-            winner_id=winner_id,
-            looser_id=looser_id,
+            winner_id=item_id,
+            looser_id=rating.ranking[(low + high) // 2],
             stage=rating.stage,
+            round=1,
+        )
+        await self._add_rating_choice(rating, choice)
+        return choice
+
+    async def _apply_ranking_choice(
+        self, rating: Rating, choice: RatingChoice
+    ) -> tuple[int, int] | None:
+        """
+        Go on with the binary search of the item inserted in the current stage
+        of a full ranking; the search is replayed from the choices of the
+        stage, at most log2(n) of them.
+        """
+        if choice.round != rating.round:
+            # The later choices of the stage followed from the changed one.
+            stmt = delete(RatingChoice).filter(
+                RatingChoice.rating_id == rating.id,
+                RatingChoice.stage == rating.stage,
+                RatingChoice.round > choice.round,
+            )
+            await self.session.execute(stmt)
+            rating.round = choice.round
+
+        stmt = (
+            select(RatingChoice.winner_id, RatingChoice.looser_id)
+            .filter(
+                RatingChoice.rating_id == rating.id,
+                RatingChoice.stage == rating.stage,
+            )
+            .order_by(RatingChoice.round)
+        )
+        games = (await self.session.execute(stmt)).tuples().all()
+        ranking = rating.ranking
+        item_id = next(id for id in games[0] if id not in ranking)
+        low, high = get_strategy(rating.pairing).search(
+            len(ranking), [winner_id == item_id for winner_id, _ in games]
+        )
+        if low < high:
+            next_choice = RatingChoice(
+                rating_id=rating.id,
+                winner_id=item_id,
+                looser_id=ranking[(low + high) // 2],
+                stage=rating.stage,
+                round=rating.round + 1,
+            )
+            self.session.add(next_choice)
+            rating.round = next_choice.round
+            return rating.stage, rating.round
+
+        rating.ranking = ranking[:low] + [item_id] + ranking[low:]
+        await self.competition_item_standing_service.record_stage(
+            rating.id, rating.competition_id, rating.stage
+        )
+        rating.stage += 1
+        next_choice = await self._next_insertion(rating)
+        if not next_choice:
+            rating.ended = True
+            await self._save_result(rating)
+            return None
+        rating.round = next_choice.round
+        return rating.stage, rating.round
+
+    async def _advance_stage(self, rating: Rating) -> int:
+        """
+        Move the survivors of the current stage to the next one and add its
+        results to the competition standings.
+
+        Returns:
+            int: The number of items left in the rating.
+        """
+        await self.competition_item_standing_service.record_stage(
+            rating.id, rating.competition_id, rating.stage
+        )
+        strategy = get_strategy(rating.pairing)
+        if strategy.scored:
+            left = await self._advance_scored_stage(rating, strategy)
+        else:
+            stmt = (
+                update(RatingItem)
+                .filter(
+                    RatingItem.rating_id == rating.id,
+                    RatingItem.stage == rating.stage,
+                    RatingItem.status == RatingItemStatus.PAIRED,
+                )
+                .values(stage=rating.stage + 1, status=RatingItemStatus.AVAILABLE)
+                .execution_options(synchronize_session=False)
+            )
+            left = (await self.session.execute(stmt)).rowcount
+        rating.stage += 1
+        rating.round = 0
+        rating.refreshes = 0
+        return left
+
+    async def _advance_scored_stage(
+        self, rating: Rating, strategy: PairingStrategy
+    ) -> int:
+        """
+        Let the strategy pick the items of the next stage from the scores and
+        the games of the current one.
+        """
+        stmt = (
+            select(RatingItem.item_id, RatingItem.score)
+            .filter(
+                RatingItem.rating_id == rating.id, RatingItem.stage == rating.stage
+            )
+            .order_by(RatingItem.item_id)
+        )
+        scores = dict((await self.session.execute(stmt)).tuples().all())
+        stmt = (
+            select(RatingChoice.winner_id, RatingChoice.looser_id)
+            .filter(
+                RatingChoice.rating_id == rating.id,
+                RatingChoice.stage == rating.stage,
+            )
+            .order_by(RatingChoice.round)
+        )
+        games = (await self.session.execute(stmt)).tuples().all()
+
+        survivors, scores = strategy.advance(rating.stage, scores, games)
+        survivors = set(survivors)
+        items = values(
+            column("item_id", UUIDType),
+            column("score", Float),
+            column("stage", Integer),
+            column("status", Integer),
+            name="items",
+        ).data(
+            [
+                (id, score, rating.stage + 1, int(RatingItemStatus.AVAILABLE))
+                if id in survivors
+                else (id, score, rating.stage, int(RatingItemStatus.ELIMINATED))
+                for id, score in scores.items()
+            ]
+        )
+        stmt = (
+            update(RatingItem)
+            .filter(
+                RatingItem.rating_id == rating.id,
+                RatingItem.item_id == items.c.item_id,
+            )
+            .values(
+                score=items.c.score,
+                stage=items.c.stage,
+                status=items.c.status,
+                updated_at=func.now(),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await self.session.execute(stmt)
+        return len(survivors)
+
+    async def _save_result(self, rating: Rating):
+        """
+        Store the final placement of a rating that has just ended, so it is
+        never rebuilt from the choices. Items are ranked by the stage they got
+        to, then by score, and items of equal scores by the sum of the scores
+        of their opponents (Buchholz); a full ranking places every item on its
+        own.
+        """
+        if rating.ranking is not None:
+            self.session.add(
+                RatingResult(
+                    rating_id=rating.id,
+                    items=rating.ranking,
+                    tier_sizes=[1] * len(rating.ranking),
+                )
+            )
+            return
+
+        stmt = (
+            select(RatingItem.stage, RatingItem.score, RatingItem.item_id)
+            .filter(RatingItem.rating_id == rating.id)
+            .order_by(
+                RatingItem.stage.desc(), RatingItem.score.desc(), RatingItem.item_id
+            )
+        )
+        rows = (await self.session.execute(stmt)).all()
+        buchholz = dict.fromkeys((row.item_id for row in rows), 0.0)
+        if get_strategy(rating.pairing).scored:
+            scores = {row.item_id: row.score for row in rows}
+            stmt = select(RatingChoice.winner_id, RatingChoice.looser_id).filter(
+                RatingChoice.rating_id == rating.id,
+                RatingChoice.looser_id.is_not(None),
+            )
+            for winner_id, looser_id in await self.session.execute(stmt):
+                buchholz[winner_id] += scores[looser_id]
+                buchholz[looser_id] += scores[winner_id]
+        rows.sort(
+            key=lambda row: (
+                -row.stage,
+                -row.score,
+                -buchholz[row.item_id],
+                row.item_id,
+            )
+        )
+        tiers = groupby(
+            rows, lambda row: (row.stage, row.score, buchholz[row.item_id])
+        )
+        self.session.add(
+            RatingResult(
+                rating_id=rating.id,
+                items=[row.item_id for row in rows],
+                tier_sizes=[len(list(tier)) for _, tier in tiers],
+            )
         )
 
     @staticmethod
@@ -131,79 +772,286 @@ class RatingService(BaseService, ModelRequests[Rating]):
         except IndexError:
             return None
 
-    async def get_last_choice(self, id: UUID):
+    @staticmethod
+    def _is_revealed(rating: Rating, stage: int, round: int) -> bool:
+        return stage < rating.stage or round <= rating.round
+
+    async def _embed_items(
+        self, competition_id: UUID, choice: RatingChoiceResponseSchema | None
+    ):
+        if choice is not None:
+            choice.items_data = await self.competition_item_service.get_cached_items(
+                competition_id, choice.items
+            )
+        return choice
+
+    async def _get_choice_response(
+        self,
+        rating: Rating,
+        choice_id: UUID | None = None,
+        stage: int | None = None,
+        round: int | None = None,
+    ) -> RatingChoiceResponseSchema:
         """
-        Get the last choice of the rating with the given id.
+        Load a choice of the rating together with its revealed neighbours in a
+        single query. The choice is selected either by id or by stage and round.
 
         Args:
-            id (UUID): The id of the rating.
+            rating (Rating): The rating the choice belongs to.
+            choice_id (UUID | None): The id of the choice.
+            stage (int | None): The stage of the choice.
+            round (int | None): The round of the choice within the stage.
 
         Returns:
-            RatingChoiceResponseSchema: The last rating choice.
+            RatingChoiceResponseSchema: The rating choice.
         """
-
-        rating = await self.get(id=id)
-        rating_choice = await self.rating_choice_service.get(id=rating.choices[-1])
+        rows = None
+        if rating.ended:
+            rows = await self._get_archived_choice_rows(
+                rating.id, choice_id, stage, round
+            )
+        if rows is None:
+            target = aliased(RatingChoice, name="target")
+            if choice_id is not None:
+                criteria = (target.id == choice_id,)
+            else:
+                criteria = (target.stage == stage, target.round == round)
+            stmt = (
+                select(RatingChoice, (RatingChoice.id == target.id).label("is_target"))
+                .join(
+                    target,
+                    and_(
+                        target.rating_id == RatingChoice.rating_id,
+                        target.stage == RatingChoice.stage,
+                        RatingChoice.round.between(target.round - 1, target.round + 1),
+                    ),
+                )
+                .filter(target.rating_id == rating.id, *criteria)
+            )
+            rows = (await self.session.execute(stmt)).all()
+
+        rating_choice = next((choice for choice, is_target in rows if is_target), None)
+        if not rating_choice or not self._is_revealed(
+            rating, rating_choice.stage, rating_choice.round
+        ):
+            raise HTTPException(status_code=404, detail="RatingChoice not found")
+        neighbours = {
+            choice.round: choice.id
+            for choice, is_target in rows
+            if not is_target and self._is_revealed(rating, choice.stage, choice.round)
+        }
 
         items = [rating_choice.winner_id]
         if rating_choice.looser_id:
             items.append(rating_choice.looser_id)
             items.sort(key=lambda x: str(x))
+
+        is_current = (
+            rating_choice.stage == rating.stage and rating_choice.round == rating.round
+        )
         return RatingChoiceResponseSchema(
             id=rating_choice.id,
             items=items,
             stage=rating_choice.stage,
-            prev=self._get_nth_element(
-                rating.choices, rating.choices.index(rating_choice.id) - 1
-            ),
-            round=len(rating.choices),
+            round=rating_choice.round,
+            prev=neighbours.get(rating_choice.round - 1),
+            next=neighbours.get(rating_choice.round + 1),
+            winner_id=rating_choice.winner_id if not is_current else None,
+        )
+
+    async def _get_archived_stages(
+        self, rating_id: UUID
+    ) -> list[list[tuple[UUID, UUID, UUID | None]]] | None:
+        """
+        Get the choices of an archived rating.
+
+        Returns:
+            (id, winner, looser) of the choices of every stage in round order,
+            or None if the rating is not archived.
+        """
+        stmt = select(RatingArchive.choices, RatingArchive.stage_sizes).filter(
+            RatingArchive.rating_id == rating_id
+        )
+        row = (await self.session.execute(stmt)).one_or_none()
+        if not row:
+            return None
+        return unpack_choices(row.choices, row.stage_sizes)
+
+    async def _get_archived_choice_rows(
+        self,
+        rating_id: UUID,
+        choice_id: UUID | None,
+        stage: int | None,
+        round: int | None,
+    ) -> list[tuple[RatingChoice, bool]] | None:
+        """
+        Find a choice of an archived rating with its neighbours, shaped like
+        the rows `_get_choice_response` reads from the database. The choices
+        are transient and never added to the session.
+
+        Returns:
+            The rows or None if the rating is not archived.
+        """
+        stages = await self._get_archived_stages(rating_id)
+        if stages is None:
+            return None
+        if choice_id is not None:
+            stage, round = next(
+                (
+                    (stage, round)
+                    for stage, choices in enumerate(stages, 1)
+                    for round, choice in enumerate(choices, 1)
+                    if choice[0] == choice_id
+                ),
+                (None, None),
+            )
+        if not (
+            stage
+            and 1 <= stage <= len(stages)
+            and 1 <= round <= len(stages[stage - 1])
+        ):
+            return []
+        return [
+            (
+                RatingChoice(
+                    id=id,
+                    rating_id=rating_id,
+                    winner_id=winner_id,
+                    looser_id=looser_id,
+                    stage=stage,
+                    round=i,
+                ),
+                i == round,
+            )
+            for i, (id, winner_id, looser_id) in enumerate(stages[stage - 1], 1)
+            if abs(i - round) <= 1
+        ]
+
+    async def _get_final_position(self, rating: Rating) -> tuple[int, int]:
+        """
+        Get the stage and round of the final choice of an ended rating, which
+        has already moved past it.
+        """
+        stages = await self._get_archived_stages(rating.id)
+        if stages is not None:
+            return len(stages), len(stages[-1]) if stages else 0
+        stmt = (
+            select(RatingChoice.stage, RatingChoice.round)
+            .filter(RatingChoice.rating_id == rating.id)
+            .order_by(RatingChoice.stage.desc(), RatingChoice.round.desc())
+            .limit(1)
         )
+        row = (await self.session.execute(stmt)).one_or_none()
+        return tuple(row) if row else (0, 0)
+
+    async def get_last_choice(self, id: UUID, embed_items: bool = False):
+        """
+        Get the last choice of the rating with the given id.
+
+        Args:
+            id (UUID): The id of the rating.
+            embed_items (bool): Whether to include the items of the choice.
 
-    async def get_choice(self, rating_id: UUID, choice_id: UUID):
+        Returns:
+            RatingChoiceResponseSchema: The last rating choice.
+        """
+        await self.flush_write_behind(id)
+        rating = await self.get(id=id)
+        stage, round = rating.stage, rating.round
+        if rating.ended:
+            stage, round = await self._get_final_position(rating)
+        choice = await self._get_choice_response(rating, stage=stage, round=round)
+        if embed_items:
+            await self._embed_items(rating.competition_id, choice)
+        return choice
+
+    async def get_choice(
+        self, rating_id: UUID, choice_id: UUID, embed_items: bool = False
+    ):
         """
         Get a rating choice by id.
 
         Args:
             rating_id (UUID): The id of the rating.
             choice_id (UUID): The id of the choice to retrieve.
+            embed_items (bool): Whether to include the items of the choice.
 
         Returns:
             RatingChoiceResponseSchema: The rating choice.
         """
-
+        await self.flush_write_behind(rating_id)
         rating = await self.get(id=rating_id)
-        rating_choice = await self.rating_choice_service.get(id=choice_id)
+        choice = await self._get_choice_response(rating, choice_id=choice_id)
+        if embed_items:
+            await self._embed_items(rating.competition_id, choice)
+        return choice
 
-        items = [rating_choice.winner_id]
-        if rating_choice.looser_id:
-            items.append(rating_choice.looser_id)
-            items.sort(key=lambda x: str(x))
+    async def _get_for_update(self, id: UUID) -> Rating:
+        """
+        Get a rating of the user and lock it until the end of the transaction.
 
-        return RatingChoiceResponseSchema(
-            id=rating_choice.id,
-            items=items,
-            stage=rating_choice.stage,
-            next=self._get_nth_element(
-                rating.choices, rating.choices.index(rating_choice.id) + 1
-            ),
-            prev=self._get_nth_element(
-                rating.choices, rating.choices.index(rating_choice.id) - 1
-            ),
-            round=rating.choices.index(choice_id) + 1,
-            winner_id=rating_choice.winner_id
-            if rating_choice.id != rating.choices[-1]
-            else None,
+        A rating locked by a concurrent request is not waited for: the request
+        fails with a 409, which the client may retry.
+        """
+        stmt = (
+            select(Rating)
+            .filter(Rating.id == id, Rating.user_id == self.token.sub)
+            .with_for_update(nowait=True)
+            .execution_options(populate_existing=True)
         )
+        rating = await self.session.scalar(stmt)
+        if not rating:
+            raise HTTPException(status_code=404, detail="Rating not found")
+        return rating
+
+    async def _discard_ratings(self, *ids: UUID):
+        """
+        Delete unfinished ratings. Their keys in Redis are to be deleted with
+        `_delete_rating_keys` after the commit.
+        """
+        await self.flush_write_behind(*ids, drop_state=True)
+        stmt = delete(Rating).filter(Rating.id.in_(ids))
+        await self.session.execute(stmt)
 
-    async def start(self, competition_id: UUID):
+    async def _delete_rating_keys(self, *ids: UUID):
+        if not ids:
+            return
+        keys = []
+        for id in ids:
+            # The dirty set is shared by all ratings.
+            keys += self._write_behind_keys(id)[:4]
+            keys += [
+                self.cache_key_owner.format(rating_id=id),
+                self.cache_snapshot_version.format(rating_id=id),
+                self.cache_grid.format(rating_id=id),
+            ]
+        await self.redis.delete(*keys)
+
+    async def start(
+        self,
+        competition_id: UUID,
+        seed: int | None = None,
+        resume: bool = True,
+        pairing: Pairing | None = None,
+    ):
         """
         Start a new rating for a competition.
 
+        A user has at most one unfinished rating per competition: it is either
+        resumed or replaced by a new one.
+
         Args:
             competition_id (UUID): The id of the competition.
+            seed (int | None): The seed the pairings of a new rating are
+                derived from, random when not given.
+            resume (bool): Whether to return the unfinished rating instead of
+                discarding it.
+            pairing (Pairing | None): The pairing of a new rating, the one of
+                the competition when not given; `full_ranking` ranks all the
+                items instead of finding a winner.
 
         Returns:
-            str: The id of the new rating.
+            str: The id of the rating.
         """
         stmt = select(Competition).filter(
             Competition.id == competition_id,
@@ -214,31 +1062,73 @@ class RatingService(BaseService, ModelRequests[Rating]):
         if not competition:
             raise HTTPException(status_code=404, detail="Competition not found")
 
-        rating = Rating(
+        unfinished = select(Rating.id).filter(
+            Rating.user_id == self.token.sub,
+            Rating.competition_id == competition_id,
+            Rating.ended == False,  # noqa: E712
+        )
+        discarded = []
+        unfinished_id = await self.session.scalar(unfinished)
+        if unfinished_id:
+            if resume:
+                return str(unfinished_id)
+            await self._discard_ratings(unfinished_id)
+            discarded.append(unfinished_id)
+
+        rating_values = dict(
             competition_id=competition_id,
             user_id=self.token.sub,
+            pairing=pairing or competition.pairing,
         )
-        self.session.add(rating)
-
-        await self.session.flush()
-        await self.session.refresh(rating)
-
-        ids = await self._get_available_items_ids(rating.id, use_cache=False)
-        new_choice = self._new_rating_choice(rating, ids)
-        self.session.add(new_choice)
-
-        await self.session.flush()
-        await self.session.refresh(rating)
-        await self.session.refresh(new_choice)
+        if seed is not None:
+            rating_values["seed"] = seed
+        stmt = (
+            pg_insert(Rating)
+            .values(**rating_values)
+            .on_conflict_do_nothing(
+                index_elements=[Rating.user_id, Rating.competition_id],
+                index_where=Rating.ended == False,  # noqa: E712
+            )
+            .returning(Rating)
+        )
+        rating = await self.session.scalar(stmt)
+        if not rating:
+            # Started by a concurrent request.
+            rating_id = await self.session.scalar(unfinished)
+            await self.session.commit()
+            await self._delete_rating_keys(*discarded)
+            return str(rating_id)
+
+        stmt = insert(RatingItem).from_select(
+            ["rating_id", "item_id", "stage", "status"],
+            select(
+                literal(rating.id, UUIDType),
+                CompetitionItem.id,
+                literal(rating.stage),
+                literal(int(RatingItemStatus.AVAILABLE)),
+            ).filter(CompetitionItem.competition_id == competition_id),
+        )
+        rating.items_count = (await self.session.execute(stmt)).rowcount
 
-        rating.choices.append(new_choice.id)
+        if get_strategy(rating.pairing).sequential:
+            new_choice = await self._start_ranking(rating)
+        else:
+            new_choice = await self._start_stage(rating)
+        if new_choice:
+            rating.round = new_choice.round
+        elif rating.ranking:
+            # A single item is ranked without choices.
+            rating.ended = True
+            await self._save_result(rating)
+        else:
+            raise HTTPException(status_code=400, detail="Competition has no items")
         rating_id = str(rating.id)
 
         await self.session.commit()
-        await self._cache_ids(ids, self.cache_key_items.format(rating_id=rating.id))
+        await self._delete_rating_keys(*discarded)
         return rating_id
 
-    async def refresh(self, id: UUID, choice_id: UUID):
+    async def refresh(self, id: UUID, choice_id: UUID, embed_items: bool = False):
         """
         Refresh a rating by removing all the choices from the current choice onward
         and generating a new one.
@@ -246,234 +1136,1299 @@ class RatingService(BaseService, ModelRequests[Rating]):
         Args:
             id (UUID): The id of the rating.
             choice_id (UUID): The id of the choice to refresh from.
+            embed_items (bool): Whether to include the items of the choice.
 
         Returns:
             StartRatingResponseSchema: The rating with the new choice.
         """
-        rating = await self.get(id=id, user_id=self.token.sub)
+        await self.flush_write_behind(id, drop_state=True)
+        rating = await self._get_for_update(id)
 
         if rating.is_refreshed:
             raise HTTPException(status_code=403, detail="Rating is refreshed")
+        if get_strategy(rating.pairing).sequential:
+            # The items of a full ranking are all compared anyway.
+            raise HTTPException(400, "Invalid request")
 
         rating_choice = await self.rating_choice_service.get(id=choice_id, rating_id=id)
+        if rating_choice.stage != rating.stage or rating_choice.round > rating.round:
+            raise HTTPException(400, "Invalid request")
 
-        idx = rating.choices.index(rating_choice.id)
-        if (len(rating.choices) > 1) and (len(rating.choices) > idx + 1):
-            stmt = delete(RatingChoice).filter(
+        released = [rating_choice.winner_id, rating_choice.looser_id]
+        stmt = (
+            delete(RatingChoice)
+            .filter(
                 RatingChoice.rating_id == rating.id,
-                RatingChoice.id.in_(rating.choices[idx + 1 :]),
+                RatingChoice.stage == rating.stage,
+                RatingChoice.round > rating_choice.round,
             )
-            await self.session.execute(stmt)
-            rating.choices = rating.choices[: idx + 1]
-
-            await self.session.flush()
-            await self.session.refresh(rating)
-
-        ids = await self._get_available_items_ids(rating.id, use_cache=False)
-        ids.append(rating_choice.winner_id)
-        if rating_choice.looser_id:
-            ids.append(rating_choice.looser_id)
-        rating_choice.winner_id = ids.pop(random.randint(0, len(ids) - 1))
-        rating_choice.looser_id = (
-            ids.pop(random.randint(0, len(ids) - 1)) if ids else None
+            .returning(RatingChoice.winner_id, RatingChoice.looser_id)
         )
+        for winner_id, looser_id in (await self.session.execute(stmt)).all():
+            released += [winner_id, looser_id]
+        rating.round = rating_choice.round
+        rating.refreshes += 1
 
-        items = [rating_choice.winner_id]
-        if rating_choice.looser_id:
-            items.append(rating_choice.looser_id)
-            items.sort(key=lambda x: str(x))
+        await self._set_items_status(
+            rating, [i for i in released if i], RatingItemStatus.AVAILABLE
+        )
+        ids = await self._load_available_items_ids(rating)
+        rating_choice.winner_id = ids.pop(0)
+        rating_choice.looser_id = ids.pop(0) if ids else None
+        await self._set_items_status(
+            rating,
+            [i for i in (rating_choice.winner_id, rating_choice.looser_id) if i],
+            RatingItemStatus.PAIRED,
+        )
+        if settings.RATING_PREGENERATE_STAGES:
+            await self._pregenerate_choices(rating)
+            ids = []
 
-        cur_choice = RatingChoiceResponseSchema(
-            id=rating_choice.id,
-            items=items,
-            stage=rating_choice.stage,
-            prev=self._get_nth_element(
-                rating.choices, rating.choices.index(rating_choice.id) - 1
-            ),
-            round=len(rating.choices),
+        cur_choice = await self._get_choice_response(
+            rating, choice_id=rating_choice.id
         )
-        cache_key = self.cache_key_items.format(rating_id=rating.id)
         await self.session.commit()
 
-        await self._cache_ids(ids, cache_key)
+        await self._cache_ids(rating, ids)
+        await self._delete_snapshot_version(rating.id)
+        if embed_items:
+            await self._embed_items(rating.competition_id, cur_choice)
         return cur_choice
 
-    async def choose(self, id: UUID, choice_id: UUID, payload: ChoosePayloadSchema):
+    async def _choose_in_one_statement(
+        self, id: UUID, choice_id: UUID, winner_id: UUID, pair: list[UUID] | None
+    ):
         """
-        Choose a winner and looser for a rating choice.
+        Record the result of a revealed choice and move to the next one in a
+        single statement.
 
-        Args:
-            id: The id of the rating.
-            choice_id: The id of the rating choice.
-            payload: The payload with the winner and looser item ids.
+        The next choice is the following round of the same stage: an existing
+        one, or a new one built from `pair` when the frontier choice is played.
 
         Returns:
-            A ChooseResponseSchema with the next rating choice and ended boolean.
+            Row | None: The next choice with its neighbours, or None when the
+            statement could not handle the request (invalid choice, missing
+            pool or end of the stage).
         """
-        rating = await self.get(id=id, user_id=self.token.sub)
-
-        choice = await self.rating_choice_service.get(id=choice_id)
-
-        if payload.winner_id not in {choice.winner_id, choice.looser_id}:
-            raise HTTPException(400, "Invalid request")
-        if choice.winner_id != payload.winner_id:
-            choice.winner_id, choice.looser_id = choice.looser_id, choice.winner_id
-
-        if rating.choices[-1] == choice_id:
-            ids = await self._get_available_items_ids(rating.id)
-            next_coice = self._new_rating_choice(rating, ids)
-            if not next_coice:
-                rating.stage += 1
-                rating.is_refreshed = False
-                rating.choices = []
-                await self.session.flush()
-                await self.session.refresh(rating)
-
-                ids = await self._get_available_items_ids(rating.id, use_cache=False)
-                next_coice = self._new_rating_choice(rating, ids)
-                if not next_coice.looser_id:
-                    rating.ended = True
-                    await self.session.commit()
-                    await self.redis.delete(
-                        self.cache_key_items.format(rating_id=rating.id)
-                    )
-                    return ChooseResponseSchema(ended=True)
-
-            self.session.add(next_coice)
-            await self.session.flush()
-            await self.session.refresh(next_coice)
-            rating.choices.append(next_coice.id)
-        else:
-            next_coice = await self.session.get(
-                RatingChoice, rating.choices[rating.choices.index(choice_id) + 1]
+        user_id = self.token.sub
+        rating = (
+            select(Rating.id, Rating.competition_id, Rating.stage, Rating.round)
+            .filter(
+                Rating.id == id,
+                Rating.user_id == user_id,
+                Rating.ended == False,  # noqa: E712
+                Rating.pairing.notin_(sequential_pairings),
             )
-
-        await self.session.commit()
-        await self.session.refresh(rating)
-        await self.session.refresh(next_coice)
-
-        try:
-            await self._cache_ids(ids, self.cache_key_items.format(rating_id=rating.id))
-        except UnboundLocalError:
-            pass
-
-        items = [next_coice.winner_id]
-        if next_coice.looser_id:
-            items.append(next_coice.looser_id)
-            items.sort(key=lambda x: str(x))
-
-        next_choice_schema = RatingChoiceResponseSchema(
-            id=next_coice.id,
-            stage=next_coice.stage,
-            items=items,
-            round=rating.choices.index(next_coice.id) + 1,
-            next=self._get_nth_element(
-                rating.choices, rating.choices.index(next_coice.id) + 1
-            ),
-            prev=self._get_nth_element(
-                rating.choices, rating.choices.index(next_coice.id) - 1
-            ),
-            winner_id=next_coice.winner_id
-            if next_coice.id != rating.choices[-1]
-            else None,
+            .with_for_update(nowait=True)
+            .cte("current_rating")
+        )
+        chosen = (
+            update(RatingChoice)
+            .filter(
+                RatingChoice.id == choice_id,
+                RatingChoice.rating_id == rating.c.id,
+                RatingChoice.stage == rating.c.stage,
+                RatingChoice.round <= rating.c.round,
+                (RatingChoice.winner_id == winner_id)
+                | (RatingChoice.looser_id == winner_id),
+            )
+            .values(
+                winner_id=winner_id,
+                looser_id=case(
+                    (RatingChoice.winner_id == winner_id, RatingChoice.looser_id),
+                    else_=RatingChoice.winner_id,
+                ),
+                updated_by=user_id,
+                updated_at=func.now(),
+            )
+            .returning(
+                RatingChoice.id,
+                RatingChoice.rating_id,
+                RatingChoice.winner_id,
+                RatingChoice.looser_id,
+                RatingChoice.stage,
+                RatingChoice.round,
+                (RatingChoice.round == rating.c.round).label("is_frontier"),
+            )
+            .cte("chosen")
+        )
+        results = (
+            update(RatingItem)
+            .filter(
+                RatingItem.rating_id == chosen.c.rating_id,
+                RatingItem.item_id.in_([chosen.c.winner_id, chosen.c.looser_id]),
+                chosen.c.looser_id.isnot(None),
+            )
+            .values(
+                status=case(
+                    (
+                        RatingItem.item_id == chosen.c.winner_id,
+                        literal(RatingItemStatus.PAIRED, Integer),
+                    ),
+                    else_=literal(RatingItemStatus.ELIMINATED, Integer),
+                ),
+                updated_by=user_id,
+                updated_at=func.now(),
+            )
+            .cte("results")
         )
 
-        return ChooseResponseSchema(next_choice=next_choice_schema, ended=rating.ended)
+        existing = select(
+            RatingChoice.id,
+            RatingChoice.rating_id,
+            RatingChoice.winner_id,
+            RatingChoice.looser_id,
+            RatingChoice.stage,
+            RatingChoice.round,
+            literal(False).label("inserted"),
+        ).filter(
+            RatingChoice.rating_id == chosen.c.rating_id,
+            RatingChoice.stage == chosen.c.stage,
+            RatingChoice.round == chosen.c.round + 1,
+        )
+        ctes = [results]
+        if pair:
+            inserted = (
+                insert(RatingChoice)
+                .from_select(
+                    [
+                        "id",
+                        "rating_id",
+                        "winner_id",
+                        "looser_id",
+                        "stage",
+                        "round",
+                        "created_by",
+                        "updated_by",
+                    ],
+                    select(
+                        literal(uuid4(), UUIDType),
+                        chosen.c.rating_id,
+                        literal(pair[0], UUIDType),
+                        literal(self._get_nth_element(pair, 1), UUIDType),
+                        chosen.c.stage,
+                        chosen.c.round + 1,
+                        literal(user_id, UUIDType),
+                        literal(user_id, UUIDType),
+                    ).filter(chosen.c.is_frontier, ~existing.exists()),
+                )
+                .returning(
+                    RatingChoice.id,
+                    RatingChoice.rating_id,
+                    RatingChoice.winner_id,
+                    RatingChoice.looser_id,
+                    RatingChoice.stage,
+                    RatingChoice.round,
+                )
+                .cte("inserted")
+            )
+            paired = (
+                update(RatingItem)
+                .filter(
+                    RatingItem.rating_id == inserted.c.rating_id,
+                    RatingItem.item_id.in_(
+                        [inserted.c.winner_id, inserted.c.looser_id]
+                    ),
+                )
+                .values(
+                    status=RatingItemStatus.PAIRED,
+                    updated_by=user_id,
+                    updated_at=func.now(),
+                )
+                .cte("paired")
+            )
+            ctes.append(paired)
+            following = existing.union_all(
+                select(inserted, literal(True).label("inserted"))
+            ).cte("following")
+        else:
+            following = existing.cte("following")
 
-    async def get_rounds_total(self, id: UUID):
-        rating = await self.get(id=id, user_id=self.token.sub)
+        moved = (
+            update(Rating)
+            .filter(
+                Rating.id == chosen.c.rating_id,
+                Rating.id == following.c.rating_id,
+                chosen.c.is_frontier,
+            )
+            .values(
+                round=following.c.round, updated_by=user_id, updated_at=func.now()
+            )
+            .cte("moved")
+        )
+        # Revising an earlier choice keeps the rating from looking abandoned.
+        touched = (
+            update(Rating)
+            .filter(Rating.id == chosen.c.rating_id, ~chosen.c.is_frontier)
+            .values(updated_by=user_id, updated_at=func.now())
+            .cte("touched")
+        )
+        ctes.extend([moved, touched])
 
-        stmt = select(func.count(CompetitionItem.id)).filter(
-            CompetitionItem.competition_id == rating.competition_id
+        next_id = (
+            select(RatingChoice.id)
+            .filter(
+                RatingChoice.rating_id == following.c.rating_id,
+                RatingChoice.stage == following.c.stage,
+                RatingChoice.round == following.c.round + 1,
+                RatingChoice.round <= rating.c.round,
+            )
+            .scalar_subquery()
+        )
+        stmt = (
+            select(
+                following.c.id,
+                following.c.winner_id,
+                following.c.looser_id,
+                following.c.stage,
+                following.c.round,
+                following.c.inserted,
+                chosen.c.id.label("prev"),
+                next_id.label("next"),
+                rating.c.competition_id,
+                (chosen.c.is_frontier | (following.c.round == rating.c.round)).label(
+                    "is_current"
+                ),
+            )
+            .select_from(chosen)
+            .join(rating, true())
+            .outerjoin(following, true())
+            .add_cte(*ctes)
         )
-        items_total: int = await self.session.scalar(stmt)
-        return math.ceil(items_total / (2 ** (rating.stage)))
+        row = (await self.session.execute(stmt)).one_or_none()
+        if row is None or row.id is None:
+            return None
+        return row
+
+    def _write_behind_keys(self, rating_id: UUID) -> list[str]:
+        return [
+            self.write_behind_state.format(rating_id=rating_id),
+            self.write_behind_pending.format(rating_id=rating_id),
+            self._items_cache_key(rating_id),
+            self.write_behind_log.format(rating_id=rating_id),
+            self.write_behind_dirty,
+            self.cache_snapshot_version.format(rating_id=rating_id),
+        ]
+
+    async def _prime_write_behind(
+        self, id: UUID, competition_id: UUID, choice: RatingChoiceResponseSchema
+    ):
+        """
+        Keep the frontier of a rating in Redis so that the following choices
+        of the stage are recorded there.
 
-    async def get_stage_items(self, id: UUID):
-        subquery = (
-            select(RatingChoice.winner_id)
-            .join(Rating, Rating.id == RatingChoice.rating_id)
+        Args:
+            id: The id of the rating.
+            competition_id: The id of the rating competition.
+            choice: The current choice of the rating.
+        """
+        stmt = (
+            select(RatingChoice.id, RatingChoice.winner_id, RatingChoice.looser_id)
             .filter(
                 RatingChoice.rating_id == id,
-                RatingChoice.stage == Rating.stage,
+                RatingChoice.stage == choice.stage,
+                RatingChoice.round > choice.round,
             )
-            .union_all(
-                select(RatingChoice.looser_id)
-                .join(Rating, Rating.id == RatingChoice.rating_id)
-                .filter(
-                    RatingChoice.rating_id == id,
-                    RatingChoice.stage == Rating.stage,
-                    RatingChoice.looser_id.isnot(None),
+            .order_by(RatingChoice.round)
+        )
+        pending = (await self.session.execute(stmt)).all()
+
+        state_key, pending_key = self._write_behind_keys(id)[:2]
+        items = [str(i) for i in choice.items] + [""]
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(state_key, pending_key)
+            pipe.hset(
+                state_key,
+                mapping={
+                    "user_id": str(self.token.sub),
+                    "competition_id": str(competition_id),
+                    "stage": choice.stage,
+                    "round": choice.round,
+                    "choice": str(choice.id),
+                    "first": items[0],
+                    "second": items[1],
+                },
+            )
+            if pending:
+                pipe.rpush(
+                    pending_key,
+                    *(f"{i}|{winner}|{looser or ''}" for i, winner, looser in pending),
                 )
+            pipe.expire(state_key, self.cache_expire)
+            pipe.expire(pending_key, self.cache_expire)
+            await pipe.execute()
+
+    async def _choose_write_behind(
+        self,
+        id: UUID,
+        choice_id: UUID,
+        payload: ChoosePayloadSchema,
+        embed_items: bool = False,
+    ) -> ChooseResponseSchema | None:
+        """
+        Record the winner of the current choice in Redis only.
+
+        Returns:
+            A ChooseResponseSchema, or None if the request has to go through
+            the database.
+        """
+        script = self.redis.register_script(self.write_behind_choose_script)
+        result = await script(
+            keys=self._write_behind_keys(id),
+            args=[
+                str(self.token.sub),
+                str(choice_id),
+                str(payload.winner_id),
+                str(uuid4()),
+                str(id),
+                self.cache_expire,
+            ],
+        )
+        if not result:
+            return None
+
+        next_id, first, second, stage, round, competition_id = (
+            i.decode() for i in result
+        )
+        next_choice_schema = RatingChoiceResponseSchema(
+            id=next_id,
+            items=sorted(i for i in (first, second) if i),
+            stage=int(stage),
+            round=int(round),
+            prev=choice_id,
+        )
+        if embed_items:
+            await self._embed_items(UUID(competition_id), next_choice_schema)
+        return ChooseResponseSchema(next_choice=next_choice_schema, ended=False)
+
+    async def _apply_write_behind(self, entries: list[dict[str, str]]):
+        """
+        Write results recorded in write-behind mode in a few bulk statements.
+
+        Every statement only sets values, so applying an entry twice is
+        harmless, and only to ratings still in the stage of the entry, so an
+        entry applied again after its stage has ended changes nothing.
+
+        Args:
+            entries: Log entries of any number of ratings, oldest first.
+        """
+        # Choices revealed in write-behind mode are inserted first, so that the
+        # results of those decided in the same batch apply to them.
+        new_choices = [
+            dict(
+                id=UUID(entry["next"]),
+                rating_id=UUID(entry["rating"]),
+                stage=int(entry["stage"]),
+                round=int(entry["round"]),
+                winner_id=UUID(entry["first"]),
+                looser_id=UUID(entry["second"]) if entry["second"] else None,
+                created_by=UUID(entry["user_id"]),
+                updated_by=UUID(entry["user_id"]),
             )
-            .subquery()
+            for entry in entries
+            if entry["inserted"] == "1"
+        ]
+        if new_choices:
+            stmt = pg_insert(RatingChoice).on_conflict_do_nothing()
+            await self.session.execute(stmt, new_choices)
+
+        results = values(
+            column("id", UUIDType),
+            column("winner_id", UUIDType),
+            column("looser_id", UUIDType),
+            column("user_id", UUIDType),
+            name="results",
+        ).data(
+            [
+                (
+                    UUID(entry["choice"]),
+                    UUID(entry["winner"]),
+                    UUID(entry["looser"]) if entry["looser"] else None,
+                    UUID(entry["user_id"]),
+                )
+                for entry in entries
+            ]
         )
         stmt = (
-            select(CompetitionItem)
+            update(RatingChoice)
+            .filter(
+                RatingChoice.id == results.c.id,
+                Rating.id == RatingChoice.rating_id,
+                Rating.stage == RatingChoice.stage,
+            )
+            .values(
+                winner_id=results.c.winner_id,
+                looser_id=results.c.looser_id,
+                updated_by=results.c.user_id,
+                updated_at=func.now(),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await self.session.execute(stmt)
+
+        statuses: dict[tuple[UUID, UUID], tuple[int, RatingItemStatus]] = {}
+        rounds: dict[UUID, tuple[int, int]] = {}
+        for entry in entries:
+            rating_id, stage = UUID(entry["rating"]), int(entry["stage"])
+            for item in (entry["first"], entry["second"], entry["winner"]):
+                if item:
+                    statuses[rating_id, UUID(item)] = stage, RatingItemStatus.PAIRED
+            if entry["looser"]:
+                statuses[rating_id, UUID(entry["looser"])] = (
+                    stage,
+                    RatingItemStatus.ELIMINATED,
+                )
+            rounds[rating_id] = max(
+                rounds.get(rating_id, (0, 0)),
+                (int(entry["stage"]), int(entry["round"])),
+            )
+
+        item_statuses = values(
+            column("rating_id", UUIDType),
+            column("item_id", UUIDType),
+            column("stage", Integer),
+            column("status", Integer),
+            name="item_statuses",
+        ).data(
+            [
+                (rating_id, item_id, stage, int(status))
+                for (rating_id, item_id), (stage, status) in statuses.items()
+            ]
+        )
+        stmt = (
+            update(RatingItem)
+            .filter(
+                RatingItem.rating_id == item_statuses.c.rating_id,
+                RatingItem.item_id == item_statuses.c.item_id,
+                Rating.id == item_statuses.c.rating_id,
+                Rating.stage == item_statuses.c.stage,
+            )
+            .values(status=item_statuses.c.status, updated_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+        await self.session.execute(stmt)
+
+        rating_rounds = values(
+            column("id", UUIDType),
+            column("stage", Integer),
+            column("round", Integer),
+            name="rating_rounds",
+        ).data(
+            [(rating_id, stage, round) for rating_id, (stage, round) in rounds.items()]
+        )
+        stmt = (
+            update(Rating)
             .filter(
-                CompetitionItem.id.in_(await self._get_available_items_ids(id))
-                | CompetitionItem.id.in_(select(subquery))
+                Rating.id == rating_rounds.c.id,
+                Rating.stage == rating_rounds.c.stage,
+            )
+            .values(
+                round=func.greatest(Rating.round, rating_rounds.c.round),
+                updated_at=func.now(),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await self.session.execute(stmt)
+
+    async def flush_write_behind(self, *ids: UUID, drop_state: bool = False):
+        """
+        Write results recorded in write-behind mode for the given ratings to
+        the database.
+
+        Log entries are removed only after the commit, so entries of a flush
+        interrupted by a crash are applied again by the next one. The ratings
+        are locked before their logs are read, so concurrent flushes of a
+        rating take turns and a flush never applies entries another one has
+        already removed.
+
+        Args:
+            ids: The ids of the ratings.
+            drop_state: Whether to forget the frontier kept in Redis, before
+                changing the rating in the database directly.
+        """
+        if not settings.RATING_WRITE_BEHIND or not ids:
+            return
+
+        async def read_logs():
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for id in ids:
+                    pipe.xrange(self.write_behind_log.format(rating_id=id))
+                return await pipe.execute()
+
+        logs = await read_logs()
+        if any(logs):
+            stmt = (
+                select(Rating.id)
+                .filter(Rating.id.in_(ids))
+                .order_by(Rating.id)
+                .with_for_update()
+            )
+            await self.session.execute(stmt)
+            logs = await read_logs()
+            entries = [
+                {key.decode(): value.decode() for key, value in fields.items()}
+                for log in logs
+                for _, fields in log
+            ]
+            if entries:
+                await self._apply_write_behind(entries)
+            await self.session.commit()
+
+        script = self.redis.register_script(self.write_behind_ack_script)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for id, log in zip(ids, logs):
+                await script(
+                    keys=[
+                        self.write_behind_log.format(rating_id=id),
+                        self.write_behind_dirty,
+                    ],
+                    args=[str(id), *(entry_id for entry_id, _ in log)],
+                    client=pipe,
+                )
+                if drop_state:
+                    pipe.delete(*self._write_behind_keys(id)[:2])
+            await pipe.execute()
+
+    async def choose(
+        self,
+        id: UUID,
+        choice_id: UUID,
+        payload: ChoosePayloadSchema,
+        embed_items: bool = False,
+    ):
+        """
+        Choose a winner and looser for a rating choice.
+
+        With `RATING_WRITE_BEHIND` the choices of a stage are recorded in Redis
+        and written to the database later; the rest goes to the database.
+
+        Args:
+            id: The id of the rating.
+            choice_id: The id of the rating choice.
+            payload: The payload with the winner and looser item ids.
+            embed_items: Whether to include the items of the next choice.
+
+        Returns:
+            A ChooseResponseSchema with the next rating choice and ended boolean.
+        """
+        if not settings.RATING_WRITE_BEHIND:
+            return await self._choose_persisted(id, choice_id, payload, embed_items)
+
+        response = await self._choose_write_behind(id, choice_id, payload, embed_items)
+        if response is None:
+            await self.flush_write_behind(id, drop_state=True)
+            response = await self._choose_persisted(
+                id, choice_id, payload, embed_items
+            )
+        return response
+
+    async def _choose_persisted(
+        self,
+        id: UUID,
+        choice_id: UUID,
+        payload: ChoosePayloadSchema,
+        embed_items: bool = False,
+    ):
+        """
+        Choose a winner and looser for a rating choice in the database.
+
+        The common case takes one Redis and one database round trip: the
+        snapshot version is marked pending along with the draw of the next
+        pair, so nothing is left to do in Redis after the commit. Choices
+        ending a stage and invalid requests go through `_choose_stepwise`.
+
+        Args:
+            id: The id of the rating.
+            choice_id: The id of the rating choice.
+            payload: The payload with the winner and looser item ids.
+            embed_items: Whether to include the items of the next choice.
+
+        Returns:
+            A ChooseResponseSchema with the next rating choice and ended boolean.
+        """
+        pair = None
+        if not settings.RATING_PREGENERATE_STAGES:
+            # Only drawn if the pool belongs to the user.
+            pair = await self._try_draw_pair(id, mark_snapshot=True)
+        else:
+            await self._mark_snapshot_pending(id)
+
+        try:
+            row = await self._choose_in_one_statement(
+                id, choice_id, payload.winner_id, pair
+            )
+            if row is not None:
+                await self.session.commit()
+        except HTTPException:
+            if pair:
+                await self._return_pair(id, pair)
+            raise
+        except BaseException:
+            # The pair may or may not have been recorded, so the pool is
+            # rebuilt from the items by the next draw.
+            if pair:
+                await self.redis.delete(self._items_cache_key(id))
+            raise
+        if row is None:
+            await self.session.rollback()
+            if pair:
+                await self._return_pair(id, pair)
+            return await self._choose_stepwise(id, choice_id, payload, embed_items)
+
+        if pair and not row.inserted:
+            await self._return_pair(id, pair)
+
+        items = [row.winner_id]
+        if row.looser_id:
+            items.append(row.looser_id)
+            items.sort(key=lambda x: str(x))
+        next_choice_schema = RatingChoiceResponseSchema(
+            id=row.id,
+            items=items,
+            stage=row.stage,
+            round=row.round,
+            prev=row.prev,
+            next=row.next,
+            winner_id=row.winner_id if not row.is_current else None,
+        )
+        if settings.RATING_WRITE_BEHIND and row.is_current:
+            await self._prime_write_behind(id, row.competition_id, next_choice_schema)
+        if embed_items:
+            await self._embed_items(row.competition_id, next_choice_schema)
+        return ChooseResponseSchema(next_choice=next_choice_schema, ended=False)
+
+    async def _choose_stepwise(
+        self,
+        id: UUID,
+        choice_id: UUID,
+        payload: ChoosePayloadSchema,
+        embed_items: bool = False,
+    ):
+        """
+        Choose a winner and looser for a rating choice, handling the end of a
+        stage and reporting invalid requests.
+
+        Args:
+            id: The id of the rating.
+            choice_id: The id of the rating choice.
+            payload: The payload with the winner and looser item ids.
+            embed_items: Whether to include the items of the next choice.
+
+        Returns:
+            A ChooseResponseSchema with the next rating choice and ended boolean.
+        """
+        rating = await self._get_for_update(id)
+        try:
+            next_position = await self._apply_choice(
+                rating, choice_id, payload.winner_id
+            )
+            return await self._commit_choice(rating, next_position, embed_items)
+        except BaseException:
+            # Pairs drawn from the pool are not returned by the rollback.
+            await self.redis.delete(self._items_cache_key(id))
+            raise
+
+    async def _apply_choice(
+        self, rating: Rating, choice_id: UUID, winner_id: UUID
+    ) -> tuple[int, int] | None:
+        """
+        Record the winner of a rating choice without committing.
+
+        Returns:
+            The stage and round of the choice to show next, or None if the
+            rating has ended.
+        """
+        if rating.ended:
+            raise HTTPException(400, "Invalid request")
+
+        choice = await self.rating_choice_service.get(id=choice_id, rating_id=rating.id)
+
+        if winner_id not in {choice.winner_id, choice.looser_id}:
+            raise HTTPException(400, "Invalid request")
+        if choice.stage != rating.stage or choice.round > rating.round:
+            raise HTTPException(400, "Invalid request")
+        if choice.winner_id != winner_id:
+            choice.winner_id, choice.looser_id = choice.looser_id, choice.winner_id
+        rating.updated_at = datetime.now()
+        if get_strategy(rating.pairing).sequential:
+            return await self._apply_ranking_choice(rating, choice)
+        await self._record_result(rating, choice)
+
+        if choice.round != rating.round:
+            return choice.stage, choice.round + 1
+
+        next_coice = await self._next_choice(rating)
+        if not next_coice:
+            left = await self._advance_stage(rating)
+            rating.is_refreshed = False
+            if left < 2:
+                rating.ended = True
+                await self._save_result(rating)
+                return None
+
+            next_coice = await self._start_stage(rating)
+        rating.round = next_coice.round
+        return rating.stage, rating.round
+
+    async def _commit_choice(
+        self,
+        rating: Rating,
+        next_position: tuple[int, int] | None,
+        embed_items: bool = False,
+    ) -> ChooseResponseSchema:
+        if next_position is None:
+            await self.session.commit()
+            await self._delete_snapshot_version(rating.id)
+            return ChooseResponseSchema(ended=True)
+
+        next_stage, next_round = next_position
+        next_choice_schema = await self._get_choice_response(
+            rating, stage=next_stage, round=next_round
+        )
+        await self.session.commit()
+        await self._delete_snapshot_version(rating.id)
+
+        if (
+            settings.RATING_WRITE_BEHIND
+            and next_choice_schema.winner_id is None
+            and not get_strategy(rating.pairing).sequential
+        ):
+            await self._prime_write_behind(
+                rating.id, rating.competition_id, next_choice_schema
             )
+        if embed_items:
+            await self._embed_items(rating.competition_id, next_choice_schema)
+        return ChooseResponseSchema(next_choice=next_choice_schema, ended=rating.ended)
+
+    async def choose_batch(
+        self,
+        id: UUID,
+        payload: list[ChooseBatchItemSchema],
+        embed_items: bool = False,
+    ):
+        """
+        Apply a list of choices of a rating in order, in one transaction.
+
+        Args:
+            id: The id of the rating.
+            payload: The choices with their winners, in the order they were made.
+            embed_items: Whether to include the items of the next choice.
+
+        Returns:
+            A ChooseResponseSchema with the choice following the last one.
+        """
+        if not payload:
+            raise HTTPException(400, "Invalid request")
+
+        await self.flush_write_behind(id, drop_state=True)
+        rating = await self._get_for_update(id)
+        try:
+            for decision in payload:
+                next_position = await self._apply_choice(
+                    rating, decision.choice_id, decision.winner_id
+                )
+            return await self._commit_choice(rating, next_position, embed_items)
+        except BaseException:
+            # Pairs drawn from the pool are not returned by the rollback.
+            await self.redis.delete(self._items_cache_key(id))
+            raise
+
+    async def get_result(self, id: UUID) -> RatingResultSchema:
+        """
+        Get the final placement of an ended rating.
+
+        Args:
+            id: The id of the rating.
+
+        Returns:
+            The champion, the runner-up, the items eliminated in every stage
+            and every item in tiers of tied ones.
+        """
+        result = await self.session.get(RatingResult, id)
+        if not result:
+            raise HTTPException(status_code=404, detail="RatingResult not found")
+        tiers, start = [], 0
+        for size in result.tier_sizes:
+            tiers.append(result.items[start : start + size])
+            start += size
+        return RatingResultSchema(
+            rating_id=id,
+            champion=result.items[0],
+            runner_up=result.items[1] if len(result.items) > 1 else None,
+            eliminated=tiers[:0:-1],
+            tiers=tiers,
+        )
+
+    async def get_rounds_total(self, id: UUID):
+        # Items added to the competition later do not take part in the rating.
+        stmt = select(Rating.stage, Rating.pairing, Rating.items_count).filter(
+            Rating.id == id, Rating.user_id == self.token.sub
+        )
+        row = (await self.session.execute(stmt)).one_or_none()
+        if not row:
+            raise HTTPException(status_code=404, detail="Rating not found")
+        return get_strategy(row.pairing).rounds_total(row.items_count, row.stage)
+
+    async def get_available_items_ids(self, id: UUID):
+        rating = await self.get(id=id, user_id=self.token.sub)
+        return await self._get_available_items_ids(rating)
+
+    async def get_stage_items(self, id: UUID):
+        rating = await self.get(id=id)
+        return await self._get_stage_items(rating)
+
+    async def _get_stage_items(self, rating: Rating):
+        stmt = (
+            select(CompetitionItem)
+            .join(RatingItem, RatingItem.item_id == CompetitionItem.id)
+            .filter(RatingItem.rating_id == rating.id)
             .order_by(CompetitionItem.created_at)
         )
+        # Every item takes part in every stage of a full ranking. Items of an
+        # ended one are all in its ranking, and may already be archived.
+        if not get_strategy(rating.pairing).sequential:
+            stmt = stmt.filter(RatingItem.stage == rating.stage)
+        elif rating.ended:
+            stmt = (
+                select(CompetitionItem)
+                .filter(CompetitionItem.id.in_(rating.ranking))
+                .order_by(CompetitionItem.created_at)
+            )
         items = (await self.session.scalars(stmt)).all()
         return items
 
+    @staticmethod
+    def _order_grid(
+        stages: list[list[tuple[UUID, UUID | None]]],
+    ) -> list[list[tuple[UUID, UUID | None]]]:
+        """
+        Order each stage so that pairs line up under the pair their winners
+        met in next.
+
+        Args:
+            stages: Choices of every stage in round order.
+
+        Returns:
+            The stages in bracket order.
+        """
+        for i in range(len(stages) - 2, -1, -1):
+            # An item may win several choices of a stage of a full ranking.
+            by_winner: dict[UUID, list[tuple[UUID, UUID | None]]] = {}
+            for choice in stages[i]:
+                by_winner.setdefault(choice[0], []).append(choice)
+            ordered = []
+            for choice in stages[i + 1]:
+                for item in choice:
+                    ordered.extend(by_winner.pop(item, []))
+            for choices in by_winner.values():
+                ordered.extend(choices)
+            stages[i] = ordered
+        return stages
+
     async def get_grid(self, id: UUID) -> list[list[tuple[UUID, UUID | None]]]:
+        """
+        Get the bracket of a rating.
+
+        Finished stages never change, so they are cached together with the
+        stage they were read at; only the choices from that stage on are read
+        from the database.
+
+        Args:
+            id: The ID of the rating.
+
+        Returns:
+            Revealed choices of every stage as (winner, looser) pairs.
+        """
+        await self.flush_write_behind(id)
         cache_key = self.cache_grid.format(rating_id=id)
+        finished: list[list[tuple[UUID, UUID | None]]] = []
         cached_result = await self.redis.get(cache_key)
         if cached_result:
-            return json.loads(cached_result, cls=self.CustomJSONDecoder)
-        
+            cached = json.loads(cached_result)
+            finished = [
+                [
+                    (UUID(winner), UUID(looser) if looser else None)
+                    for winner, looser in choices
+                ]
+                for choices in cached["stages"]
+            ]
+
+        stmt = (
+            select(
+                Rating.stage.label("current_stage"),
+                RatingChoice.stage,
+                RatingChoice.winner_id,
+                RatingChoice.looser_id,
+            )
+            .join(Rating, Rating.id == RatingChoice.rating_id)
+            .filter(
+                RatingChoice.rating_id == id,
+                RatingChoice.stage > len(finished),
+                (RatingChoice.stage < Rating.stage)
+                | (RatingChoice.round <= Rating.round),
+            )
+            .order_by(RatingChoice.stage, RatingChoice.round)
+        )
+        result = (await self.session.execute(stmt)).all()
+        if not result:
+            # Ended ratings may have their choices archived.
+            archived = await self._get_archived_stages(id)
+            if archived is not None:
+                finished = []
+                result = [
+                    (len(archived) + 1, stage, winner, looser)
+                    for stage, choices in enumerate(archived, 1)
+                    for _, winner, looser in choices
+                ]
+
+        stages = finished
+        cached_stage = current_stage = len(finished) + 1
+        for current_stage, stage, winner, looser in result:
+            while len(stages) < stage:
+                stages.append([])
+            stages[stage - 1].append((winner, looser))
+
+        if current_stage > cached_stage:
+            await self.redis.setex(
+                cache_key,
+                self.cache_expire,
+                json.dumps(
+                    {"stages": stages[: current_stage - 1]},
+                    cls=RatingService.CustomJSONEncoder,
+                ),
+            )
+        return self._order_grid(stages)
+
+    async def get_compact_grid(self, id: UUID) -> dict[str, Any]:
+        """
+        Get the bracket of a rating with items referenced by their position
+        in a single items list.
+
+        Args:
+            id: The ID of the rating.
+
+        Returns:
+            The items list and the stages as pairs of positions in it.
+        """
+        stages = await self.get_grid(id)
+        positions: dict[UUID, int] = {}
+        for choices in stages:
+            for choice in choices:
+                for item in choice:
+                    if item is not None:
+                        positions.setdefault(item, len(positions))
+        return {
+            "items": list(positions),
+            "stages": [
+                [
+                    (positions[winner], None if looser is None else positions[looser])
+                    for winner, looser in choices
+                ]
+                for choices in stages
+            ],
+        }
+
+    async def _delete_snapshot_version(self, id: UUID):
+        await self.redis.delete(self.cache_snapshot_version.format(rating_id=id))
+
+    async def _mark_snapshot_pending(self, id: UUID):
+        await self.redis.set(
+            self.cache_snapshot_version.format(rating_id=id),
+            self.snapshot_pending,
+            ex=self.snapshot_pending_expire,
+        )
+
+    async def _get_snapshot_etag(self, id: UUID) -> str | None:
+        rating_version = await self.redis.get(
+            self.cache_snapshot_version.format(rating_id=id)
+        )
+        if not rating_version or rating_version.decode() == self.snapshot_pending:
+            return None
+        competition_id, rating_version = rating_version.decode().split(":")
+        items_version = await self.redis.get(
+            self.competition_item_service.cache_items_version.format(
+                competition_id=competition_id
+            )
+        )
+        if not items_version:
+            return None
+        return f'"{rating_version}-{items_version.decode()}"'
+
+    async def _new_snapshot_etag(self, id: UUID, competition_id: UUID) -> str:
+        # Versions are stored before the rating is read: a change committed
+        # after that deletes them, so a stored version never outlives the
+        # data it was handed out with.
+        rating_key = self.cache_snapshot_version.format(rating_id=id)
+        items_key = self.competition_item_service.cache_items_version.format(
+            competition_id=competition_id
+        )
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(
+                rating_key,
+                f"{competition_id}:{uuid4().hex}",
+                ex=self.cache_expire,
+                nx=True,
+            )
+            pipe.set(items_key, uuid4().hex, ex=self.cache_expire, nx=True)
+            pipe.get(rating_key)
+            pipe.get(items_key)
+            *_, rating_version, items_version = await pipe.execute()
+        if rating_version.decode() == self.snapshot_pending:
+            # A change is being committed: the ETag is not stored.
+            return f'"{uuid4().hex}-{items_version.decode()}"'
+        return f'"{rating_version.decode().split(":")[1]}-{items_version.decode()}"'
+
+    async def get_snapshot(
+        self, id: UUID, etag: str | None = None
+    ) -> tuple[str, RatingSnapshotSchema | None]:
+        """
+        Get everything needed to show a rating in one go.
+
+        Args:
+            id: The id of the rating.
+            etag: The ETag of a snapshot the client already has.
+
+        Returns:
+            The ETag of the current snapshot and the snapshot, or None in its
+            place if `etag` is still current; that check reads Redis only.
+        """
+        current_etag = await self._get_snapshot_etag(id)
+        if current_etag and current_etag == etag:
+            return current_etag, None
+
+        await self.flush_write_behind(id)
+        rating = await self.get(id=id)
+        etag = await self._new_snapshot_etag(id, rating.competition_id)
+
+        choice = None
+        if not rating.ended:
+            choice = await self._get_choice_response(
+                rating, stage=rating.stage, round=rating.round
+            )
+        strategy = get_strategy(rating.pairing)
+        snapshot = RatingSnapshotSchema(
+            rating=RatingSchema.model_validate(rating),
+            choice=choice,
+            items=await self._get_stage_items(rating),
+            grid=await self.get_grid(id),
+            rounds_total=strategy.rounds_total(rating.items_count, rating.stage),
+            stages_total=strategy.stages_total(rating.items_count),
+        )
+        return etag, snapshot
+
+    async def archive_ended(self, batch_size: int = 1000) -> int:
+        """
+        Pack the choices of ended ratings into archives and delete their rows,
+        along with the rows of their items.
+
+        Ratings being archived are locked and skipped by concurrent runs.
+
+        Args:
+            batch_size: The number of ratings archived at once.
+
+        Returns:
+            The number of archived ratings, 0 when there is nothing left.
+        """
         stmt = (
-            select(RatingChoice.stage, RatingChoice.winner_id, RatingChoice.looser_id)
-            .filter(RatingChoice.rating_id == id)
-            .order_by(RatingChoice.created_at)
+            select(Rating.id)
+            .filter(
+                Rating.ended == True,  # noqa: E712
+                ~exists().where(RatingArchive.rating_id == Rating.id),
+            )
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
         )
+        ids = (await self.session.scalars(stmt)).all()
+        if not ids:
+            return 0
 
-        result: list[tuple[int, UUID, UUID | None]] = (
+        stmt = (
+            select(
+                RatingChoice.rating_id,
+                RatingChoice.stage,
+                RatingChoice.id,
+                RatingChoice.winner_id,
+                RatingChoice.looser_id,
+            )
+            .filter(RatingChoice.rating_id.in_(ids))
+            .order_by(RatingChoice.rating_id, RatingChoice.stage, RatingChoice.round)
+        )
+        choices: dict[UUID, list[tuple[UUID, UUID, UUID | None]]] = {
+            id: [] for id in ids
+        }
+        stage_sizes: dict[UUID, list[int]] = {id: [] for id in ids}
+        for rating_id, stage, id, winner_id, looser_id in (
             await self.session.execute(stmt)
-        ).all()
-        response_dict = defaultdict(list[tuple[UUID, UUID | None]])
-        for stage, winner, looser in result:
-            response_dict[stage].append((winner, looser))
-
-        response = list(response_dict.values())
-        for i in range(len(response) - 1, 0, -1):
-            cur_stage_choices = response[i]
-            prev_stage_choices = response[i - 1]
-
-            choice_index = 0
-            for cur_choice in cur_stage_choices:
-                winner_index = next(
-                    (
-                        x
-                        for x, item in enumerate(prev_stage_choices)
-                        if item[0] == cur_choice[0]
-                    ),
-                )
-                prev_stage_choices[choice_index], prev_stage_choices[winner_index] = (
-                    prev_stage_choices[winner_index],
-                    prev_stage_choices[choice_index],
+        ).all():
+            choices[rating_id].append((id, winner_id, looser_id))
+            sizes = stage_sizes[rating_id]
+            sizes.extend([0] * (stage - len(sizes)))
+            sizes[stage - 1] += 1
+
+        await self.session.execute(
+            insert(RatingArchive),
+            [
+                dict(
+                    rating_id=id,
+                    choices=pack_choices(choices[id]),
+                    stage_sizes=stage_sizes[id],
                 )
-                choice_index += 1
-                if cur_choice[1] is None:
-                    continue
-                looser_index = next(
-                    (
-                        x
-                        for x, item in enumerate(prev_stage_choices)
-                        if item[0] == cur_choice[1]
-                    ),
-                )
-                prev_stage_choices[choice_index], prev_stage_choices[looser_index] = (
-                    prev_stage_choices[looser_index],
-                    prev_stage_choices[choice_index],
-                )
-                choice_index += 1
-        await self.redis.setex(
-            cache_key,
-            self.cache_expire,
-            json.dumps(response, cls=RatingService.CustomJSONEncoder),
+                for id in ids
+            ],
         )
-        return response
+        stmt = delete(RatingChoice).filter(RatingChoice.rating_id.in_(ids))
+        await self.session.execute(stmt)
+        # Placements are kept in the results; only the items that got to the
+        # final stage of a tournament are still listed as its stage items.
+        stmt = delete(RatingItem).filter(
+            RatingItem.rating_id.in_(ids),
+            Rating.id == RatingItem.rating_id,
+            (Rating.stage != RatingItem.stage)
+            | Rating.pairing.in_(sequential_pairings),
+        )
+        await self.session.execute(stmt)
+        await self.session.commit()
+        return len(ids)
+
+    async def reap_abandoned(self, idle: timedelta, batch_size: int = 1000) -> int:
+        """
+        Delete unfinished ratings that have not changed for a while.
+
+        Ratings being deleted are locked and skipped by concurrent runs.
+
+        Args:
+            idle: How long a rating has to stay unchanged to be abandoned.
+            batch_size: The number of ratings deleted at once.
+
+        Returns:
+            The number of deleted ratings, 0 when there is nothing left.
+        """
+        stmt = (
+            select(Rating.id)
+            .filter(
+                Rating.ended == False,  # noqa: E712
+                Rating.updated_at < func.now() - idle,
+            )
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        ids = (await self.session.scalars(stmt)).all()
+        if not ids:
+            return 0
+        if settings.RATING_WRITE_BEHIND:
+            # Choices not flushed yet are recent activity.
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for id in ids:
+                    pipe.exists(self.write_behind_log.format(rating_id=id))
+                unflushed = await pipe.execute()
+            ids = [id for id, exists in zip(ids, unflushed) if not exists]
+            if not ids:
+                await self.session.rollback()
+                return 0
+        await self._discard_ratings(*ids)
+        await self.session.commit()
+        await self._delete_rating_keys(*ids)
+        return len(ids)
+
+
+class RatingWriteBehindFlusher:
+    def __init__(self):
+        self.flush_task: asyncio.Task | None = None
+
+    async def init(self):
+        if settings.RATING_WRITE_BEHIND:
+            self.flush_task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.flush_task:
+            # A flush cut short rolls back before the last ones run.
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+            while await self.flush() == settings.RATING_FLUSH_BATCH:
+                pass
+
+    async def flush(self) -> int:
+        redis = redis_manager.redis
+        ids = await redis.srandmember(
+            RatingService.write_behind_dirty, settings.RATING_FLUSH_BATCH
+        )
+        if not ids:
+            return 0
+        async with db_manager.session() as session:
+            service = RatingService(session, redis, None)
+            await service.flush_write_behind(*(UUID(i.decode()) for i in ids))
+        return len(ids)
+
+    async def _run(self):
+        while True:
+            try:
+                flushed = await self.flush()
+            except Exception:
+                logger.exception("Failed to flush rating results")
+                flushed = 0
+            if flushed < settings.RATING_FLUSH_BATCH:
+                await asyncio.sleep(settings.RATING_FLUSH_INTERVAL)
+
+
+rating_flusher = RatingWriteBehindFlusher()
+
+
+class RatingReaper:
+    # Held for an interval by the worker that sweeps, so that one sweep runs
+    # per interval however many workers there are.
+    lock_key = "RatingReaper:lock"
+
+    def __init__(self):
+        self.reap_task: asyncio.Task | None = None
+
+    async def init(self):
+        if settings.RATING_REAP_ABANDONED:
+            self.reap_task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.reap_task:
+            self.reap_task.cancel()
+            try:
+                await self.reap_task
+            except asyncio.CancelledError:
+                pass
+            self.reap_task = None
+
+    async def reap(self) -> int:
+        redis = redis_manager.redis
+        locked = await redis.set(
+            self.lock_key,
+            uuid4().hex,
+            nx=True,
+            ex=max(int(settings.RATING_REAP_INTERVAL), 1),
+        )
+        if not locked:
+            return 0
+        idle = timedelta(seconds=settings.RATING_ABANDONED_AFTER)
+        reaped = 0
+        async with db_manager.session() as session:
+            service = RatingService(session, redis, None)
+            while True:
+                batch = await service.reap_abandoned(
+                    idle, batch_size=settings.RATING_REAP_BATCH
+                )
+                reaped += batch
+                if batch < settings.RATING_REAP_BATCH:
+                    return reaped
+
+    async def _run(self):
+        while True:
+            try:
+                reaped = await self.reap()
+                if reaped:
+                    logger.info("Deleted %s abandoned ratings", reaped)
+            except Exception:
+                logger.exception("Failed to reap abandoned ratings")
+            await asyncio.sleep(settings.RATING_REAP_INTERVAL)
+
+
+rating_reaper = RatingReaper()
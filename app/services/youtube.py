@@ -7,10 +7,21 @@ from app.models.tests import CompetitionItem, Competition
 from app.schemas.competition_item import CompetitionItemSchema
 from app.schemas.youtube import AddPlaylistPayloadSchema, GetVideoTitleResponseSchema
 from app.services import BaseService
+from app.services.competition_item import CompetitionItemService
 from fastapi import HTTPException
 
 
 class YouTubeService(BaseService):
+    _competition_item_service: CompetitionItemService = None
+
+    @property
+    def competition_item_service(self):
+        if self._competition_item_service is None:
+            self._competition_item_service = CompetitionItemService(
+                self.session, self.redis, self._token
+            )
+        return self._competition_item_service
+
     async def get_video_title(self, id: str):
         params = dict(id=id, part="snippet", key=settings.YOUTUBE_API_KEY)
 
@@ -100,5 +111,6 @@ class YouTubeService(BaseService):
                 params["pageToken"] = next_page_token
 
         await self.session.commit()
+        await self.competition_item_service.delete_cached_items(payload.competition_id)
 
         return added
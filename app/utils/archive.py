@@ -0,0 +1,58 @@
+from typing import Iterable
+from uuid import UUID
+import numpy as np
+
+# Id, winner and looser of a choice, 16 bytes each.
+CHOICE_SIZE = 48
+# The records as a numpy dtype, for reading many of them at once.
+CHOICE_DTYPE = np.dtype([("id", "S16"), ("winner", "S16"), ("looser", "S16")])
+
+_NO_LOOSER = bytes(16)
+
+
+def pack_choices(choices: Iterable[tuple[UUID, UUID, UUID | None]]) -> bytes:
+    """
+    Pack choices into fixed size records.
+
+    Args:
+        choices: (id, winner, looser) of every choice; the looser is None for
+            an item that had no pair.
+
+    Returns:
+        The records of the choices in the given order.
+    """
+    return b"".join(
+        id.bytes + winner.bytes + (looser.bytes if looser else _NO_LOOSER)
+        for id, winner, looser in choices
+    )
+
+
+def unpack_choices(
+    data: bytes, stage_sizes: Iterable[int]
+) -> list[list[tuple[UUID, UUID, UUID | None]]]:
+    """
+    Unpack choices packed with `pack_choices` into stages.
+
+    Args:
+        data: The packed choices in stage and round order.
+        stage_sizes: The number of choices in every stage.
+
+    Returns:
+        (id, winner, looser) of the choices of every stage in round order.
+    """
+    stages = []
+    offset = 0
+    for size in stage_sizes:
+        choices = []
+        for start in range(offset, offset + size * CHOICE_SIZE, CHOICE_SIZE):
+            looser = data[start + 32 : start + 48]
+            choices.append(
+                (
+                    UUID(bytes=data[start : start + 16]),
+                    UUID(bytes=data[start + 16 : start + 32]),
+                    UUID(bytes=looser) if looser != _NO_LOOSER else None,
+                )
+            )
+        stages.append(choices)
+        offset += size * CHOICE_SIZE
+    return stages
@@ -0,0 +1,116 @@
+import hashlib
+import json
+from typing import Any, Awaitable, Callable
+from aioredis import Redis
+from fastapi import Depends, Header, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from app.config import settings
+from app.database import get_redis
+from app.utils.token import AccessToken, get_optional_access_token_data
+
+
+class Idempotency:
+    """
+    Replays the response to the first request with an `Idempotency-Key`
+    header to the retries of it, so that a retried mutation is done once.
+
+    The first response is kept in Redis for `IDEMPOTENCY_EXPIRE` seconds and
+    replayed without running the request again. A retry arriving while the
+    first request is still running gets a 409, the same key sent with another
+    request gets a 422, and a failed request may be retried with its key.
+    """
+
+    key_format = "idempotency:{user_id}:{key}"
+    # How long a request may run before its key can be taken by a retry.
+    lock_expire = 60
+
+    def __init__(
+        self,
+        redis: Redis,
+        response: Response,
+        cache_key: str | None = None,
+        fingerprint: str | None = None,
+    ):
+        self.redis = redis
+        self.response = response
+        self.cache_key = cache_key
+        self.fingerprint = fingerprint
+
+    @classmethod
+    async def get_dependency(
+        cls,
+        request: Request,
+        response: Response,
+        idempotency_key: str | None = Header(None, max_length=255),
+        redis: Redis = Depends(get_redis),
+        token: AccessToken | None = Depends(get_optional_access_token_data),
+    ):
+        if not idempotency_key or not token:
+            return cls(redis, response)
+        fingerprint = hashlib.sha256(
+            b"\n".join(
+                (
+                    request.method.encode(),
+                    request.url.path.encode(),
+                    request.url.query.encode(),
+                    await request.body(),
+                )
+            )
+        ).hexdigest()
+        cache_key = cls.key_format.format(user_id=token.sub, key=idempotency_key)
+        return cls(redis, response, cache_key, fingerprint)
+
+    async def run(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run a request once per key.
+
+        Args:
+            call: Does the request and returns its response.
+
+        Returns:
+            The response to the request, the stored one for a retry.
+        """
+        if not self.cache_key:
+            return await call()
+
+        locked = await self.redis.set(
+            self.cache_key,
+            json.dumps({"fingerprint": self.fingerprint}),
+            ex=self.lock_expire,
+            nx=True,
+        )
+        if not locked:
+            return await self._replay()
+
+        try:
+            result = await call()
+        except BaseException:
+            await self.redis.delete(self.cache_key)
+            raise
+        await self.redis.set(
+            self.cache_key,
+            json.dumps(
+                {"fingerprint": self.fingerprint, "response": jsonable_encoder(result)}
+            ),
+            ex=settings.IDEMPOTENCY_EXPIRE,
+        )
+        return result
+
+    async def _replay(self) -> Any:
+        cached_result = await self.redis.get(self.cache_key)
+        if not cached_result:
+            # The first request has just failed.
+            raise HTTPException(
+                status_code=409, detail="Request with this key is in progress"
+            )
+        cached = json.loads(cached_result)
+        if cached["fingerprint"] != self.fingerprint:
+            raise HTTPException(
+                status_code=422, detail="Idempotency-Key was used for another request"
+            )
+        if "response" not in cached:
+            raise HTTPException(
+                status_code=409, detail="Request with this key is in progress"
+            )
+        self.response.headers["Idempotent-Replayed"] = "true"
+        return cached["response"]
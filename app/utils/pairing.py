@@ -0,0 +1,207 @@
+import math
+import random
+from typing import Hashable, TypeVar
+from app.models.tests import Pairing
+
+_T = TypeVar("_T", bound=Hashable)
+
+
+class PairingStrategy:
+    """
+    Decides who meets whom in a rating and who goes on after every stage.
+
+    Every stage pairs the items taking part in it in the order given by
+    `order`, the first with the second and so on; an odd one out goes on
+    without a pair. When the stage is over `advance` picks the items of the
+    next stage. The rating ends once fewer than two items go on.
+    """
+
+    # Whether the strategy keeps scores of items between stages. Without
+    # scores the winners of a stage go on, which the service does in a
+    # single statement instead of calling `advance`.
+    scored = False
+    # Whether every choice depends on the answer to the previous one. Such a
+    # strategy does not pair the items of a stage up front, see
+    # `BinaryInsertion`.
+    sequential = False
+
+    def stages_total(self, items_count: int) -> int:
+        return math.ceil(math.log2(items_count)) if items_count else 0
+
+    def rounds_total(self, items_count: int, stage: int) -> int:
+        """
+        The number of choices in a stage.
+        """
+        return math.ceil(items_count / (2**stage))
+
+    def order(
+        self, ids: list[_T], scores: dict[_T, float], rng: random.Random
+    ) -> list[_T]:
+        """
+        Order the items of a stage the way they are paired.
+
+        Args:
+            ids: The items, in any order.
+            scores: Scores of the items.
+            rng: The source of randomness; the order must depend only on it
+                and the arguments, so that pairings can be reproduced.
+        """
+        order = sorted(ids)
+        rng.shuffle(order)
+        return order
+
+    def advance(
+        self, stage: int, scores: dict[_T, float], games: list[tuple[_T, _T | None]]
+    ) -> tuple[list[_T], dict[_T, float]]:
+        """
+        Pick the items of the next stage.
+
+        Args:
+            stage: The finished stage.
+            scores: Scores of the items of the stage.
+            games: (winner, looser) of every choice of the stage, the looser
+                is None for an item without a pair.
+
+        Returns:
+            The items going on and the new scores of the items of the stage.
+        """
+        return [winner for winner, _ in games], scores
+
+
+class SingleElimination(PairingStrategy):
+    pass
+
+
+class _PairedByScore(PairingStrategy):
+    scored = True
+
+    def order(
+        self, ids: list[_T], scores: dict[_T, float], rng: random.Random
+    ) -> list[_T]:
+        # Items of equal scores meet in random pairs.
+        order = super().order(ids, scores, rng)
+        order.sort(key=lambda id: -scores[id])
+        return order
+
+
+class Swiss(_PairedByScore):
+    """
+    Nobody is eliminated: items with equal numbers of wins meet each other
+    for a fixed number of stages and are finally ranked by wins.
+    """
+
+    def rounds_total(self, items_count: int, stage: int) -> int:
+        if stage > self.stages_total(items_count):
+            return 0
+        return math.ceil(items_count / 2)
+
+    def advance(
+        self, stage: int, scores: dict[_T, float], games: list[tuple[_T, _T | None]]
+    ) -> tuple[list[_T], dict[_T, float]]:
+        scores = dict(scores)
+        for winner, _ in games:
+            scores[winner] += 1
+        if stage >= self.stages_total(len(scores)):
+            return [], scores
+        return list(scores), scores
+
+
+class EloAdaptive(_PairedByScore):
+    """
+    Items of similar Elo meet each other and the best of them by Elo go on,
+    so a strong item that lost to another strong one can still go on. Scores
+    are Elo differences from the starting one.
+    """
+
+    k_factor = 32
+    # Keeping more than the winners costs more choices, but makes the top of
+    # the ranking far more accurate (see benchmark_pairing.py).
+    kept_share = 0.75
+
+    def _kept(self, items_count: int) -> int:
+        return min(math.ceil(items_count * self.kept_share), items_count - 1)
+
+    def stages_total(self, items_count: int) -> int:
+        stages = 0
+        while items_count > 1:
+            items_count = self._kept(items_count)
+            stages += 1
+        return stages
+
+    def rounds_total(self, items_count: int, stage: int) -> int:
+        for _ in range(stage - 1):
+            items_count = max(self._kept(items_count), 1)
+        return math.ceil(items_count / 2) if items_count > 1 else 0
+
+    def advance(
+        self, stage: int, scores: dict[_T, float], games: list[tuple[_T, _T | None]]
+    ) -> tuple[list[_T], dict[_T, float]]:
+        updated = dict(scores)
+        for winner, looser in games:
+            if looser is None:
+                continue
+            expected = 1 / (1 + 10 ** ((scores[looser] - scores[winner]) / 400))
+            updated[winner] += self.k_factor * (1 - expected)
+            updated[looser] -= self.k_factor * (1 - expected)
+        ranked = sorted(updated, key=lambda id: (-updated[id], id))
+        return ranked[: self._kept(len(ranked))], updated
+
+
+class BinaryInsertion(PairingStrategy):
+    """
+    Ranks all the items instead of finding a winner: they are inserted one by
+    one, in the order given by `order`, into the ranking of the items before
+    them with a binary search. Stage k inserts the (k + 1)-th item, every
+    round compares it with the middle of the range it may still take.
+
+    The ranking takes at most ceil(log2(k + 1)) choices per stage, about
+    n * log2(n) in total, close to the minimum any comparison sort needs.
+    """
+
+    sequential = True
+
+    def stages_total(self, items_count: int) -> int:
+        return max(items_count - 1, 0)
+
+    def rounds_total(self, items_count: int, stage: int) -> int:
+        if stage >= items_count:
+            return 0
+        return math.ceil(math.log2(stage + 1))
+
+    def search(self, ranked_count: int, wins: list[bool]) -> tuple[int, int]:
+        """
+        Narrow down the place of an item in a ranking by its results.
+
+        Args:
+            ranked_count: The number of items ranked so far.
+            wins: Whether the item won each comparison of its stage so far.
+
+        Returns:
+            The range of places the item may take, [low, high). The next
+            comparison is with the item in the middle of it; once the range
+            is empty the item takes place `low`.
+        """
+        low, high = 0, ranked_count
+        for won in wins:
+            middle = (low + high) // 2
+            if won:
+                high = middle
+            else:
+                low = middle + 1
+        return low, high
+
+
+strategies: dict[Pairing, PairingStrategy] = {
+    Pairing.SINGLE_ELIMINATION: SingleElimination(),
+    Pairing.SWISS: Swiss(),
+    Pairing.ELO: EloAdaptive(),
+    Pairing.FULL_RANKING: BinaryInsertion(),
+}
+
+sequential_pairings = [
+    pairing for pairing, strategy in strategies.items() if strategy.sequential
+]
+
+
+def get_strategy(pairing: str) -> PairingStrategy:
+    return strategies[Pairing(pairing)]
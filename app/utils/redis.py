@@ -1,12 +1,17 @@
 import hashlib
+from collections import OrderedDict
 from uuid import UUID, uuid4
 from aioredis import Redis
 import inspect
 from functools import wraps
 import json
 import asyncio
-from typing import Callable, Any
-from pydantic import BaseModel
+import math
+import random
+import threading
+import time
+from typing import Callable, Any, Iterable
+from pydantic import BaseModel, TypeAdapter
 from sqlalchemy.orm import DeclarativeBase
 from app.database import get_redis
 
@@ -19,22 +24,6 @@ async def generate_unique_redis_key(redis: Redis, prefix: str = "key") -> str:
             return new_key
 
 
-def calculate_hash(args: tuple, kwargs: dict):
-    # Если func - метод класса, исключаем self (первый аргумент)
-    if args and hasattr(args[0], '__class__'):
-        args = args[1:]  # Исключаем self
-    
-    # Преобразуем kwargs в отсортированный список для гарантированной последовательности
-    kwargs_tuple = tuple(sorted(kwargs.items()))
-    
-    # Комбинируем args и kwargs
-    arg_tuple = args + kwargs_tuple
-    
-    # Создаем хэш
-    hash_value = hashlib.md5(str(arg_tuple).encode()).hexdigest()
-    return hash_value
-
-
 def model_to_dict(model) -> dict:
     return {column.name: getattr(model, column.name) for column in model.__table__.columns}
 
@@ -54,23 +43,6 @@ def recursive_convert(obj):
     
     return obj
 
-def resolve_annotation(anatation: Any, obj: Any):
-    if hasattr(anatation, "__origin__"):
-        origin = anatation.__origin__
-
-        if origin is dict:
-            return {k: resolve_annotation(anatation.__args__[1], v) for k, v in obj.items()}
-        
-        if origin in (list, tuple):
-            return [resolve_annotation(anatation.__args__[0], i) for i in obj]
-        
-        return obj
-    
-    if isinstance(obj, dict):
-        return anatation(**obj)
-    
-    return anatation(obj)
-
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         try:
@@ -79,53 +51,330 @@ class CustomJSONEncoder(json.JSONEncoder):
             return str(obj)
 
 
-def cache(expire: int = 3600):
+# Every tag keeps a set of the keys of the results registered under it, and
+# a generation counted up by every invalidation of it.
+_TAG_KEY = "cache:tag:{tag}"
+_GENERATION_KEY = "cache:generation:{tag}"
+# Generations only have to outlive the calls started before an invalidation.
+_GENERATION_EXPIRE = 24 * 3600
 
-    def decorator(func: Callable) -> Callable:
-        
-        @wraps(func)
-        async def async_wrapper(*args, **kwargs) -> Any:
-            redis = next(get_redis())
-            cache_key = f"cache:{func.__qualname__}:{calculate_hash(args, kwargs)}"
+# KEYS: the key of the result, the generations of its tags and the sets of its
+# tags. ARGV: expire, result and the generations read before the call. Nothing
+# is stored if a tag has been invalidated since.
+_STORE_SCRIPT = """
+local n = (#KEYS - 1) / 2
+for i = 1, n do
+    if (redis.call('GET', KEYS[1 + i]) or '0') ~= ARGV[2 + i] then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[1])
+for i = 2 + n, #KEYS do
+    redis.call('SADD', KEYS[i], KEYS[1])
+    if redis.call('TTL', KEYS[i]) < tonumber(ARGV[1]) then
+        redis.call('EXPIRE', KEYS[i], ARGV[1])
+    end
+end
+return 1
+"""
+
+# KEYS: the sets of the tags, then their generations. ARGV: the expiry of the
+# generations.
+_INVALIDATE_SCRIPT = """
+local n = #KEYS / 2
+for t = 1, n do
+    local keys = redis.call('SMEMBERS', KEYS[t])
+    for i = 1, #keys, 1000 do
+        redis.call('DEL', unpack(keys, i, math.min(i + 999, #keys)))
+    end
+    redis.call('DEL', KEYS[t])
+    redis.call('INCR', KEYS[n + t])
+    redis.call('EXPIRE', KEYS[n + t], ARGV[1])
+end
+"""
+
+
+class TwoTierCache:
+    """
+    Caches the results of a function in a bounded in-process LRU in front of
+    Redis.
+
+    - Entries stay in process for `local_expire` seconds at most, so changes
+      made by other workers show up after that long.
+    - Concurrent misses of a key in a process wait for a single call.
+    - An entry is recomputed before it expires with a probability growing as
+      the expiry nears and with the time the call takes (XFetch), so hot keys
+      do not expire for everyone at once.
+    - Entries are registered under tags, the tag of the function and the ones
+      `tags` returns for the arguments, and are invalidated by them with
+      `invalidate_tags`. A call started before an invalidation of one of its
+      tags does not store its result.
+
+    Results of async functions are shared through Redis. Sync functions are
+    cached in process only: they cannot wait for Redis without blocking the
+    event loop. Results are stored as JSON and validated against the return
+    annotation of the function when read.
+
+    A call outlives the caller that started it and is awaited by others, so
+    it must not use anything of the caller that may be closed in between,
+    like the session of a request.
+    """
+
+    def __init__(
+        self,
+        func: Callable,
+        expire: int,
+        local_expire: float,
+        local_size: int,
+        beta: float,
+        tags: Callable[..., Iterable[str]] | None = None,
+    ):
+        self.func = func
+        self.prefix = f"cache:{func.__qualname__}"
+        self.tag = f"function:{func.__qualname__}"
+        self.expire = expire
+        self.local_expire = local_expire
+        self.local_size = local_size
+        self.beta = beta
+        self.tags = tags
+        self._signature = inspect.signature(func)
+        annotation = self._signature.return_annotation
+        self._adapter = None
+        if annotation is not inspect.Signature.empty:
+            self._adapter = TypeAdapter(annotation)
+        # Sync functions may be called from several threads.
+        self._lock = threading.Lock()
+        self._local: OrderedDict[str, tuple[dict, float, list[str]]] = OrderedDict()
+        self._local_tags: dict[str, set[str]] = {}
+        self._flights: dict[str, asyncio.Future] = {}
+        self._sync_flights: dict[str, threading.Event] = {}
+        _caches.append(self)
+
+    def _bind(self, args: tuple, kwargs: dict) -> tuple[str, list[str]]:
+        bound = self._signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = tuple(
+            (name, value)
+            for name, value in bound.arguments.items()
+            if name not in ("self", "cls")
+        )
+        key = f"{self.prefix}:{hashlib.md5(str(arguments).encode()).hexdigest()}"
+        tags = [self.tag]
+        if self.tags:
+            tags += self.tags(**bound.arguments)
+        return key, tags
+
+    def key(self, *args, **kwargs) -> str:
+        return self._bind(args, kwargs)[0]
+
+    def _load(self, entry: dict) -> Any:
+        if self._adapter is None:
+            return entry["data"]
+        return self._adapter.validate_python(entry["data"])
+
+    def _dump(self, result: Any, delta: float) -> dict:
+        entry = dict(
+            data=recursive_convert(result),
+            delta=delta,
+            expiry=time.time() + self.expire,
+        )
+        return json.loads(json.dumps(entry, cls=CustomJSONEncoder))
+
+    def _is_fresh(self, entry: dict) -> bool:
+        early = -entry["delta"] * self.beta * math.log(1 - random.random())
+        return time.time() + early < entry["expiry"]
+
+    def _get_local(self, key: str) -> dict | None:
+        with self._lock:
+            item = self._local.get(key)
+            if item is None:
+                return None
+            entry, deadline, _ = item
+            if time.monotonic() >= deadline:
+                self._drop_local(key)
+                return None
+            self._local.move_to_end(key)
+            return entry
 
-            cached_result = await redis.get(cache_key)
+    def _set_local(self, key: str, entry: dict, tags: list[str]):
+        if self.local_expire <= 0:
+            return
+        ttl = min(self.local_expire, entry["expiry"] - time.time())
+        with self._lock:
+            self._drop_local(key)
+            self._local[key] = (entry, time.monotonic() + ttl, tags)
+            for tag in tags:
+                self._local_tags.setdefault(tag, set()).add(key)
+            while len(self._local) > self.local_size:
+                self._drop_local(next(iter(self._local)))
+
+    def _drop_local(self, key: str):
+        # Called with the lock held.
+        item = self._local.pop(key, None)
+        if item is None:
+            return
+        for tag in item[2]:
+            keys = self._local_tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._local_tags[tag]
+
+    def delete_local(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._drop_local(key)
+
+    def invalidate_local(self, tags: Iterable[str]):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._local_tags.get(tag, ())):
+                    self._drop_local(key)
+
+    async def get_async(self, *args, **kwargs) -> Any:
+        key, tags = self._bind(args, kwargs)
+        entry = self._get_local(key)
+        if entry is None:
+            cached_result = await next(get_redis()).get(key)
             if cached_result:
-                res = resolve_annotation(func.__annotations__.get("return"), json.loads(cached_result))
-                return res
+                entry = json.loads(cached_result)
+                self._set_local(key, entry, tags)
+        if entry is None or not self._is_fresh(entry):
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = asyncio.ensure_future(
+                    self._call_async(key, tags, args, kwargs)
+                )
+                self._flights[key] = flight
+                flight.add_done_callback(lambda _: self._flights.pop(key, None))
+            entry = await asyncio.shield(flight)
+        return self._load(entry)
+
+    async def _call_async(
+        self, key: str, tags: list[str], args: tuple, kwargs: dict
+    ) -> dict:
+        redis = next(get_redis())
+        generation_keys = [_GENERATION_KEY.format(tag=tag) for tag in tags]
+        generations = await redis.mget(generation_keys)
+        started = time.monotonic()
+        result = await self.func(*args, **kwargs)
+        entry = self._dump(result, time.monotonic() - started)
+        script = redis.register_script(_STORE_SCRIPT)
+        stored = await script(
+            keys=[
+                key,
+                *generation_keys,
+                *(_TAG_KEY.format(tag=tag) for tag in tags),
+            ],
+            args=[
+                self.expire,
+                json.dumps(entry),
+                *(value.decode() if value else "0" for value in generations),
+            ],
+        )
+        if stored:
+            self._set_local(key, entry, tags)
+        return entry
+
+    def get_sync(self, *args, **kwargs) -> Any:
+        key, tags = self._bind(args, kwargs)
+        entry = self._get_local(key)
+        if entry is not None and self._is_fresh(entry):
+            return self._load(entry)
+
+        with self._lock:
+            flight = self._sync_flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self._sync_flights[key] = threading.Event()
+        if not leading:
+            flight.wait()
+            entry = self._get_local(key)
+            if entry is not None:
+                return self._load(entry)
+        try:
+            started = time.monotonic()
+            result = self.func(*args, **kwargs)
+            entry = self._dump(result, time.monotonic() - started)
+            self._set_local(key, entry, tags)
+        finally:
+            if leading:
+                with self._lock:
+                    del self._sync_flights[key]
+                flight.set()
+        return self._load(entry)
+
+
+_caches: list[TwoTierCache] = []
+
+
+def cache(
+    expire: int = 3600,
+    local_expire: float = 5.0,
+    local_size: int = 1024,
+    beta: float = 1.0,
+    tags: Callable[..., Iterable[str]] | None = None,
+):
+    """
+    Cache the results of a function, see `TwoTierCache`.
 
-            result = await func(*args, **kwargs)
-            await redis.setex(cache_key, expire, json.dumps(recursive_convert(result), cls=CustomJSONEncoder))
-            return result
+    Args:
+        expire: How long results are kept in Redis, in seconds.
+        local_expire: How long results are kept in process, in seconds; 0
+            keeps them in Redis only, so invalidations show up at once.
+        local_size: How many results are kept in process.
+        beta: How eagerly results are recomputed before they expire; 0 never
+            does it.
+        tags: Takes the arguments of a call by name and returns the tags to
+            register its result under.
+    """
+
+    def decorator(func: Callable) -> Callable:
+        two_tier_cache = TwoTierCache(
+            func, expire, local_expire, local_size, beta, tags
+        )
+
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs) -> Any:
+            return await two_tier_cache.get_async(*args, **kwargs)
 
         @wraps(func)
         def sync_wrapper(*args, **kwargs) -> Any:
-            redis = next(get_redis())
-            cache_key = f"cache:{func.__qualname__}:{calculate_hash(args, kwargs)}"
+            return two_tier_cache.get_sync(*args, **kwargs)
+
+        wrapper = async_wrapper if inspect.iscoroutinefunction(func) else sync_wrapper
+        wrapper.cache = two_tier_cache
+        return wrapper
 
-            async def async_cache_operations():
-                cached_result = await redis.get(cache_key)
-                if cached_result:
-                    return resolve_annotation(func.__annotations__.get("return"), json.loads(cached_result))
-                
-                result = func(*args, **kwargs)
-                await redis.setex(cache_key, expire, json.dumps(recursive_convert(result)))
-                return result
+    return decorator
 
-            return asyncio.run(async_cache_operations())
 
-        if inspect.iscoroutinefunction(func):
-            return async_wrapper
-        else:
-            return sync_wrapper
+async def invalidate_tags(*tags: str):
+    """
+    Delete the cached results registered under any of the tags, touching only
+    their own keys, and keep calls already running from storing theirs.
+    """
+    for two_tier_cache in _caches:
+        two_tier_cache.invalidate_local(tags)
+    redis = next(get_redis())
+    script = redis.register_script(_INVALIDATE_SCRIPT)
+    await script(
+        keys=[
+            *(_TAG_KEY.format(tag=tag) for tag in tags),
+            *(_GENERATION_KEY.format(tag=tag) for tag in tags),
+        ],
+        args=[_GENERATION_EXPIRE],
+    )
+
+
+async def delete_cache(func: Callable, *args, **kwargs):
+    """
+    Delete the cached result of a call of a function decorated with `cache`.
+    """
+    two_tier_cache: TwoTierCache = func.cache
+    key = two_tier_cache.key(*args, **kwargs)
+    two_tier_cache.delete_local(key)
+    await next(get_redis()).delete(key)
 
-    return decorator
 
 async def delete_function_cache(func: Callable):
-    redis = next(get_redis())
-    pattern = f"cache:{func.__qualname__}:*"
-    cursor = b'0'
-    while cursor:
-        cursor, keys = await redis.scan(cursor=cursor, match=pattern)
-        if keys:
-            await redis.delete(*keys)
-    
\ No newline at end of file
+    await invalidate_tags(func.cache.tag)
@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def fit_bradley_terry(
+    winners: np.ndarray,
+    loosers: np.ndarray,
+    items_total: int,
+    max_iterations: int = 500,
+    tolerance: float = 1e-5,
+) -> np.ndarray:
+    """
+    Fit Bradley-Terry strengths of items from pairwise comparisons.
+
+    Uses the fixed point iteration of Newman (2023), which converges in far
+    fewer iterations than the classic minorization-maximization one. Every
+    item gets one virtual win and one virtual loss against an item of
+    strength 1, so items that never won or never lost keep finite strengths.
+
+    Args:
+        winners: Index of the winner of every comparison.
+        loosers: Index of the looser of every comparison.
+        items_total: Number of items; indices are below it.
+        max_iterations: Upper bound of iterations.
+        tolerance: Largest change of a log strength to stop at.
+
+    Returns:
+        Strengths of the items, with a geometric mean of 1.
+    """
+    # Repeated pairs are folded into weights, so iterations are linear in the
+    # number of distinct pairs rather than comparisons.
+    pairs, counts = np.unique(
+        winners.astype(np.int64) * items_total + loosers, return_counts=True
+    )
+    first, second = np.divmod(pairs, items_total)
+
+    strengths = np.ones(items_total)
+    for _ in range(max_iterations):
+        weights = counts / (strengths[first] + strengths[second])
+        prior = 1 / (strengths + 1)
+        updated = (
+            np.bincount(first, weights * strengths[second], items_total) + prior
+        ) / (np.bincount(second, weights, items_total) + prior)
+        updated /= np.exp(np.log(updated).mean())
+        change = np.abs(np.log(updated / strengths)).max()
+        strengths = updated
+        if change < tolerance:
+            break
+    return strengths
+
+
+def to_elo(strengths: np.ndarray, base: float = 1500) -> np.ndarray:
+    """
+    Convert Bradley-Terry strengths to the Elo scale.
+    """
+    return base + 400 * np.log10(strengths)
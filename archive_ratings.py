@@ -0,0 +1,27 @@
+import argparse
+import asyncio
+from app.config import settings
+from app.database import db_manager
+from app.services.rating import RatingService
+
+
+async def archive(batch_size: int):
+    db_manager.init(settings.DATABASE_URL)
+    try:
+        async with db_manager.session() as session:
+            service = RatingService(session, None, None)
+            total = 0
+            while archived := await service.archive_ended(batch_size=batch_size):
+                total += archived
+            print(f"{total} ratings archived")
+    finally:
+        await db_manager.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pack the choices of ended ratings into compact archives."
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(archive(args.batch_size))
@@ -0,0 +1,155 @@
+import argparse
+import math
+import random
+import time
+from typing import Callable
+import numpy as np
+from app.models.tests import Pairing
+from app.utils.pairing import BinaryInsertion, PairingStrategy, strategies
+
+
+def simulate(
+    strategy: PairingStrategy, strengths: np.ndarray, noise: float, seed: int
+) -> tuple[list[int], int, float]:
+    """
+    Play a rating the way the service does, with a user who picks the item of
+    the higher hidden strength, or under `noise` the item the Bradley-Terry
+    model with that scale picks.
+
+    Returns:
+        The ranking of items from the first place down, the number of
+        comparisons and the CPU time spent in the strategy.
+    """
+    rng = random.Random(seed)
+
+    def first_wins(first: int, second: int) -> bool:
+        difference = strengths[first] - strengths[second]
+        if noise:
+            return rng.random() < 1 / (1 + math.exp(-difference / noise))
+        return difference > 0
+
+    if strategy.sequential:
+        return _simulate_sequential(strategy, len(strengths), first_wins, seed)
+
+    scores = {i: 0.0 for i in range(len(strengths))}
+    reached = dict.fromkeys(scores, 1)
+    items = list(scores)
+    stage, comparisons, cpu = 1, 0, 0.0
+    while True:
+        started = time.process_time()
+        order = strategy.order(
+            items, {i: scores[i] for i in items}, random.Random(f"{seed}:{stage}")
+        )
+        cpu += time.process_time() - started
+
+        games = []
+        for first, second in zip(order[::2], order[1::2] + [None]):
+            if second is None:
+                games.append((first, None))
+                continue
+            comparisons += 1
+            games.append(
+                (first, second) if first_wins(first, second) else (second, first)
+            )
+
+        started = time.process_time()
+        survivors, stage_scores = strategy.advance(
+            stage, {i: scores[i] for i in items}, games
+        )
+        cpu += time.process_time() - started
+        scores.update(stage_scores)
+        stage += 1
+        for i in survivors:
+            reached[i] = stage
+        if len(survivors) < 2:
+            break
+        items = survivors
+
+    ranking = sorted(scores, key=lambda i: (-reached[i], -scores[i], i))
+    return ranking, comparisons, cpu
+
+
+def _simulate_sequential(
+    strategy: BinaryInsertion,
+    items_count: int,
+    first_wins: Callable[[int, int], bool],
+    seed: int,
+) -> tuple[list[int], int, float]:
+    started = time.process_time()
+    order = strategy.order(
+        list(range(items_count)),
+        dict.fromkeys(range(items_count), 0.0),
+        random.Random(f"{seed}:1"),
+    )
+    cpu = time.process_time() - started
+    ranking, comparisons = order[:1], 0
+    for item in order[1:]:
+        wins = []
+        while True:
+            started = time.process_time()
+            low, high = strategy.search(len(ranking), wins)
+            cpu += time.process_time() - started
+            if low == high:
+                break
+            comparisons += 1
+            wins.append(first_wins(item, ranking[(low + high) // 2]))
+        ranking.insert(low, item)
+    return ranking, comparisons, cpu
+
+
+def spearman(ranking: list[int], truth: list[int]) -> float:
+    n = len(ranking)
+    if n < 2:
+        return 1.0
+    places = np.empty(n)
+    places[ranking] = np.arange(n)
+    true_places = np.empty(n)
+    true_places[truth] = np.arange(n)
+    return 1 - 6 * float(((places - true_places) ** 2).sum()) / (n * (n**2 - 1))
+
+
+def benchmark(items: int, runs: int, noise: float, top: int, seed: int):
+    print(
+        f"{'strategy':<20}{'comparisons':>12}{'top-1':>8}{f'top-{top}':>8}"
+        f"{'spearman':>10}{'cpu/decision, us':>18}"
+    )
+    for pairing in Pairing:
+        strategy = strategies[pairing]
+        totals = np.zeros(5)
+        for run in range(runs):
+            strengths = np.random.default_rng(seed + run).normal(size=items)
+            truth = sorted(range(items), key=lambda i: -strengths[i])
+            ranking, comparisons, cpu = simulate(
+                strategy, strengths, noise, seed + run
+            )
+            totals += (
+                comparisons,
+                ranking[0] == truth[0],
+                len(set(ranking[:top]) & set(truth[:top])) / min(top, items),
+                spearman(ranking, truth),
+                cpu / max(comparisons, 1) * 1e6,
+            )
+        comparisons, top_1, top_k, rho, cpu = totals / runs
+        print(
+            f"{pairing.value:<20}{comparisons:>12.1f}{top_1:>8.2f}{top_k:>8.2f}"
+            f"{rho:>10.3f}{cpu:>18.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare pairing strategies on simulated users with a "
+        "hidden ranking of items."
+    )
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument(
+        "--noise",
+        type=float,
+        default=0.0,
+        help="Scale of mistakes of users, 0 for users who never err.",
+    )
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    benchmark(args.items, args.runs, args.noise, args.top, args.seed)
@@ -9,6 +9,7 @@ from app.routers.auth import router as auth_router
 from app.routers.youtube import router as youtube_router
 from app.routers.rating import router as rating_router
 from app.routers.competition import router as competition_router
+from app.services.rating import rating_flusher, rating_reaper
 from app.utils.token import prohibited_tokens_manager
 import os
 
@@ -18,7 +19,11 @@ async def lifespan(app: FastAPI):
     db_manager.init(settings.DATABASE_URL)
     await redis_manager.init(settings.REDIS_URL)
     await prohibited_tokens_manager.init()
+    await rating_flusher.init()
+    await rating_reaper.init()
     yield
+    await rating_reaper.close()
+    await rating_flusher.close()
     await db_manager.close()
     await redis_manager.close()
 
@@ -0,0 +1,37 @@
+import argparse
+import asyncio
+from uuid import UUID
+from sqlalchemy import select
+from app.config import settings
+from app.database import db_manager
+from app.models.tests import Competition
+from app.services.competition_item_standing import CompetitionItemStandingService
+
+
+async def recompute(competition_ids: list[UUID], chunk_size: int):
+    db_manager.init(settings.DATABASE_URL)
+    try:
+        async with db_manager.session() as session:
+            if not competition_ids:
+                competition_ids = (await session.scalars(select(Competition.id))).all()
+            service = CompetitionItemStandingService(session, None, None)
+            for competition_id in competition_ids:
+                items = await service.recompute(competition_id, chunk_size=chunk_size)
+                print(f"{competition_id}: {items} items")
+    finally:
+        await db_manager.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rebuild competition standings from finished rating stages."
+    )
+    parser.add_argument(
+        "competition_ids",
+        nargs="*",
+        type=UUID,
+        help="Competitions to rebuild, all of them by default.",
+    )
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    args = parser.parse_args()
+    asyncio.run(recompute(args.competition_ids, args.chunk_size))
@@ -1,16 +1,20 @@
 from asyncio import Task
+from datetime import timedelta
 from typing import Optional
 
 import pytest
 from httpx import AsyncClient, ASGITransport
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
 from yarl import URL
 
 from alembic.command import upgrade
 from tests.db_utils import alembic_config_from_url, tmp_database
 
 from app.config import settings
-from app.database import db_manager, redis_manager
-from app.models.tests import Base
+from app.database import DatabaseSessionManager, db_manager, redis_manager
+from app.models.tests import Base, Competition, CompetitionItem, User
+from app.utils.token import generate_jwt_token
 
 from fakeredis import FakeAsyncRedis
 
@@ -74,3 +78,55 @@ async def client(session, app):
     transport = ASGITransport(app=app)
     async with AsyncClient(transport=transport, base_url="http://test") as client:
         yield client
+
+
+@pytest.fixture()
+def statements(sessionmanager_for_tests: DatabaseSessionManager):
+    executed: list[str] = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    engine = sessionmanager_for_tests._engine.sync_engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    yield executed
+    event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture()
+async def competition(session: AsyncSession):
+    user = User(
+        username="Test", email="test@test.com", access_lvl=1, hashed_password=""
+    )
+    session.add(user)
+    await session.flush()
+    competition = Competition(
+        user_id=user.id,
+        title="Test",
+        description="",
+        category="Test",
+        image="default.png",
+        published=True,
+    )
+    session.add(competition)
+    await session.flush()
+    session.add_all(
+        CompetitionItem(
+            competition_id=competition.id,
+            title=f"Video {i}",
+            description="",
+            videoId=f"video{i:06}",
+        )
+        for i in range(8)
+    )
+    await session.commit()
+    return competition
+
+
+@pytest.fixture()
+def headers(competition: Competition):
+    token = generate_jwt_token(
+        dict(sub=str(competition.user_id), access_lvl=1, type="access"),
+        timedelta(minutes=15),
+    )
+    return {"Authorization": f"Bearer {token}"}
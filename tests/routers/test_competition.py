@@ -0,0 +1,128 @@
+import asyncio
+import pytest
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+from fakeredis import FakeAsyncRedis
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import db_manager
+from app.models.tests import Competition
+from app.services.competition_item import CompetitionItemService
+from app.utils.redis import cache, delete_function_cache, invalidate_tags
+
+
+async def test_get_cached(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    statements: list[str],
+):
+    url = f"/competition/{competition.id}/"
+    get = await client.get(url)
+    assert get.status_code == status.HTTP_200_OK
+
+    statements.clear()
+    cached = await client.get(url)
+    assert cached.json() == get.json()
+    assert statements == []
+
+    patch = await client.patch(url, data={"title": "Changed"}, headers=headers)
+    assert patch.status_code == status.HTTP_200_OK
+    assert (await client.get(url)).json()["title"] == "Changed"
+
+    await client.patch(url, data={"published": False}, headers=headers)
+    assert (await client.get(url)).status_code == status.HTTP_404_NOT_FOUND
+    assert (await client.get(url, headers=headers)).status_code == status.HTTP_200_OK
+
+
+async def test_get_cached_invalidated_elsewhere(
+    client: AsyncClient,
+    competition: Competition,
+    session: AsyncSession,
+    redis: FakeAsyncRedis,
+):
+    url = f"/competition/{competition.id}/"
+    assert (await client.get(url)).status_code == status.HTTP_200_OK
+
+    # Another worker unpublishes the competition and invalidates it in Redis.
+    await session.execute(
+        update(Competition)
+        .filter(Competition.id == competition.id)
+        .values(published=False)
+    )
+    await session.commit()
+    cached = CompetitionItemService.get_competition.cache
+    key = cached.key(CompetitionItemService, competition.id)
+    await redis.delete(key)
+    assert (await client.get(url)).status_code == status.HTTP_404_NOT_FOUND
+
+    # The call is shared, so it does not use the session of its caller.
+    await redis.delete(key)
+    async with db_manager.session() as own:
+        service = CompetitionItemService(own, redis, None)
+        assert (await service.get_competition(competition.id)).published is False
+        assert not own.in_transaction()
+
+
+async def test_cache_single_flight(app: FastAPI):
+    calls = []
+
+    @cache(expire=60)
+    async def slow_square(x: int) -> int:
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        return x * x
+
+    assert await asyncio.gather(*(slow_square(3) for _ in range(10))) == [9] * 10
+    assert await slow_square(3) == 9
+    assert calls == [3]
+
+    @cache(expire=60)
+    def square(x: int) -> int:
+        calls.append(x)
+        return x * x
+
+    # Sync functions work inside a running event loop.
+    assert square(4) == square(4) == 16
+    assert calls == [3, 4]
+
+
+async def test_cache_tags(app: FastAPI):
+    calls = []
+
+    @cache(expire=60, tags=lambda x: [f"parity:{x % 2}"])
+    async def square(x: int) -> int:
+        calls.append(x)
+        return x * x
+
+    for x in (1, 2, 3):
+        await square(x)
+    await invalidate_tags("parity:1")
+    for x in (1, 2, 3):
+        await square(x)
+    assert calls == [1, 2, 3, 1, 3]
+
+    await delete_function_cache(square)
+    await square(2)
+    assert calls == [1, 2, 3, 1, 3, 2]
+
+
+async def test_cache_invalidated_in_flight(app: FastAPI):
+    calls = []
+    release = asyncio.Event()
+
+    @cache(expire=60, tags=lambda x: ["in_flight"])
+    async def slow_count(x: int) -> int:
+        calls.append(x)
+        await release.wait()
+        return len(calls)
+
+    call = asyncio.ensure_future(slow_count(1))
+    while not calls:
+        await asyncio.sleep(0)
+    # The result read before the invalidation is not stored.
+    await invalidate_tags("in_flight")
+    release.set()
+    assert await call == 1
+    assert await slow_count(1) == 2
+    assert await slow_count(1) == 2
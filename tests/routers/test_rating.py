@@ -0,0 +1,1094 @@
+import asyncio
+from datetime import datetime, timedelta
+import json
+from uuid import UUID
+import pytest
+from httpx import AsyncClient
+from fakeredis import FakeAsyncRedis
+from fastapi import FastAPI, status
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.models.tests import (
+    Competition,
+    CompetitionItem,
+    Pairing,
+    Rating,
+    RatingChoice,
+    RatingItem,
+    RatingItemStatus,
+    User,
+)
+from app.services.competition_item_standing import CompetitionItemStandingService
+from app.services.rating import RatingReaper, RatingService, RatingWriteBehindFlusher
+from app.utils.pairing import get_strategy, sequential_pairings
+from app.utils.token import generate_jwt_token
+
+
+async def play(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    seed: int | None = None,
+) -> str:
+    start = await client.post(
+        f"/rating/start/{competition.id}/",
+        params={"seed": seed} if seed is not None else None,
+        headers=headers,
+    )
+    rating_id = start.json()
+
+    last_choice = await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    choice = last_choice.json()
+    while True:
+        choose = await client.post(
+            f"/rating/{rating_id}/choose/{choice['id']}/",
+            json={"winner_id": choice["items"][-1]},
+            headers=headers,
+        )
+        if choose.json()["ended"]:
+            return rating_id
+        choice = choose.json()["next_choice"]
+
+
+@pytest.mark.parametrize("pregenerate", [False, True])
+async def test_choose_single_round_trip(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    statements: list[str],
+    monkeypatch: pytest.MonkeyPatch,
+    pregenerate: bool,
+):
+    monkeypatch.setattr(settings, "RATING_PREGENERATE_STAGES", pregenerate)
+
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    assert start.status_code == status.HTTP_200_OK
+    rating_id = start.json()
+
+    last_choice = await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    choice = last_choice.json()
+
+    statements.clear()
+    choose = await client.post(
+        f"/rating/{rating_id}/choose/{choice['id']}/",
+        json={"winner_id": choice["items"][0]},
+        headers=headers,
+    )
+    assert choose.status_code == status.HTTP_200_OK
+    assert len(statements) == 1
+
+    next_choice = choose.json()["next_choice"]
+    assert next_choice["round"] == 2
+    assert next_choice["prev"] == choice["id"]
+    assert next_choice["winner_id"] is None
+
+
+async def test_pregenerate_stage(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    session: AsyncSession,
+    statements: list[str],
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(settings, "RATING_PREGENERATE_STAGES", True)
+
+    statements.clear()
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+    inserts = [i for i in statements if i.startswith("INSERT INTO rating_choice")]
+    assert len(inserts) == 1
+
+    stmt = (
+        select(RatingChoice)
+        .filter(RatingChoice.rating_id == rating_id)
+        .order_by(RatingChoice.round)
+    )
+    choices = (await session.scalars(stmt)).all()
+    assert [(choice.stage, choice.round) for choice in choices] == [
+        (1, round) for round in range(1, 5)
+    ]
+    paired = [id for choice in choices for id in (choice.winner_id, choice.looser_id)]
+    assert len(set(paired)) == 8
+    available = await client.get(f"/rating/{rating_id}/items/ids/", headers=headers)
+    assert available.json() == []
+
+    # Pending choices stay hidden until the one before them is played.
+    grid = await client.get(f"/rating/{rating_id}/grid/", headers=headers)
+    assert [len(stage) for stage in grid.json()] == [1]
+    choice = (
+        await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    ).json()
+    assert choice["id"] == str(choices[0].id)
+    assert choice["next"] is None
+    choose = await client.post(
+        f"/rating/{rating_id}/choose/{choice['id']}/",
+        json={"winner_id": choice["items"][0]},
+        headers=headers,
+    )
+    assert choose.json()["next_choice"]["id"] == str(choices[1].id)
+
+
+async def test_grid(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    redis: FakeAsyncRedis,
+):
+    rating_id = await play(client, competition, headers)
+
+    grid = await client.get(f"/rating/{rating_id}/grid/", headers=headers)
+    assert grid.status_code == status.HTTP_200_OK
+    stages = grid.json()
+    assert [len(choices) for choices in stages] == [4, 2, 1]
+    for stage, next_stage in zip(stages, stages[1:]):
+        assert [item for choice in next_stage for item in choice] == [
+            winner for winner, _ in stage
+        ]
+
+    cached = json.loads(await redis.get(f"cache:RatingService:grid:{rating_id}"))
+    assert len(cached["stages"]) == 3
+    grid = await client.get(f"/rating/{rating_id}/grid/", headers=headers)
+    assert grid.json() == stages
+
+    compact = await client.get(
+        f"/rating/{rating_id}/grid/",
+        headers={**headers, "Accept": "application/vnd.rating-grid.compact+json"},
+    )
+    items = compact.json()["items"]
+    assert len(items) == 8
+    assert [
+        [[items[winner], items[looser]] for winner, looser in choices]
+        for choices in compact.json()["stages"]
+    ] == stages
+
+
+async def test_result(client: AsyncClient, competition: Competition, headers: dict):
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    result = await client.get(f"/rating/{start.json()}/result/", headers=headers)
+    assert result.status_code == status.HTTP_404_NOT_FOUND
+
+    rating_id = await play(client, competition, headers)
+    result = await client.get(f"/rating/{rating_id}/result/", headers=headers)
+    assert result.status_code == status.HTTP_200_OK
+    grid = (await client.get(f"/rating/{rating_id}/grid/", headers=headers)).json()
+    data = result.json()
+    assert data["champion"] == grid[-1][0][0]
+    assert data["runner_up"] == grid[-1][0][1]
+    assert [sorted(items) for items in data["eliminated"]] == [
+        sorted(looser for _, looser in choices) for choices in grid
+    ]
+
+
+async def test_result_tied_tiers(
+    client: AsyncClient, competition: Competition, headers: dict, session: AsyncSession
+):
+    # With six items in Swiss pairing, upsets leave three items tied on wins.
+    competition.pairing = Pairing.SWISS
+    items = (
+        await session.scalars(
+            select(CompetitionItem.id)
+            .filter(CompetitionItem.competition_id == competition.id)
+            .order_by(CompetitionItem.id)
+        )
+    ).all()
+    await session.execute(
+        delete(CompetitionItem).filter(CompetitionItem.id.in_(items[6:]))
+    )
+    await session.commit()
+
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+    choice = (
+        await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    ).json()
+    wins = {str(id): 0 for id in items[:6]}
+    while True:
+        # The item with fewer wins wins.
+        winner_id = min(choice["items"], key=lambda id: (wins[id], id))
+        wins[winner_id] += 1
+        choose = await client.post(
+            f"/rating/{rating_id}/choose/{choice['id']}/",
+            json={"winner_id": winner_id},
+            headers=headers,
+        )
+        if choose.json()["ended"]:
+            break
+        choice = choose.json()["next_choice"]
+
+    grid = (await client.get(f"/rating/{rating_id}/grid/", headers=headers)).json()
+    buchholz = dict.fromkeys(wins, 0)
+    for choices in grid:
+        for winner_id, looser_id in choices:
+            buchholz[winner_id] += wins[looser_id]
+            buchholz[looser_id] += wins[winner_id]
+    result = (await client.get(f"/rating/{rating_id}/result/", headers=headers)).json()
+    assert sorted(wins.values(), reverse=True)[:3] == [2, 2, 2]
+
+    tiers = result["tiers"]
+    assert sorted(id for tier in tiers for id in tier) == sorted(wins)
+    assert result["champion"] == tiers[0][0]
+    assert result["runner_up"] == (tiers[0] + tiers[1])[1]
+    places = [{(wins[id], buchholz[id]) for id in tier} for tier in tiers]
+    assert all(len(place) == 1 for place in places)
+    assert [place.pop() for place in places] == sorted(
+        {(wins[id], buchholz[id]) for id in wins}, reverse=True
+    )
+
+
+async def test_idempotency_key(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    statements: list[str],
+):
+    url = f"/rating/start/{competition.id}/"
+    start_headers = {**headers, "Idempotency-Key": "start"}
+    rating_id = (
+        await client.post(url, params={"resume": False}, headers=start_headers)
+    ).json()
+    retry = await client.post(url, params={"resume": False}, headers=start_headers)
+    assert retry.json() == rating_id
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+    choice = (
+        await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    ).json()
+    choose_url = f"/rating/{rating_id}/choose/{choice['id']}/"
+    choose_headers = {**headers, "Idempotency-Key": "choose"}
+    payload = {"winner_id": choice["items"][0]}
+    choose = await client.post(choose_url, json=payload, headers=choose_headers)
+    assert choose.status_code == status.HTTP_200_OK
+
+    statements.clear()
+    retry = await client.post(choose_url, json=payload, headers=choose_headers)
+    assert retry.status_code == status.HTTP_200_OK
+    assert retry.json() == choose.json()
+    assert statements == []
+
+    other = await client.post(
+        choose_url, json={"winner_id": choice["items"][1]}, headers=choose_headers
+    )
+    assert other.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+async def test_concurrent_update(
+    client: AsyncClient, competition: Competition, headers: dict, session: AsyncSession
+):
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+    choice = (
+        await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    ).json()
+    choose_url = f"/rating/{rating_id}/choose/{choice['id']}/"
+    payload = {"winner_id": choice["items"][0]}
+
+    # Another request is updating the rating.
+    await session.execute(
+        select(Rating.id).filter(Rating.id == rating_id).with_for_update()
+    )
+    choose = await client.post(choose_url, json=payload, headers=headers)
+    assert choose.status_code == status.HTTP_409_CONFLICT
+    refresh = await client.post(
+        f"/rating/{rating_id}/refresh/{choice['id']}/", headers=headers
+    )
+    assert refresh.status_code == status.HTTP_409_CONFLICT
+    await session.rollback()
+
+    choose = await client.post(choose_url, json=payload, headers=headers)
+    assert choose.status_code == status.HTTP_200_OK
+    assert choose.json()["next_choice"]["round"] == 2
+
+
+async def test_choose_keeps_pool(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    session: AsyncSession,
+    redis: FakeAsyncRedis,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+    choice = (
+        await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    ).json()
+    choose_url = f"/rating/{rating_id}/choose/{choice['id']}/"
+    payload = {"winner_id": choice["items"][0]}
+    pool_key = RatingService.cache_key_items.format(rating_id=rating_id)
+    pool = await redis.zrange(pool_key, 0, -1, withscores=True)
+    assert len(pool) == 6
+
+    # Another user does not draw from the pool of the rating.
+    other = User(
+        username="Other", email="other@test.com", access_lvl=1, hashed_password=""
+    )
+    session.add(other)
+    await session.commit()
+    token = generate_jwt_token(
+        dict(sub=str(other.id), access_lvl=1, type="access"), timedelta(minutes=15)
+    )
+    other_headers = {"Authorization": f"Bearer {token}"}
+    choose = await client.post(choose_url, json=payload, headers=other_headers)
+    assert choose.status_code == status.HTTP_404_NOT_FOUND
+    assert await redis.zrange(pool_key, 0, -1, withscores=True) == pool
+
+    # A pair drawn by a failed request is not lost: the pool is rebuilt.
+    async def fail(*args):
+        raise RuntimeError
+
+    with monkeypatch.context() as patch:
+        patch.setattr(RatingService, "_choose_in_one_statement", fail)
+        with pytest.raises(RuntimeError):
+            await client.post(choose_url, json=payload, headers=headers)
+    assert not await redis.exists(pool_key)
+
+    while choice["stage"] == 1:
+        choose = await client.post(
+            f"/rating/{rating_id}/choose/{choice['id']}/",
+            json={"winner_id": choice["items"][0]},
+            headers=headers,
+        )
+        choice = choose.json()["next_choice"]
+    grid = (await client.get(f"/rating/{rating_id}/grid/", headers=headers)).json()
+    assert len(grid[0]) == 4
+
+
+async def test_choose_stepwise_keeps_pool(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    redis: FakeAsyncRedis,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+    choice = (
+        await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    ).json()
+    pool_key = RatingService.cache_key_items.format(rating_id=rating_id)
+
+    async def stepwise(*args):
+        return None
+
+    async def fail(*args):
+        raise RuntimeError
+
+    # The next pair is drawn, then the request fails before the commit.
+    with monkeypatch.context() as patch:
+        patch.setattr(RatingService, "_choose_in_one_statement", stepwise)
+        patch.setattr(RatingService, "_commit_choice", fail)
+        with pytest.raises(RuntimeError):
+            await client.post(
+                f"/rating/{rating_id}/choose/{choice['id']}/",
+                json={"winner_id": choice["items"][0]},
+                headers=headers,
+            )
+    assert not await redis.exists(pool_key)
+
+    while choice["stage"] == 1:
+        choose = await client.post(
+            f"/rating/{rating_id}/choose/{choice['id']}/",
+            json={"winner_id": choice["items"][0]},
+            headers=headers,
+        )
+        choice = choose.json()["next_choice"]
+    grid = (await client.get(f"/rating/{rating_id}/grid/", headers=headers)).json()
+    assert len(grid[0]) == 4
+
+
+async def test_start_resume(
+    client: AsyncClient, competition: Competition, headers: dict
+):
+    url = f"/rating/start/{competition.id}/"
+    rating_id = (await client.post(url, headers=headers)).json()
+    assert (await client.post(url, headers=headers)).json() == rating_id
+
+    restart = await client.post(url, params={"resume": False}, headers=headers)
+    assert restart.status_code == status.HTTP_200_OK
+    assert restart.json() != rating_id
+    old = await client.get(f"/rating/{rating_id}/", headers=headers)
+    assert old.status_code == status.HTTP_404_NOT_FOUND
+
+    finished_id = await play(client, competition, headers)
+    assert finished_id == restart.json()
+    assert (await client.post(url, headers=headers)).json() != finished_id
+
+
+async def test_last_choice_ended(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    session: AsyncSession,
+):
+    rating_id = await play(client, competition, headers)
+    rating = (await client.get(f"/rating/{rating_id}/", headers=headers)).json()
+    assert rating["ended"]
+    assert "round" in rating and "choices" not in rating
+
+    last = await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    assert last.status_code == status.HTTP_200_OK
+    final = (
+        await session.execute(
+            select(RatingChoice)
+            .filter(RatingChoice.rating_id == rating_id)
+            .order_by(RatingChoice.stage.desc(), RatingChoice.round.desc())
+            .limit(1)
+        )
+    ).scalar_one()
+    assert last.json()["id"] == str(final.id)
+    assert last.json()["winner_id"] == str(final.winner_id)
+    assert last.json()["next"] is None
+
+
+async def test_reap_abandoned(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    session: AsyncSession,
+    redis: FakeAsyncRedis,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    finished_id = await play(client, competition, headers)
+    url = f"/rating/start/{competition.id}/"
+    abandoned_id = (await client.post(url, headers=headers)).json()
+    await client.get(f"/rating/{abandoned_id}/items/ids/", headers=headers)
+    await session.execute(
+        update(Rating).values(updated_at=datetime.now() - timedelta(days=2))
+    )
+    await session.commit()
+
+    monkeypatch.setattr(settings, "RATING_ABANDONED_AFTER", 24 * 3600)
+    monkeypatch.setattr(settings, "RATING_REAP_BATCH", 1)
+    await redis.delete(RatingReaper.lock_key)
+    reaper = RatingReaper()
+    assert await reaper.reap() == 1
+    # The next sweep takes the lock again and finds nothing left.
+    await redis.delete(RatingReaper.lock_key)
+    assert await reaper.reap() == 0
+    assert await redis.exists(RatingReaper.lock_key)
+    assert (await session.scalars(select(Rating.id))).all() == [UUID(finished_id)]
+
+    rating = await client.get(f"/rating/{abandoned_id}/", headers=headers)
+    assert rating.status_code == status.HTTP_404_NOT_FOUND
+    assert not await redis.exists(f"cache:RatingService:item_pool:{abandoned_id}")
+    rating = await client.get(f"/rating/{finished_id}/", headers=headers)
+    assert rating.status_code == status.HTTP_200_OK
+
+
+async def test_reap_revised(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    session: AsyncSession,
+    redis: FakeAsyncRedis,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+    last_choice = await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    choice = last_choice.json()
+    await client.post(
+        f"/rating/{rating_id}/choose/{choice['id']}/",
+        json={"winner_id": choice["items"][0]},
+        headers=headers,
+    )
+    await session.execute(
+        update(Rating).values(updated_at=datetime.now() - timedelta(days=2))
+    )
+    await session.commit()
+
+    # Revising an earlier choice does not move the rating forward.
+    revise = await client.post(
+        f"/rating/{rating_id}/choose/{choice['id']}/",
+        json={"winner_id": choice["items"][1]},
+        headers=headers,
+    )
+    assert revise.status_code == status.HTTP_200_OK
+
+    monkeypatch.setattr(settings, "RATING_ABANDONED_AFTER", 24 * 3600)
+    await redis.delete(RatingReaper.lock_key)
+    assert await RatingReaper().reap() == 0
+    rating = await client.get(f"/rating/{rating_id}/", headers=headers)
+    assert rating.status_code == status.HTTP_200_OK
+
+
+async def test_flusher_close(app: FastAPI, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, "RATING_WRITE_BEHIND", True)
+    flusher = RatingWriteBehindFlusher()
+    await flusher.init()
+    task = flusher.flush_task
+    await asyncio.sleep(0)
+    await flusher.close()
+    assert task.done() and flusher.flush_task is None
+
+
+@pytest.mark.parametrize("pregenerate", [False, True])
+async def test_seed(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    monkeypatch: pytest.MonkeyPatch,
+    pregenerate: bool,
+):
+    monkeypatch.setattr(settings, "RATING_PREGENERATE_STAGES", pregenerate)
+
+    grids = []
+    for _ in range(2):
+        rating_id = await play(client, competition, headers, seed=42)
+        grid = await client.get(f"/rating/{rating_id}/grid/", headers=headers)
+        grids.append(grid.json())
+    assert grids[0] == grids[1]
+
+
+@pytest.mark.parametrize(
+    "pairing", [pairing for pairing in Pairing if pairing not in sequential_pairings]
+)
+async def test_pairing(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    session: AsyncSession,
+    pairing: Pairing,
+):
+    competition.pairing = pairing
+    await session.commit()
+    strengths = {
+        str(item.id): int(item.videoId[-6:])
+        for item in await session.scalars(
+            select(CompetitionItem).filter(
+                CompetitionItem.competition_id == competition.id
+            )
+        )
+    }
+
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+    choice = (
+        await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    ).json()
+    while True:
+        choose = await client.post(
+            f"/rating/{rating_id}/choose/{choice['id']}/",
+            json={"winner_id": max(choice["items"], key=strengths.get)},
+            headers=headers,
+        )
+        if choose.json()["ended"]:
+            break
+        choice = choose.json()["next_choice"]
+
+    result = await client.get(f"/rating/{rating_id}/result/", headers=headers)
+    assert result.json()["champion"] == max(strengths, key=strengths.get)
+    grid = (await client.get(f"/rating/{rating_id}/grid/", headers=headers)).json()
+    strategy = get_strategy(pairing)
+    assert len(grid) == strategy.stages_total(8)
+    assert [len(choices) for choices in grid] == [
+        strategy.rounds_total(8, stage) for stage in range(1, len(grid) + 1)
+    ]
+
+
+async def test_full_ranking(
+    client: AsyncClient, competition: Competition, headers: dict, session: AsyncSession
+):
+    strengths = {
+        str(item.id): int(item.videoId[-6:])
+        for item in await session.scalars(
+            select(CompetitionItem).filter(
+                CompetitionItem.competition_id == competition.id
+            )
+        )
+    }
+    start = await client.post(
+        f"/rating/start/{competition.id}/",
+        params={"pairing": Pairing.FULL_RANKING.value},
+        headers=headers,
+    )
+    rating_id = start.json()
+    choice = (
+        await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    ).json()
+    refresh = await client.post(
+        f"/rating/{rating_id}/refresh/{choice['id']}/", headers=headers
+    )
+    assert refresh.status_code == status.HTTP_400_BAD_REQUEST
+
+    changed = False
+    rounds = {}
+    while True:
+        rounds[choice["stage"]] = choice["round"]
+        winner_id = max(choice["items"], key=strengths.get)
+        if choice["stage"] == 3 and choice["round"] == 1:
+            # Answer wrong, then change the answer from the next choice; with
+            # three items ranked the stage goes on either way.
+            changed = True
+            wrong = await client.post(
+                f"/rating/{rating_id}/choose/{choice['id']}/",
+                json={"winner_id": min(choice["items"], key=strengths.get)},
+                headers=headers,
+            )
+            assert wrong.json()["next_choice"]["round"] == 2
+        choose = await client.post(
+            f"/rating/{rating_id}/choose/{choice['id']}/",
+            json={"winner_id": winner_id},
+            headers=headers,
+        )
+        assert choose.status_code == status.HTTP_200_OK
+        if choose.json()["ended"]:
+            break
+        choice = choose.json()["next_choice"]
+    assert changed
+
+    result = (await client.get(f"/rating/{rating_id}/result/", headers=headers)).json()
+    ranking = sorted(strengths, key=strengths.get, reverse=True)
+    assert [result["champion"], result["runner_up"]] == ranking[:2]
+    assert result["eliminated"] == [[id] for id in reversed(ranking[1:])]
+
+    grid = (await client.get(f"/rating/{rating_id}/grid/", headers=headers)).json()
+    strategy = get_strategy(Pairing.FULL_RANKING)
+    assert len(grid) == strategy.stages_total(8)
+    assert [len(choices) for choices in grid] == [
+        rounds[stage] for stage in range(1, len(grid) + 1)
+    ]
+    assert all(
+        len(choices) <= strategy.rounds_total(8, stage)
+        for stage, choices in enumerate(grid, 1)
+    )
+
+    # Every insertion counts toward the standings once its stage ends, the
+    # same way it does when they are recomputed.
+    url = f"/competition/{competition.id}/standings/?max_per_page=8&page=1"
+    incremental = (await client.get(url)).json()["data"]
+    service = CompetitionItemStandingService(session, None, None)
+    assert await service.recompute(competition.id) == 8
+    recomputed = (await client.get(url)).json()["data"]
+
+    def counters(standings: list[dict]):
+        return sorted(
+            (i["item_id"], i["wins"], i["losses"], i["appearances"]) for i in standings
+        )
+
+    assert counters(recomputed) == counters(incremental)
+    assert sum(i["wins"] for i in incremental) == sum(rounds.values())
+
+
+async def test_choose_write_behind(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    statements: list[str],
+    redis: FakeAsyncRedis,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(settings, "RATING_WRITE_BEHIND", True)
+
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+    last_choice = await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    choice = last_choice.json()
+
+    choose = await client.post(
+        f"/rating/{rating_id}/choose/{choice['id']}/",
+        json={"winner_id": choice["items"][0]},
+        headers=headers,
+    )
+    choice = choose.json()["next_choice"]
+
+    state_key = RatingService.write_behind_state.format(rating_id=rating_id)
+    winners = {}
+    statements.clear()
+    for _ in range(2):
+        # Pick the item drawn second, so a result lost on flush shows up.
+        first = (await redis.hget(state_key, "first")).decode()
+        winner_id = next(i for i in choice["items"] if i != first)
+        winners[choice["id"]] = winner_id
+        choose = await client.post(
+            f"/rating/{rating_id}/choose/{choice['id']}/",
+            json={"winner_id": winner_id},
+            headers=headers,
+        )
+        assert choose.status_code == status.HTTP_200_OK
+        choice = choose.json()["next_choice"]
+    assert statements == []
+
+    last_choice = await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    assert last_choice.json() == {**choice, "next": None}
+    assert last_choice.json()["round"] == 4
+    for choice_id, winner_id in winners.items():
+        decided = await client.get(
+            f"/rating/{rating_id}/choice/{choice_id}/", headers=headers
+        )
+        assert decided.json()["winner_id"] == winner_id
+
+
+async def test_write_behind_replay(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    session: AsyncSession,
+    redis: FakeAsyncRedis,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(settings, "RATING_WRITE_BEHIND", True)
+
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+    choice = (
+        await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    ).json()
+    log_key = RatingService.write_behind_log.format(rating_id=rating_id)
+    while choice["stage"] == 1:
+        if choice["round"] == 4:
+            # A flush late to read the log still holds the entries of the
+            # stage when it ends.
+            entries = [
+                {key.decode(): value.decode() for key, value in fields.items()}
+                for _, fields in await redis.xrange(log_key)
+            ]
+        choose = await client.post(
+            f"/rating/{rating_id}/choose/{choice['id']}/",
+            json={"winner_id": choice["items"][0]},
+            headers=headers,
+        )
+        choice = choose.json()["next_choice"]
+    assert entries
+
+    async def state():
+        items = await session.execute(
+            select(RatingItem.item_id, RatingItem.stage, RatingItem.status)
+            .filter(RatingItem.rating_id == UUID(rating_id))
+            .order_by(RatingItem.item_id)
+        )
+        rating = await session.get(Rating, UUID(rating_id), populate_existing=True)
+        return items.all(), (rating.stage, rating.round)
+
+    before = await state()
+    service = RatingService(session, redis, None)
+    await service._apply_write_behind(entries)
+    await session.commit()
+    assert await state() == before
+    assert before[1] == (2, 1)
+
+
+async def test_rating_items(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    session: AsyncSession,
+):
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+    choice = (
+        await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    ).json()
+
+    async def statuses():
+        stmt = select(RatingItem.item_id, RatingItem.stage, RatingItem.status).filter(
+            RatingItem.rating_id == rating_id
+        )
+        return {
+            str(item_id): (stage, status)
+            for item_id, stage, status in await session.execute(stmt)
+        }
+
+    members = await statuses()
+    assert len(members) == 8
+    assert {
+        id for id, status in members.items() if status == (1, RatingItemStatus.PAIRED)
+    } == set(choice["items"])
+    available = [s for s in members.values() if s == (1, RatingItemStatus.AVAILABLE)]
+    assert len(available) == 6
+
+    winner_id, looser_id = choice["items"]
+    choose = await client.post(
+        f"/rating/{rating_id}/choose/{choice['id']}/",
+        json={"winner_id": winner_id},
+        headers=headers,
+    )
+    next_items = choose.json()["next_choice"]["items"]
+    members = await statuses()
+    assert members[winner_id] == (1, RatingItemStatus.PAIRED)
+    assert members[looser_id] == (1, RatingItemStatus.ELIMINATED)
+    assert all(members[id] == (1, RatingItemStatus.PAIRED) for id in next_items)
+
+    # Items added after the start do not join the rating.
+    item = CompetitionItem(
+        competition_id=competition.id,
+        title="Video 8",
+        description="",
+        videoId="video000008",
+    )
+    session.add(item)
+    await session.commit()
+    items = await client.get(f"/rating/{rating_id}/items/", headers=headers)
+    assert sorted(i["id"] for i in items.json()) == sorted(members)
+    available = await client.get(f"/rating/{rating_id}/items/ids/", headers=headers)
+    assert str(item.id) not in available.json()
+    assert len(available.json()) == 4
+
+
+async def test_items_count(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    session: AsyncSession,
+):
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+
+    rounds_total = await client.get(f"/rating/{rating_id}/rounds_total/", headers=headers)
+    assert rounds_total.json() == 4
+    stages_total = await client.get(
+        f"/competition/{competition.id}/stages_total/", headers=headers
+    )
+    assert stages_total.json() == 3
+
+    # Items added later count for the competition, but not for the rating.
+    session.add_all(
+        CompetitionItem(
+            competition_id=competition.id,
+            title=f"Video {i}",
+            description="",
+            videoId=f"video{i:06}",
+        )
+        for i in range(8, 10)
+    )
+    await session.commit()
+    stages_total = await client.get(
+        f"/competition/{competition.id}/stages_total/", headers=headers
+    )
+    assert stages_total.json() == 4
+    rounds_total = await client.get(f"/rating/{rating_id}/rounds_total/", headers=headers)
+    assert rounds_total.json() == 4
+    snapshot = await client.get(f"/rating/{rating_id}/snapshot/", headers=headers)
+    assert (snapshot.json()["rounds_total"], snapshot.json()["stages_total"]) == (4, 3)
+
+    await session.execute(
+        delete(CompetitionItem).filter(CompetitionItem.competition_id == competition.id)
+    )
+    await session.commit()
+    stages_total = await client.get(
+        f"/competition/{competition.id}/stages_total/", headers=headers
+    )
+    assert stages_total.json() == 0
+
+
+async def test_standings(client: AsyncClient, competition: Competition, headers: dict):
+    for _ in range(2):
+        await play(client, competition, headers)
+
+    standings = await client.get(
+        f"/competition/{competition.id}/standings/?max_per_page=8&page=1"
+    )
+    assert standings.status_code == status.HTTP_200_OK
+    data = standings.json()["data"]
+    assert standings.json()["total"] == 8
+    assert sum(i["wins"] for i in data) == sum(i["losses"] for i in data) == 14
+    assert all(i["appearances"] == i["wins"] + i["losses"] for i in data)
+    assert data[0]["score"] > 1500 > data[-1]["score"]
+    assert [i["score"] for i in data] == sorted((i["score"] for i in data), reverse=True)
+
+
+async def test_recompute_standings(
+    client: AsyncClient, competition: Competition, headers: dict, session: AsyncSession
+):
+    for _ in range(2):
+        await play(client, competition, headers)
+    url = f"/competition/{competition.id}/standings/?max_per_page=8&page=1"
+    incremental = (await client.get(url)).json()["data"]
+
+    service = CompetitionItemStandingService(session, None, None)
+    assert await service.recompute(competition.id, chunk_size=5) == 8
+    recomputed = (await client.get(url)).json()["data"]
+
+    def counters(standings: list[dict]):
+        return sorted(
+            (i["item_id"], i["wins"], i["losses"], i["appearances"]) for i in standings
+        )
+
+    assert counters(recomputed) == counters(incremental)
+    assert recomputed[0]["wins"] == 6
+    assert recomputed[0]["score"] > 1500 > recomputed[-1]["score"]
+
+
+@pytest.mark.parametrize("pairing", [Pairing.SINGLE_ELIMINATION, Pairing.FULL_RANKING])
+async def test_archive(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    session: AsyncSession,
+    redis: FakeAsyncRedis,
+    pairing: Pairing,
+):
+    competition.pairing = pairing
+    await session.commit()
+    rating_id = await play(client, competition, headers)
+    choice_ids = (
+        await session.scalars(
+            select(RatingChoice.id).filter(RatingChoice.rating_id == rating_id)
+        )
+    ).all()
+
+    async def read():
+        await redis.delete(f"cache:RatingService:grid:{rating_id}")
+        grid = await client.get(f"/rating/{rating_id}/grid/", headers=headers)
+        choices = [
+            (await client.get(f"/rating/{rating_id}/choice/{id}/", headers=headers))
+            .json()
+            for id in choice_ids
+        ]
+        last = await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+        items = await client.get(f"/rating/{rating_id}/items/", headers=headers)
+        return grid.json(), choices, last.json(), items.json()
+
+    expected = await read()
+    service = RatingService(session, redis, None)
+    assert await service.archive_ended() == 1
+    assert await service.archive_ended() == 0
+    assert not await session.scalar(
+        select(RatingChoice.id).filter(RatingChoice.rating_id == rating_id)
+    )
+    # Only the winner of a tournament is left, as the items of its last stage.
+    items = (
+        await session.scalars(
+            select(RatingItem.item_id).filter(RatingItem.rating_id == rating_id)
+        )
+    ).all()
+    assert len(items) == (0 if pairing in sequential_pairings else 1)
+    assert await read() == expected
+
+    url = f"/competition/{competition.id}/standings/?max_per_page=8&page=1"
+    incremental = (await client.get(url)).json()["data"]
+    standings = CompetitionItemStandingService(session, None, None)
+    assert await standings.recompute(competition.id) == 8
+    recomputed = (await client.get(url)).json()["data"]
+    assert sorted((i["item_id"], i["wins"], i["losses"]) for i in recomputed) == sorted(
+        (i["item_id"], i["wins"], i["losses"]) for i in incremental
+    )
+
+
+async def test_choose_batch(client: AsyncClient, competition: Competition, headers: dict):
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+    last_choice = await client.get(f"/rating/{rating_id}/choice/last/", headers=headers)
+    choices = [last_choice.json()]
+    for _ in range(2):
+        choose = await client.post(
+            f"/rating/{rating_id}/choose/{choices[-1]['id']}/",
+            json={"winner_id": choices[-1]["items"][0]},
+            headers=headers,
+        )
+        choices.append(choose.json()["next_choice"])
+
+    invalid = await client.post(
+        f"/rating/{rating_id}/choose/",
+        json=[
+            {"choice_id": choices[0]["id"], "winner_id": choices[0]["items"][1]},
+            {"choice_id": choices[1]["id"], "winner_id": choices[0]["items"][1]},
+        ],
+        headers=headers,
+    )
+    assert invalid.status_code == status.HTTP_400_BAD_REQUEST
+    first = await client.get(
+        f"/rating/{rating_id}/choice/{choices[0]['id']}/", headers=headers
+    )
+    assert first.json()["winner_id"] == choices[0]["items"][0]
+
+    batch = await client.post(
+        f"/rating/{rating_id}/choose/",
+        json=[
+            {"choice_id": choice["id"], "winner_id": choice["items"][1]}
+            for choice in choices
+        ],
+        headers=headers,
+    )
+    assert batch.status_code == status.HTTP_200_OK
+    assert batch.json()["next_choice"]["round"] == 4
+    assert batch.json()["next_choice"]["prev"] == choices[-1]["id"]
+    first = await client.get(
+        f"/rating/{rating_id}/choice/{choices[0]['id']}/", headers=headers
+    )
+    assert first.json()["winner_id"] == choices[0]["items"][1]
+
+
+@pytest.mark.parametrize("write_behind", [False, True])
+async def test_embed_items(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    monkeypatch: pytest.MonkeyPatch,
+    write_behind: bool,
+):
+    monkeypatch.setattr(settings, "RATING_WRITE_BEHIND", write_behind)
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+
+    last_choice = await client.get(
+        f"/rating/{rating_id}/choice/last/?embed_items=true", headers=headers
+    )
+    choice = last_choice.json()
+    assert [i["id"] for i in choice["items_data"]] == choice["items"]
+
+    for _ in range(2):
+        choose = await client.post(
+            f"/rating/{rating_id}/choose/{choice['id']}/?embed_items=true",
+            json={"winner_id": choice["items"][0]},
+            headers=headers,
+        )
+        choice = choose.json()["next_choice"]
+        assert [i["id"] for i in choice["items_data"]] == choice["items"]
+        assert all(i["title"].startswith("Video") for i in choice["items_data"])
+
+
+async def test_snapshot(
+    client: AsyncClient,
+    competition: Competition,
+    headers: dict,
+    statements: list[str],
+    redis: FakeAsyncRedis,
+):
+    start = await client.post(f"/rating/start/{competition.id}/", headers=headers)
+    rating_id = start.json()
+
+    snapshot = await client.get(f"/rating/{rating_id}/snapshot/", headers=headers)
+    assert snapshot.status_code == status.HTTP_200_OK
+    data = snapshot.json()
+    assert data["rating"]["id"] == rating_id
+    assert len(data["items"]) == 8
+    assert data["rounds_total"] == 4
+    assert data["stages_total"] == 3
+    etag = snapshot.headers["ETag"]
+
+    statements.clear()
+    cached = await client.get(
+        f"/rating/{rating_id}/snapshot/", headers={**headers, "If-None-Match": etag}
+    )
+    assert cached.status_code == status.HTTP_304_NOT_MODIFIED
+    assert cached.headers["ETag"] == etag
+    assert statements == []
+
+    choice = data["choice"]
+    await client.post(
+        f"/rating/{rating_id}/choose/{choice['id']}/",
+        json={"winner_id": choice["items"][0]},
+        headers=headers,
+    )
+    snapshot = await client.get(
+        f"/rating/{rating_id}/snapshot/", headers={**headers, "If-None-Match": etag}
+    )
+    assert snapshot.status_code == status.HTTP_200_OK
+    assert snapshot.headers["ETag"] != etag
+    assert snapshot.json()["choice"]["round"] == 2
+
+    # The version was marked pending along with the draw, so the snapshot read
+    # while the choice was being committed is not cached until it expires.
+    version_key = RatingService.cache_snapshot_version.format(rating_id=rating_id)
+    assert await redis.get(version_key) == b"pending"
+    await redis.delete(version_key)
+    etag = (
+        await client.get(f"/rating/{rating_id}/snapshot/", headers=headers)
+    ).headers["ETag"]
+    cached = await client.get(
+        f"/rating/{rating_id}/snapshot/", headers={**headers, "If-None-Match": etag}
+    )
+    assert cached.status_code == status.HTTP_304_NOT_MODIFIED